@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from tle.util.db.user_db_conn import UserDbConn, _HOT_QUERIES
+
+
+@pytest.fixture
+def db_file(tmpdir):
+    return os.path.join(str(tmpdir), 'user.db')
+
+
+def test_hot_queries_do_not_scan(db_file):
+    user_db = UserDbConn(db_file)
+    try:
+        regressions = user_db.check_query_plans()
+    finally:
+        user_db.close()
+    assert _HOT_QUERIES
+    assert not regressions, '\n'.join(f'{query!r} plans as {plan}'
+                                      for query, plan in regressions)
+
+
+def test_missing_index_is_reported(db_file):
+    user_db = UserDbConn(db_file)
+    with user_db.conn:
+        user_db.conn.execute('DROP INDEX ix_challenge_user_id_status')
+    user_db.close()
+
+    # A new connection, the statements of the first one were prepared with the old schema.
+    user_db = UserDbConn(db_file)
+    try:
+        regressions = user_db.check_query_plans()
+    finally:
+        user_db.close()
+    assert any('FROM challenge' in query for query, _ in regressions)
@@ -7,13 +7,11 @@ from logging.handlers import TimedRotatingFileHandler
 from os import environ
 from pathlib import Path
 
-import seaborn as sns
 from discord.ext import commands
-from matplotlib import pyplot as plt
 
 from tle import constants
 from tle.util import codeforces_common as cf_common
-from tle.util import discord_common, font_downloader
+from tle.util import discord_common, font_downloader, graph_common
 
 
 def setup():
@@ -29,14 +27,7 @@ def setup():
                                                            backupCount=3, utc=True)])
 
     # matplotlib and seaborn
-    plt.rcParams['figure.figsize'] = 7.0, 3.5
-    sns.set()
-    options = {
-        'axes.edgecolor': '#A0A0C5',
-        'axes.spines.top': False,
-        'axes.spines.right': False,
-    }
-    sns.set_style('darkgrid', options)
+    graph_common.setup_style()
 
     # Download fonts if necessary
     font_downloader.maybe_download()
@@ -4,7 +4,10 @@ import traceback
 
 from discord.ext import commands
 
+from tle.util import codeforces_api as cf
 from tle.util import codeforces_common as cf_common
+from tle.util import graph_common as gc
+from tle.util import table
 
 
 def timed_command(coro):
@@ -83,6 +86,43 @@ class CacheControl(commands.Cog):
             count = await cf_common.cache2.problemset_cache.update_for_contest(contest_id)
         await ctx.send(f'Done, fetched {count} problems')
 
+    @cache.command(brief='Show Codeforces API request scheduler stats')
+    @commands.has_role('Admin')
+    async def apistats(self, ctx):
+        """Shows queue depth, requests in flight, requests served and wait times in seconds
+        for every lane of the Codeforces API request scheduler.
+        """
+        style = table.Style('{:<}  {:>}  {:>}  {:>}  {:>}  {:>}')
+        t = table.Table(style)
+        t += table.Header('Lane', 'Queued', 'Running', 'Served', 'Avg wait', 'Max wait')
+        t += table.Line()
+        for lane, stats in cf.request_scheduler.get_stats().items():
+            t += table.Data(lane, stats.queued, stats.in_flight, stats.served,
+                            f'{stats.avg_wait:.2f}', f'{stats.max_wait:.2f}')
+        await ctx.send(f'```\n{t}\n```')
+
+    @cache.command(brief='Show plot render queue and render cache stats')
+    @commands.has_role('Admin')
+    async def renderstats(self, ctx):
+        """Shows renders done, failures and wait and render times in seconds for every render
+        function, followed by the hits, misses and size of the render cache.
+        """
+        style = table.Style('{:<}  {:>}  {:>}  {:>}  {:>}  {:>}')
+        t = table.Table(style)
+        t += table.Header('Function', 'Renders', 'Failed', 'Avg wait', 'Avg render', 'Max render')
+        t += table.Line()
+        for name, stats in sorted(gc.render_queue.stats.items()):
+            t += table.Data(name, stats.count, stats.failures,
+                            f'{stats.total_wait_time / stats.count:.2f}',
+                            f'{stats.total_render_time / stats.count:.2f}',
+                            f'{stats.max_render_time:.2f}')
+        cache = gc.render_cache
+        lookups = cache.hits + cache.misses
+        hit_rate = cache.hits / lookups if lookups else 0
+        await ctx.send(f'```\n{t}\n\nCache: {cache.hits} hits, {cache.misses} misses '
+                       f'({hit_rate:.0%} hit rate), {cache.size / 2**20:.1f} of '
+                       f'{cache.max_bytes / 2**20:.1f} MiB used\n```')
+
     async def cog_command_error(self, ctx, error):
         if isinstance(error, commands.CommandInvokeError):
             error = error.__cause__
@@ -73,19 +73,17 @@ class Codeforces(commands.Cog):
         rating = round(user.effective_rating, -2)
         resp = await cf.user.rating(handle=handle)
         contests = {change.contestId for change in resp}
-        submissions = await cf.user.status(handle=handle)
-        solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.name not in solved and prob.contestId in contests
-                    and abs(rating - prob.rating) <= 300]
+        solved = await cf_common.cache2.submission_cache.get_problem_bits([handle], 'solved')
+        problems = cf_common.cache2.problem_cache.select(min_rating=rating - 300,
+                                                         max_rating=rating + 300,
+                                                         contest_ids=contests,
+                                                         exclude_bits=solved,
+                                                         newest_first=True)
 
         if not problems:
             await ctx.send('Problems not found within the search parameters')
             return
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds, reverse=True)
-
         if choice > 0 and choice <= len(problems):
             problem = problems[choice - 1]
             await self._gitgud(ctx, handle, problem, problem.rating - rating)
@@ -109,21 +107,16 @@ class Codeforces(commands.Cog):
             else:
                 tags.append(arg)
 
-        submissions = await cf.user.status(handle=handle)
-        solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
+        solved = await cf_common.cache2.submission_cache.get_problem_bits([handle], 'solved')
 
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating == rating and prob.name not in solved and
-                    not cf_common.is_contest_writer(prob.contestId, handle)]
-        if tags:
-            problems = [prob for prob in problems if prob.tag_matches(tags)]
+        problems = cf_common.cache2.problem_cache.select(rating=rating,
+                                                         tags=tags,
+                                                         exclude_bits=solved,
+                                                         exclude_writers=[handle])
 
         if not problems:
             raise CodeforcesCogError('Problems not found within the search parameters')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max([random.randrange(len(problems)) for _ in range(2)])
         problem = problems[choice]
 
@@ -147,7 +140,7 @@ class Codeforces(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        submissions = [await cf.user.status(handle=handle) for handle in handles]
+        submissions = [await cf_common.cache2.submission_cache.get_submissions(handle) for handle in handles]
         submissions = [sub for subs in submissions for sub in subs]
         submissions = filt.filter_subs(submissions)
 
@@ -180,25 +173,20 @@ class Codeforces(commands.Cog):
 
         handles = handles or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
-        submissions = [sub for user in resp for sub in user]
-        solved = {sub.problem.name for sub in submissions}
         info = await cf.user.info(handles=handles)
         rating = int(round(sum(user.effective_rating for user in info) / len(handles), -2))
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if abs(prob.rating - rating) <= 100 and prob.name not in solved
-                    and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
-                    and not cf_common.is_nonstandard_problem(prob)]
-        if tags:
-            problems = [prob for prob in problems if prob.tag_matches(tags)]
+        solved = await cf_common.cache2.submission_cache.get_problem_bits(handles, 'attempted')
+        problems = cf_common.cache2.problem_cache.select(min_rating=rating - 100,
+                                                         max_rating=rating + 100,
+                                                         tags=tags,
+                                                         standard_only=True,
+                                                         exclude_bits=solved,
+                                                         exclude_writers=handles)
 
         if len(problems) < 4:
             await ctx.send('Problems not found within the search parameters')
             return
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choices = []
         for i in range(4):
             k = max(random.randrange(len(problems) - i) for _ in range(2))
@@ -225,27 +213,18 @@ class Codeforces(commands.Cog):
         handle, = await cf_common.resolve_handles(ctx, self.converter, ('!' + str(ctx.author),))
         user = cf_common.user_db.fetch_cf_user(handle)
         rating = round(user.effective_rating, -2)
-        submissions = await cf.user.status(handle=handle)
-        solved = {sub.problem.name for sub in submissions}
+        solved = await cf_common.cache2.submission_cache.get_problem_bits([handle], 'attempted')
         noguds = cf_common.user_db.get_noguds(ctx.message.author.id)
 
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if (prob.rating == rating + delta and
-                        prob.name not in solved and
-                        prob.name not in noguds)]
-
-        def check(problem):
-            return (not cf_common.is_nonstandard_problem(problem) and
-                    not cf_common.is_contest_writer(problem.contestId, handle))
-
-        problems = list(filter(check, problems))
+        problems = cf_common.cache2.problem_cache.select(rating=rating + delta,
+                                                         standard_only=True,
+                                                         exclude_bits=solved,
+                                                         exclude_names=noguds,
+                                                         exclude_writers=[handle])
         if not problems:
             await ctx.send('No problem to assign')
             return
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max(random.randrange(len(problems)) for _ in range(2))
         await self._gitgud(ctx, handle, problems[choice], delta)
 
@@ -285,7 +264,7 @@ class Codeforces(commands.Cog):
             await ctx.send(f'You do not have an active challenge')
             return
 
-        submissions = await cf.user.status(handle=handle)
+        submissions = await cf_common.cache2.submission_cache.get_submissions(handle)
         solved = {sub.problem.name for sub in submissions if sub.verdict == 'OK'}
 
         challenge_id, issue_time, name, contestId, index, delta = active
@@ -381,7 +360,7 @@ class Codeforces(commands.Cog):
 
         # subs_by_contest_id contains contest_id mapped to [list of problem.name]
         subs_by_contest_id = defaultdict(set)
-        for sub in await cf.user.status(handle=handle):
+        for sub in await cf_common.cache2.submission_cache.get_submissions(handle):
             if sub.verdict == 'OK':
                 try:
                     contest = cf_common.cache2.contest_cache.get_contest(sub.problem.contestId)
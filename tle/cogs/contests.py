@@ -8,7 +8,6 @@ from collections import defaultdict, namedtuple
 
 import discord
 from discord.ext import commands
-from matplotlib import pyplot as plt
 
 from tle.util import codeforces_common as cf_common
 from tle.util import cache_system2
@@ -102,6 +101,25 @@ def _get_ongoing_vc_participants():
         ongoing_vc_participants |= vc_participants
     return ongoing_vc_participants
 
+def _render_vc_rating(series, labels, ylim):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    # plot at least from mid gray to mid purple
+    for x, y in series:
+        ax.plot(x, y,
+                linestyle='-',
+                marker='o',
+                markersize=4,
+                markerfacecolor='white',
+                markeredgewidth=0.5)
+
+    gc.plot_rating_bg(ax, cf.RATED_RANKS)
+    fig.autofmt_xdate()
+    ax.set_ylim(*ylim)
+    ax.legend(labels, loc='upper left', prop=gc.fontprop)
+    return gc.figure_to_png(fig)
+
+
 class Contests(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -592,13 +610,14 @@ class Contests(commands.Cog):
             raise ContestCogError('No Rated VC channel')
         channel = self.bot.get_channel(int(channel_id))
         member_ids = cf_common.user_db.get_rated_vc_user_ids(vc_id)
-        handles = [cf_common.user_db.get_handle(member_id, channel.guild.id) for member_id in member_ids]
+        handle_by_member_id = cf_common.user_db.get_handles(member_ids, channel.guild.id)
+        handles = [handle_by_member_id.get(member_id) for member_id in member_ids]
         handle_to_member_id = {handle : member_id for handle, member_id in zip(handles, member_ids)}
         now = time.time()
         ranklist = await cf_common.cache2.ranklist_cache.generate_vc_ranklist(vc.contest_id, handle_to_member_id)
 
         async def has_running_subs(handle):
-            return [sub for sub in await cf.user.status(handle=handle)
+            return [sub for sub in await cf_common.cache2.submission_cache.get_submissions(handle)
                     if sub.verdict == 'TESTING' and
                        sub.problem.contestId == vc.contest_id and
                        sub.relativeTimeSeconds <= vc.finish_time - vc.start_time]
@@ -633,8 +652,9 @@ class Contests(commands.Cog):
         ongoing_rated_vcs = cf_common.user_db.get_ongoing_rated_vc_ids()
         if ongoing_rated_vcs is None:
             return
-        for rated_vc_id in ongoing_rated_vcs:
-            await self._watch_rated_vc(rated_vc_id)
+        with cf.request_lane(cf.LANE_REFRESH):
+            for rated_vc_id in ongoing_rated_vcs:
+                await self._watch_rated_vc(rated_vc_id)
 
     @commands.command(brief='Unregister this user from an ongoing ratedvc', usage='@user')
     @commands.has_any_role('Admin', 'Moderator')
@@ -720,30 +740,17 @@ class Contests(commands.Cog):
                 min_rating = min(min_rating, rating)
                 max_rating = max(max_rating, rating)
 
-        plt.clf()
-        # plot at least from mid gray to mid purple
-        for rating_data in plot_data.values():
-            x, y = zip(*rating_data)
-            plt.plot(x, y,
-                     linestyle='-',
-                     marker='o',
-                     markersize=4,
-                     markerfacecolor='white',
-                     markeredgewidth=0.5)
-
-        gc.plot_rating_bg(cf.RATED_RANKS)
-        plt.gcf().autofmt_xdate()
-
-        plt.ylim(min_rating - 100, max_rating + 200)
         labels = [
             gc.StrWrap('{} ({})'.format(
                 member_display_name,
                 rating_data[-1][1]))
             for member_display_name, rating_data in plot_data.items()
         ]
-        plt.legend(labels, loc='upper left', prop=gc.fontprop)
+        series = [tuple(zip(*rating_data)) for rating_data in plot_data.values()]
+        ylim = min_rating - 100, max_rating + 200
+        png = await gc.render(_render_vc_rating, series, labels, ylim, key=ctx.guild.id)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='VC rating graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
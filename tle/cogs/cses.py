@@ -24,9 +24,10 @@ class CSES(commands.Cog):
     @commands.Cog.listener()
     @discord_common.once
     async def on_ready(self):
-        self._cache_data.start()
+        # The leaderboards are only kept in memory.
+        self._cache_data.start(force_run=True)
 
-    @tasks.task_spec(name='ProblemsetCacheUpdate',
+    @tasks.task_spec(name='CSESCacheUpdate',
                      waiter=tasks.Waiter.fixed_delay(30*60))
     async def _cache_data(self, _):
         await self._reload()
@@ -6,7 +6,6 @@ import itertools
 
 from discord.ext import commands
 from collections import defaultdict, namedtuple
-from matplotlib import pyplot as plt
 
 from tle import constants
 from tle.util.db.user_db_conn import Duel, DuelType, Winner
@@ -48,6 +47,24 @@ def rating2rank(rating):
             return rank
 
 
+def _render_duel_rating(series, labels, xlim, ylim):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    for x, y in series:
+        ax.plot(x, y,
+                linestyle='-',
+                marker='o',
+                markersize=2,
+                markerfacecolor='white',
+                markeredgewidth=0.5)
+
+    gc.plot_rating_bg(ax, DUEL_RANKS)
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+    ax.legend(labels, loc='upper left', prop=gc.fontprop)
+    return gc.figure_to_png(fig)
+
+
 class DuelCogError(commands.CommandError):
     pass
 
@@ -65,11 +82,11 @@ def get_cf_user(userid, guild_id):
     return cf_common.user_db.fetch_cf_user(handle)
 
 
-def complete_duel(duelid, guild_id, win_status, winner, loser, finish_time, score, dtype):
+async def complete_duel(duelid, guild_id, win_status, winner, loser, finish_time, score, dtype):
     winner_r = cf_common.user_db.get_duel_rating(winner.id)
     loser_r = cf_common.user_db.get_duel_rating(loser.id)
     delta = round(elo_delta(winner_r, loser_r, score))
-    rc = cf_common.user_db.complete_duel(
+    rc = await cf_common.user_db.aio.complete_duel(
         duelid, win_status, finish_time, winner.id, loser.id, delta, dtype)
     if rc == 0:
         raise DuelCogError('Hey! No cheating!')
@@ -139,7 +156,6 @@ class Dueling(commands.Cog):
         userids = [challenger_id, challengee_id]
         handles = [cf_common.user_db.get_handle(
             userid, ctx.guild.id) for userid in userids]
-        submissions = [await cf.user.status(handle=handle) for handle in handles]
 
         if not cf_common.user_db.is_duelist(challenger_id):
             raise DuelCogError(
@@ -165,16 +181,16 @@ class Dueling(commands.Cog):
         unofficial = False # rating > suggested_rating
         dtype = DuelType.UNOFFICIAL if unofficial else DuelType.OFFICIAL
 
-        solved = {
-            sub.problem.name for subs in submissions for sub in subs if sub.verdict != 'COMPILATION_ERROR'}
+        solved = await cf_common.cache2.submission_cache.get_problem_bits(handles, 'compiled')
         seen = {name for userid in userids for name,
                 in cf_common.user_db.get_duel_problem_names(userid)}
 
         def get_problems(rating):
-            return [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating == rating and prob.name not in solved and prob.name not in seen
-                    and not any(cf_common.is_contest_writer(prob.contestId, handle) for handle in handles)
-                    and not cf_common.is_nonstandard_problem(prob)]
+            return cf_common.cache2.problem_cache.select(rating=rating,
+                                                         standard_only=True,
+                                                         exclude_bits=solved,
+                                                         exclude_names=seen,
+                                                         exclude_writers=handles)
 
         for problems in map(get_problems, range(rating, 400, -100)):
             if problems:
@@ -185,9 +201,6 @@ class Dueling(commands.Cog):
             raise DuelCogError(
                 f'No unsolved {rstr}problems left for {ctx.author.mention} vs {opponent.mention}.')
 
-        problems.sort(key=lambda problem: cf_common.cache2.contest_cache.get_contest(
-            problem.contestId).startTimeSeconds)
-
         choice = max(random.randrange(len(problems)) for _ in range(2))
         problem = problems[choice]
 
@@ -264,7 +277,7 @@ class Dueling(commands.Cog):
 
         async def get_solve_time(userid):
             handle = cf_common.user_db.get_handle(userid, ctx.guild.id)
-            subs = [sub for sub in await cf.user.status(handle=handle)
+            subs = [sub for sub in await cf_common.cache2.submission_cache.get_submissions(handle)
                     if (sub.verdict == 'OK' or sub.verdict == 'TESTING')
                     and sub.problem.contestId == contest_id
                     and sub.problem.index == index]
@@ -292,21 +305,21 @@ class Dueling(commands.Cog):
                 winner = challenger if challenger_time < challengee_time else challengee
                 loser = challenger if challenger_time > challengee_time else challengee
                 win_status = Winner.CHALLENGER if winner == challenger else Winner.CHALLENGEE
-                embed = complete_duel(duelid, ctx.guild.id, win_status, winner, loser, min(
+                embed = await complete_duel(duelid, ctx.guild.id, win_status, winner, loser, min(
                     challenger_time, challengee_time), 1, dtype)
                 await ctx.send(f'Both {challenger.mention} and {challengee.mention} solved it but {winner.mention} was {diff} faster!', embed=embed)
             else:
-                embed = complete_duel(duelid, ctx.guild.id, Winner.DRAW,
-                                      challenger, challengee, challenger_time, 0.5, dtype)
+                embed = await complete_duel(duelid, ctx.guild.id, Winner.DRAW,
+                                            challenger, challengee, challenger_time, 0.5, dtype)
                 await ctx.send(f"{challenger.mention} and {challengee.mention} solved the problem in the exact same amount of time! It's a draw!", embed=embed)
 
         elif challenger_time:
-            embed = complete_duel(duelid, ctx.guild.id, Winner.CHALLENGER,
-                                  challenger, challengee, challenger_time, 1, dtype)
+            embed = await complete_duel(duelid, ctx.guild.id, Winner.CHALLENGER,
+                                        challenger, challengee, challenger_time, 1, dtype)
             await ctx.send(f'{challenger.mention} beat {challengee.mention} in a duel!', embed=embed)
         elif challengee_time:
-            embed = complete_duel(duelid, ctx.guild.id, Winner.CHALLENGEE,
-                                  challengee, challenger, challengee_time, 1, dtype)
+            embed = await complete_duel(duelid, ctx.guild.id, Winner.CHALLENGEE,
+                                        challengee, challenger, challengee_time, 1, dtype)
             await ctx.send(f'{challengee.mention} beat {challenger.mention} in a duel!', embed=embed)
         else:
             await ctx.send('Nobody solved the problem yet.')
@@ -337,8 +350,8 @@ class Dueling(commands.Cog):
             return
 
         offerer = ctx.guild.get_member(self.draw_offers[duelid])
-        embed = complete_duel(duelid, ctx.guild.id, Winner.DRAW,
-                              offerer, ctx.author, now, 0.5, dtype)
+        embed = await complete_duel(duelid, ctx.guild.id, Winner.DRAW,
+                                    offerer, ctx.author, now, 0.5, dtype)
         await ctx.send(f'{ctx.author.mention} accepted draw offer by {offerer.mention}.', embed=embed)
 
     @duel.command(brief='Show duelist profile')
@@ -490,7 +503,9 @@ class Dueling(commands.Cog):
         """Show the list of duelists with their duel rating."""
         users = [(ctx.guild.get_member(user_id), rating)
                  for user_id, rating in cf_common.user_db.get_duelists()]
-        users = [(member, cf_common.user_db.get_handle(member.id, ctx.guild.id), rating)
+        handle_by_member_id = cf_common.user_db.get_handles(
+            [member.id for member, _ in users if member is not None], ctx.guild.id)
+        users = [(member, handle_by_member_id.get(member.id), rating)
                  for member, rating in users
                  if member is not None and cf_common.user_db.get_num_duel_completed(member.id) > 0]
 
@@ -588,7 +603,6 @@ class Dueling(commands.Cog):
         if time_tick == 0:
             raise DuelCogError(f'Nothing to plot.')
 
-        plt.clf()
         # plot at least from mid gray to mid purple
         min_rating = 1350
         max_rating = 1550
@@ -597,27 +611,18 @@ class Dueling(commands.Cog):
                 min_rating = min(min_rating, rating)
                 max_rating = max(max_rating, rating)
 
-            x, y = zip(*rating_data)
-            plt.plot(x, y,
-                     linestyle='-',
-                     marker='o',
-                     markersize=2,
-                     markerfacecolor='white',
-                     markeredgewidth=0.5)
-
-        gc.plot_rating_bg(DUEL_RANKS)
-        plt.xlim(0, time_tick - 1)
-        plt.ylim(min_rating - 100, max_rating + 100)
-
         labels = [
             gc.StrWrap('{} ({})'.format(
                 ctx.guild.get_member(duelist).display_name,
                 rating_data[-1][1]))
             for duelist, rating_data in plot_data.items()
         ]
-        plt.legend(labels, loc='upper left', prop=gc.fontprop)
+        series = [tuple(zip(*rating_data)) for rating_data in plot_data.values()]
+        xlim = 0, time_tick - 1
+        ylim = min_rating - 100, max_rating + 100
+        png = await gc.render(_render_duel_rating, series, labels, xlim, ylim, key=ctx.guild.id)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Duel rating graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -1,4 +1,3 @@
-import bisect
 import collections
 import datetime as dt
 import time
@@ -11,8 +10,8 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from discord.ext import commands
-from matplotlib import pyplot as plt
 from matplotlib import patches as patches
+from matplotlib import rcParams
 from matplotlib import lines as mlines
 from matplotlib import dates as mdates
 
@@ -26,6 +25,7 @@ pd.plotting.register_matplotlib_converters()
 
 # A user is considered active if the duration since his last contest is not more than this
 CONTEST_ACTIVE_TIME_CUTOFF = 90 * 24 * 60 * 60 # 90 days
+_DAY = 24 * 60 * 60
 
 
 class GraphCogError(commands.CommandError):
@@ -38,24 +38,26 @@ def nice_sub_type(types):
                 'PRACTICE':'Practice: {}'}
     return [nice_map[t] for t in types]
 
-def _plot_rating(resp, mark='o'):
+def _rating_series(resp):
+    """Returns (times, ratings) of every list of rating changes in `resp`, for plotting."""
+    return [([dt.datetime.fromtimestamp(change.ratingUpdateTimeSeconds) for change in changes],
+             [change.newRating for change in changes])
+            for changes in resp]
 
-    for rating_changes in resp:
-        ratings, times = [], []
-        for rating_change in rating_changes:
-            ratings.append(rating_change.newRating)
-            times.append(dt.datetime.fromtimestamp(rating_change.ratingUpdateTimeSeconds))
 
-        plt.plot(times,
-                 ratings,
-                 linestyle='-',
-                 marker=mark,
-                 markersize=3,
-                 markerfacecolor='white',
-                 markeredgewidth=0.5)
+def _plot_rating(ax, series, mark='o'):
+
+    for times, ratings in series:
+        ax.plot(times,
+                ratings,
+                linestyle='-',
+                marker=mark,
+                markersize=3,
+                markerfacecolor='white',
+                markeredgewidth=0.5)
 
-    gc.plot_rating_bg(cf.RATED_RANKS)
-    plt.gcf().autofmt_xdate()
+    gc.plot_rating_bg(ax, cf.RATED_RANKS)
+    ax.figure.autofmt_xdate()
 
 def _classify_submissions(submissions):
     solved_by_type = {sub_type: [] for sub_type in cf.Party.PARTICIPANT_TYPES}
@@ -64,11 +66,11 @@ def _classify_submissions(submissions):
     return solved_by_type
 
 
-def _plot_scatter(regular, practice, virtual, point_size):
+def _plot_scatter(ax, regular, practice, virtual, point_size):
     for contest in [practice, regular, virtual]:
         if contest:
             times, ratings = zip(*contest)
-            plt.scatter(times, ratings, zorder=10, s=point_size)
+            ax.scatter(times, ratings, zorder=10, s=point_size)
 
 
 def _running_mean(x, bin_size):
@@ -103,7 +105,7 @@ def _get_extremes(contest, problemset, submissions):
     return min_unsolved, max_solved
 
 
-def _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolved):
+def _classify_extremes(packed_contest_subs_problemset):
     extremes = [
         (dt.datetime.fromtimestamp(contest.end_time), _get_extremes(contest, problemset, subs))
         for contest, problemset, subs in packed_contest_subs_problemset
@@ -122,14 +124,20 @@ def _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolv
             # No rated problems in the contest, which means rating is not yet available for
             # problems in this contest. Skip this data point.
             pass
+    return regular, fullsolves, nosolves
+
 
+def _render_extreme(handle, rating, regular, fullsolves, nosolves, solved, unsolved):
     solvedcolor = 'tab:orange'
     unsolvedcolor = 'tab:blue'
     linecolor = '#00000022'
     outlinecolor = '#00000022'
 
+    fig = gc.new_figure()
+    ax = fig.subplots()
+
     def scatter_outline(*args, **kwargs):
-        plt.scatter(*args, **kwargs)
+        ax.scatter(*args, **kwargs)
         kwargs['zorder'] -= 1
         kwargs['color'] = outlinecolor
         if kwargs['marker'] == '*':
@@ -142,9 +150,8 @@ def _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolv
             del kwargs['alpha']
         if 'label' in kwargs:
             del kwargs['label']
-        plt.scatter(*args, **kwargs)
+        ax.scatter(*args, **kwargs)
 
-    plt.clf()
     time_scatter, plot_min, plot_max = zip(*regular)
     if unsolved:
         scatter_outline(time_scatter, plot_min, zorder=10,
@@ -155,7 +162,6 @@ def _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolv
                         s=14, marker='o', color=solvedcolor,
                         label='Hardest solved')
 
-    ax = plt.gca()
     if solved and unsolved:
         for t, mn, mx in regular:
             ax.add_line(mlines.Line2D((t, t), (mn, mx), color=linecolor))
@@ -169,13 +175,14 @@ def _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolv
                         s=32, marker='X',
                         color=unsolvedcolor)
 
-    plt.legend(title=f'{handle}: {rating}', title_fontsize=plt.rcParams['legend.fontsize'],
-               loc='upper left').set_zorder(20)
-    gc.plot_rating_bg(cf.RATED_RANKS)
-    plt.gcf().autofmt_xdate()
+    ax.legend(title=f'{handle}: {rating}', title_fontsize=rcParams['legend.fontsize'],
+              loc='upper left').set_zorder(20)
+    gc.plot_rating_bg(ax, cf.RATED_RANKS)
+    fig.autofmt_xdate()
+    return gc.figure_to_png(fig)
 
 
-def _plot_average(practice, bin_size, label: str = ''):
+def _plot_average(ax, practice, bin_size, label: str = ''):
     if len(practice) > bin_size:
         sub_times, ratings = map(list, zip(*practice))
 
@@ -184,13 +191,269 @@ def _plot_average(practice, bin_size, label: str = ''):
         mean_sub_times = [dt.datetime.fromtimestamp(timestamp) for timestamp in mean_sub_timestamps]
         mean_ratings = _running_mean(ratings, bin_size)
 
-        plt.plot(mean_sub_times,
-                 mean_ratings,
-                 linestyle='-',
-                 marker='',
-                 markerfacecolor='white',
-                 markeredgewidth=0.5,
-                 label=label)
+        ax.plot(mean_sub_times,
+                mean_ratings,
+                linestyle='-',
+                marker='',
+                markerfacecolor='white',
+                markeredgewidth=0.5,
+                label=label)
+
+
+def _rotate_xticklabels(ax, rotation, **kwargs):
+    for label in ax.get_xticklabels():
+        label.set(rotation=rotation, **kwargs)
+
+
+# Render functions run in the worker processes of the render queue, they take plain data and
+# return the plot as PNG bytes.
+
+def _render_rating(series, labels, ylim):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.set_prop_cycle(gc.rating_color_cycler)
+    _plot_rating(ax, series)
+    ax.legend(labels, loc='upper left')
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    return gc.figure_to_png(fig)
+
+
+def _render_solved(all_ratings, labels, hist_bins, legend_title):
+    """Plots stacked by type with a titled legend if `legend_title` is given, otherwise side by
+    side with one label per histogram."""
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.set_xlabel('Problem rating')
+    ax.set_ylabel('Number solved')
+    if legend_title is not None:
+        ax.hist(all_ratings, stacked=True, bins=hist_bins, label=labels)
+        ax.legend(title=legend_title, title_fontsize=rcParams['legend.fontsize'],
+                  loc='upper right')
+    else:
+        ax.hist(all_ratings, bins=hist_bins)
+        ax.legend(labels, loc='upper right')
+    return gc.figure_to_png(fig)
+
+
+def _render_hist(all_times, labels, hist_range, bins, legend_title):
+    """Like `_render_solved`, over time."""
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Number solved')
+    if legend_title is not None:
+        ax.hist(all_times, stacked=True, label=labels, range=hist_range, bins=bins)
+        ax.legend(title=legend_title, title_fontsize=rcParams['legend.fontsize'])
+    else:
+        ax.hist(all_times, range=hist_range, bins=bins)
+        ax.legend(labels)
+
+    # NOTE: In case of nested list, matplotlib decides type using 1st sublist,
+    # it assumes float when 1st sublist is empty.
+    # Hence explicitly assigning locator and formatter is must here.
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
+
+    fig.autofmt_xdate()
+    return gc.figure_to_png(fig)
+
+
+def _render_curve(series, labels):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.set_xlabel('Time')
+    ax.set_ylabel('Cumulative solve count')
+    for times, counts in series:
+        ax.plot(times, counts)
+    ax.legend(labels)
+    fig.autofmt_xdate()
+    return gc.figure_to_png(fig)
+
+
+def _render_scatter(regular, practice, virtual, point_size, bin_size, rating_series, rlo, rhi):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    _plot_scatter(ax, regular, practice, virtual, point_size)
+    labels = []
+    if practice:
+        labels.append('Practice')
+    if regular:
+        labels.append('Regular')
+    if virtual:
+        labels.append('Virtual')
+    ax.legend(labels, loc='upper left')
+    _plot_average(ax, practice, bin_size)
+    _plot_rating(ax, rating_series, mark='')
+
+    # zoom
+    ymin, ymax = ax.get_ylim()
+    ax.set_ylim(max(ymin, rlo - 100), min(ymax, rhi + 100))
+    return gc.figure_to_png(fig)
+
+
+def _render_rating_hist(x, height, colors, label, xlim, binsize, mode):
+    fig = gc.new_figure(figsize=(15, 5))
+    ax = fig.subplots()
+    ax.set_xlim(*xlim)
+    ax.bar(x, height, binsize*0.9, color=colors, linewidth=0, tick_label=label, log=(mode == 'log'))
+    _rotate_xticklabels(ax, 45)
+    ax.set_xlabel('Rating')
+    ax.set_ylabel('Number of users')
+    return gc.figure_to_png(fig)
+
+
+def _render_centile(ratings, users_to_mark, zoom):
+    intervals = [(rank.low, rank.high) for rank in cf.RATED_RANKS]
+    colors = [rank.color_graph for rank in cf.RATED_RANKS]
+    n = len(ratings)
+    perc = 100*np.arange(n)/n
+
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.plot(ratings, perc, color='#00000099')
+
+    ax.set_xlabel('Rating')
+    ax.set_ylabel('Percentile')
+
+    for pos in ['right','top','bottom','left']:
+        ax.spines[pos].set_visible(False)
+    ax.tick_params(axis='both', which='both',length=0)
+
+    # Color intervals by rank
+    for interval,color in zip(intervals,colors):
+        alpha = '99'
+        l,r = interval
+        col = color + alpha
+        rect = patches.Rectangle((l,-50), r-l, 200,
+                                 edgecolor='none',
+                                 facecolor=col)
+        ax.add_patch(rect)
+
+    # Mark users in plot
+    for user,point in users_to_mark.items():
+        x,y = point
+        ax.annotate(user,
+                    xy=point,
+                    xytext=(0, 0),
+                    textcoords='offset points',
+                    ha='right',
+                    va='bottom')
+        ax.plot(*point,
+                marker='o',
+                markersize=5,
+                color='red',
+                markeredgecolor='darkred')
+
+    # Set limits (before drawing tick lines)
+    if users_to_mark and zoom:
+        xmargin = 50
+        ymargin = 5
+        xmin = min(point[0] for point in users_to_mark.values())
+        xmax = max(point[0] for point in users_to_mark.values())
+        ymin = min(point[1] for point in users_to_mark.values())
+        ymax = max(point[1] for point in users_to_mark.values())
+        ax.set_xlim(xmin - xmargin, xmax + xmargin)
+        ax.set_ylim(ymin - ymargin, ymax + ymargin)
+    else:
+        ax.set_xlim(ratings[0], ratings[-1])
+        ax.set_ylim(-1.5, 101.5)
+
+    # Draw tick lines
+    linecolor = '#00000022'
+    inf = 10000
+    def horz_line(y):
+        l = mlines.Line2D([-inf,inf], [y,y], color=linecolor)
+        ax.add_line(l)
+    def vert_line(x):
+        l = mlines.Line2D([x,x], [-inf,inf], color=linecolor)
+        ax.add_line(l)
+    for y in ax.get_yticks():
+        horz_line(y)
+    for x in ax.get_xticks():
+        vert_line(x)
+    return gc.figure_to_png(fig)
+
+
+def _render_howgud(deltas, labels, hist_bins):
+    fig = gc.new_figure()
+    ax = fig.subplots()
+    ax.margins(x=0)
+    ax.hist(deltas, bins=hist_bins, rwidth=1)
+    ax.set_xlabel('Problem delta')
+    ax.set_ylabel('Number solved')
+    ax.legend(labels, prop=gc.fontprop)
+    return gc.figure_to_png(fig)
+
+
+def _render_country_counts(countries, counts):
+    fig = gc.new_figure(figsize=(15, 5))
+    with sns.axes_style(rc={'xtick.bottom': True}):
+        ax = fig.subplots()
+    sns.barplot(x=countries, y=counts, ax=ax)
+
+    # Show counts on top of bars.
+    for p in ax.patches:
+        x = p.get_x() + p.get_width() / 2
+        y = p.get_y() + p.get_height() + 0.5
+        ax.text(x, y, int(p.get_height()), horizontalalignment='center', color='#30304f',
+                fontsize='x-small')
+
+    _rotate_xticklabels(ax, 40, horizontalalignment='right')
+    ax.tick_params(axis='x', length=4, color=ax.spines['bottom'].get_edgecolor())
+    ax.set_xlabel('Country')
+    ax.set_ylabel('Number of members')
+    return gc.figure_to_png(fig)
+
+
+def _render_country_ratings(data, column_order, color_map):
+    df = pd.DataFrame(data, columns=['Country', 'Rating'])
+    fig = gc.new_figure()
+    if len(column_order) <= 5:
+        ax = fig.subplots()
+        sns.swarmplot(x='Country', y='Rating', hue='Rating', data=df, order=column_order,
+                      palette=color_map, ax=ax)
+    else:
+        # Add ticks and rotate tick labels to avoid overlap.
+        with sns.axes_style(rc={'xtick.bottom': True}):
+            ax = fig.subplots()
+        sns.swarmplot(x='Country', y='Rating', hue='Rating', data=df,
+                      order=column_order, palette=color_map, ax=ax)
+        _rotate_xticklabels(ax, 30, horizontalalignment='right')
+        ax.tick_params(axis='x', color=ax.spines['bottom'].get_edgecolor())
+    if ax.get_legend() is not None:
+        ax.get_legend().remove()
+    ax.set_xlabel('Country')
+    ax.set_ylabel('Rating')
+    return gc.figure_to_png(fig)
+
+
+def _render_visualrank(title, ranks, delta, color, users_to_mark, xlim, ylim):
+    fig = gc.new_figure(figsize=(12, 8))
+    ax = fig.subplots()
+    ax.set_title(title)
+    ax.set_xlabel('Rank')
+    ax.set_ylabel('Rating Changes')
+
+    mark_size = 2e4 / len(ranks)
+    ax.set_xlim(*xlim)
+    ax.set_ylim(*ylim)
+    ax.scatter(ranks, delta, s=mark_size, c=color)
+
+    for handle, point in users_to_mark.items():
+        ax.annotate(handle,
+                    xy=point,
+                    xytext=(0, 0),
+                    textcoords='offset points',
+                    ha='left',
+                    va='bottom',
+                    fontsize='large')
+        ax.plot(*point,
+                marker='o',
+                markersize=5,
+                color='black')
+    return gc.figure_to_png(fig)
 
 
 class Graphs(commands.Cog):
@@ -241,13 +504,10 @@ class Graphs(commands.Cog):
         if peak:
             resp = [max_prefix(user) for user in resp]
 
-        plt.clf()
-        plt.axes().set_prop_cycle(gc.rating_color_cycler)
-        _plot_rating(resp)
         current_ratings = [rating_changes[-1].newRating if rating_changes else 'Unrated' for rating_changes in resp]
         labels = [gc.StrWrap(f'{handle} ({rating})') for handle, rating in zip(handles, current_ratings)]
-        plt.legend(labels, loc='upper left')
 
+        ylim = None
         if not zoom:
             min_rating = 1100
             max_rating = 1800
@@ -255,9 +515,11 @@ class Graphs(commands.Cog):
                 for rating in rating_changes:
                     min_rating = min(min_rating, rating.newRating)
                     max_rating = max(max_rating, rating.newRating)
-            plt.ylim(min_rating - 100, max_rating + 200)
+            ylim = min_rating - 100, max_rating + 200
 
-        discord_file = gc.get_current_figure_as_file()
+        png = await gc.render(_render_rating, _rating_series(resp), labels, ylim,
+                              key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Rating graph on Codeforces')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -281,7 +543,7 @@ class Graphs(commands.Cog):
 
         contest_ids = [change.contestId for change in ratingchanges]
         subs_by_contest_id = {contest_id: [] for contest_id in contest_ids}
-        for sub in await cf.user.status(handle=handle):
+        for sub in await cf_common.cache2.submission_cache.get_submissions(handle):
             if sub.contestId in subs_by_contest_id:
                 subs_by_contest_id[sub.contestId].append(sub)
 
@@ -293,9 +555,11 @@ class Graphs(commands.Cog):
         ]
 
         rating = max(ratingchanges, key=lambda change: change.ratingUpdateTimeSeconds).newRating
-        _plot_extreme(handle, rating, packed_contest_subs_problemset, solved, unsolved)
+        regular, fullsolves, nosolves = _classify_extremes(packed_contest_subs_problemset)
+        png = await gc.render(_render_extreme, handle, rating, regular, fullsolves, nosolves,
+                              solved, unsolved, key=ctx.guild.id)
 
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Codeforces extremes graph')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -310,15 +574,12 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        resp = [await cf_common.cache2.submission_cache.get_submissions(handle) for handle in handles]
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
             raise GraphCogError(f'There are no problems within the specified parameters.')
 
-        plt.clf()
-        plt.xlabel('Problem rating')
-        plt.ylabel('Number solved')
         if len(handles) == 1:
             # Display solved problem separately by type for a single user.
             handle, solved_by_type = handles[0], _classify_submissions(all_solved_subs[0])
@@ -331,10 +592,8 @@ class Graphs(commands.Cog):
             step = 100
             # shift the range to center the text
             hist_bins = list(range(filt.rlo - step // 2, filt.rhi + step // 2 + 1, step))
-            plt.hist(all_ratings, stacked=True, bins=hist_bins, label=labels)
             total = sum(map(len, all_ratings))
-            plt.legend(title=f'{handle}: {total}', title_fontsize=plt.rcParams['legend.fontsize'],
-                       loc='upper right')
+            legend_title = f'{handle}: {total}'
 
         else:
             all_ratings = [[sub.problem.rating for sub in solved_subs]
@@ -344,10 +603,11 @@ class Graphs(commands.Cog):
 
             step = 200 if filt.rhi - filt.rlo > 3000 // len(handles) else 100
             hist_bins = list(range(filt.rlo - step // 2, filt.rhi + step // 2 + 1, step))
-            plt.hist(all_ratings, bins=hist_bins)
-            plt.legend(labels, loc='upper right')
+            legend_title = None
 
-        discord_file = gc.get_current_figure_as_file()
+        png = await gc.render(_render_solved, all_ratings, labels, hist_bins, legend_title,
+                              key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Histogram of problems solved on Codeforces')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -373,15 +633,12 @@ class Graphs(commands.Cog):
 
         handles = handles or ['!' + str(ctx.author)]
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        resp = [await cf_common.cache2.submission_cache.get_submissions(handle) for handle in handles]
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
             raise GraphCogError(f'There are no problems within the specified parameters.')
 
-        plt.clf()
-        plt.xlabel('Time')
-        plt.ylabel('Number solved')
         if len(handles) == 1:
             handle, solved_by_type = handles[0], _classify_submissions(all_solved_subs[0])
             all_times = [[dt.datetime.fromtimestamp(sub.creationTimeSeconds) for sub in solved_by_type[sub_type]]
@@ -393,15 +650,10 @@ class Graphs(commands.Cog):
             dlo = min(itertools.chain.from_iterable(all_times)).date()
             dhi = min(dt.datetime.today() + dt.timedelta(days=1), dt.datetime.fromtimestamp(filt.dhi)).date()
             phase_cnt = math.ceil((dhi - dlo) / phase_time)
-            plt.hist(
-                all_times,
-                stacked=True,
-                label=labels,
-                range=(dhi - phase_cnt * phase_time, dhi),
-                bins=min(40, phase_cnt))
+            bins = min(40, phase_cnt)
 
             total = sum(map(len, all_times))
-            plt.legend(title=f'{handle}: {total}', title_fontsize=plt.rcParams['legend.fontsize'])
+            legend_title = f'{handle}: {total}'
         else:
             all_times = [[dt.datetime.fromtimestamp(sub.creationTimeSeconds) for sub in solved_subs]
                          for solved_subs in all_solved_subs]
@@ -415,21 +667,13 @@ class Graphs(commands.Cog):
             dlo = min(itertools.chain.from_iterable(all_times)).date()
             dhi = min(dt.datetime.today() + dt.timedelta(days=1), dt.datetime.fromtimestamp(filt.dhi)).date()
             phase_cnt = math.ceil((dhi - dlo) / phase_time)
-            plt.hist(
-                all_times,
-                range=(dhi - phase_cnt * phase_time, dhi),
-                bins=min(40 // len(handles), phase_cnt))
-            plt.legend(labels)
-
-        # NOTE: In case of nested list, matplotlib decides type using 1st sublist,
-        # it assumes float when 1st sublist is empty.
-        # Hence explicitly assigning locator and formatter is must here.
-        locator = mdates.AutoDateLocator()
-        plt.gca().xaxis.set_major_locator(locator)
-        plt.gca().xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
-
-        plt.gcf().autofmt_xdate()
-        discord_file = gc.get_current_figure_as_file()
+            bins = min(40 // len(handles), phase_cnt)
+            legend_title = None
+
+        hist_range = dhi - phase_cnt * phase_time, dhi
+        png = await gc.render(_render_hist, all_times, labels, hist_range, bins, legend_title,
+                              key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Histogram of number of solved problems over time')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -443,30 +687,25 @@ class Graphs(commands.Cog):
         args = filt.parse(args)
         handles = args or ('!' + str(ctx.author),)
         handles = await cf_common.resolve_handles(ctx, self.converter, handles)
-        resp = [await cf.user.status(handle=handle) for handle in handles]
+        resp = [await cf_common.cache2.submission_cache.get_submissions(handle) for handle in handles]
         all_solved_subs = [filt.filter_subs(submissions) for submissions in resp]
 
         if not any(all_solved_subs):
             raise GraphCogError(f'There are no problems within the specified parameters.')
 
-        plt.clf()
-        plt.xlabel('Time')
-        plt.ylabel('Cumulative solve count')
-
         all_times = [[dt.datetime.fromtimestamp(sub.creationTimeSeconds) for sub in solved_subs]
                      for solved_subs in all_solved_subs]
+        series = []
         for times in all_times:
             cumulative_solve_count = list(range(1, len(times)+1)) + [len(times)]
             timestretched = times + [min(dt.datetime.now(), dt.datetime.fromtimestamp(filt.dhi))]
-            plt.plot(timestretched, cumulative_solve_count)
+            series.append((timestretched, cumulative_solve_count))
 
         labels = [gc.StrWrap(f'{handle}: {len(times)}')
                   for handle, times in zip(handles, all_times)]
 
-        plt.legend(labels)
-
-        plt.gcf().autofmt_xdate()
-        discord_file = gc.get_current_figure_as_file()
+        png = await gc.render(_render_curve, series, labels, key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Curve of number of solved problems over time')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -497,7 +736,7 @@ class Graphs(commands.Cog):
         handle, = await cf_common.resolve_handles(ctx, self.converter, (handle,))
         rating_resp = [await cf.user.rating(handle=handle)]
         rating_resp = [filt.filter_rating_changes(rating_changes) for rating_changes in rating_resp]
-        submissions = filt.filter_subs(await cf.user.status(handle=handle))
+        submissions = filt.filter_subs(await cf_common.cache2.submission_cache.get_submissions(handle))
 
         def extract_time_and_rating(submissions):
             return [(dt.datetime.fromtimestamp(sub.creationTimeSeconds), sub.problem.rating)
@@ -512,30 +751,15 @@ class Graphs(commands.Cog):
         practice = extract_time_and_rating(solved_by_type['PRACTICE'])
         virtual = extract_time_and_rating(solved_by_type['VIRTUAL'])
 
-        plt.clf()
-        _plot_scatter(regular, practice, virtual, point_size)
-        labels = []
-        if practice:
-            labels.append('Practice')
-        if regular:
-            labels.append('Regular')
-        if virtual:
-            labels.append('Virtual')
-        plt.legend(labels, loc='upper left')
-        _plot_average(practice, bin_size)
-        _plot_rating(rating_resp, mark='')
-
-        # zoom
-        ymin, ymax = plt.gca().get_ylim()
-        plt.ylim(max(ymin, filt.rlo - 100), min(ymax, filt.rhi + 100))
-
-        discord_file = gc.get_current_figure_as_file()
+        png = await gc.render(_render_scatter, regular, practice, virtual, point_size, bin_size,
+                              _rating_series(rating_resp), filt.rlo, filt.rhi, key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title=f'Rating vs solved problem rating for {handle}')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
         await ctx.send(embed=embed, file=discord_file)
 
-    async def _rating_hist(self, ctx, ratings, mode, binsize, title):
+    async def _rating_hist(self, ctx, ratings, mode, binsize, title, *, cache_key=None):
         if mode not in ('log', 'normal'):
             raise GraphCogError('Mode should be either `log` or `normal`')
 
@@ -575,17 +799,10 @@ class Graphs(commands.Cog):
         colors = colors[l:r+1]
         height = height[l:r+1]
 
-        plt.clf()
-        fig = plt.figure(figsize=(15, 5))
-
-        plt.xticks(rotation=45)
-        plt.xlim(l * binsize - binsize//2, r * binsize + binsize//2)
-        plt.bar(x, height, binsize*0.9, color=colors, linewidth=0, tick_label=label, log=(mode == 'log'))
-        plt.xlabel('Rating')
-        plt.ylabel('Number of users')
-
-        discord_file = gc.get_current_figure_as_file()
-        plt.close(fig)
+        xlim = l * binsize - binsize//2, r * binsize + binsize//2
+        png = await gc.render(_render_rating_hist, x, height, colors, label, xlim, binsize, mode,
+                              key=ctx.guild.id, cache_key=cache_key)
+        discord_file = gc.get_png_as_file(png)
 
         embed = discord_common.cf_color_embed(title=title)
         discord_common.attach_image(embed, discord_file)
@@ -602,11 +819,13 @@ class Graphs(commands.Cog):
         res = cf_common.user_db.get_cf_users_for_guild(ctx.guild.id)
         ratings = [cf_user.rating for user_id, cf_user in res
                    if cf_user.rating is not None and not in_purgatory(user_id)]
+        # Roles are not versioned, so the ratings themselves are the key.
         await self._rating_hist(ctx,
                                 ratings,
                                 'normal',
                                 binsize=100,
-                                title='Rating distribution of server members')
+                                title='Rating distribution of server members',
+                                cache_key=tuple(sorted(ratings)))
 
     @plot.command(brief='Show Codeforces rating distribution', usage='[normal/log] [active/all] [contest_cutoff=5]')
     async def cfdistrib(self, ctx, mode: str = 'log', activity = 'active', contest_cutoff: int = 5):
@@ -618,30 +837,28 @@ class Graphs(commands.Cog):
             raise GraphCogError('Activity should be either `active` or `all`')
 
         time_cutoff = int(time.time()) - CONTEST_ACTIVE_TIME_CUTOFF if activity == 'active' else 0
-        handles = cf_common.cache2.rating_changes_cache.get_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
-        if not handles:
+        cache = cf_common.cache2.rating_changes_cache
+        ratings = cache.get_ratings_of_users_with_more_than_n_contests(time_cutoff, contest_cutoff)
+        if not len(ratings):
             raise GraphCogError('No Codeforces users meet the specified criteria')
 
-        ratings = [cf_common.cache2.rating_changes_cache.get_current_rating(handle) for handle in handles]
+        ratings = ratings.tolist()
         title = f'Rating distribution of {activity} Codeforces users ({mode} scale)'
+        # Active users also change as days pass without contests.
+        cache_key = mode, contest_cutoff, time_cutoff // _DAY, cache.version
         await self._rating_hist(ctx,
                                 ratings,
                                 mode,
                                 binsize=100,
-                                title=title)
+                                title=title,
+                                cache_key=cache_key)
 
     @plot.command(brief='Show percentile distribution on codeforces', usage='[+zoom] [+nomarker] [handles...]')
     async def centile(self, ctx, *args: str):
         """Show percentile distribution of codeforces and mark given handles in the plot. If +zoom and handles are given, it zooms to the neighborhood of the handles."""
         (zoom, nomarker), args = cf_common.filter_flags(args, ['+zoom', '+nomarker'])
-        # Prepare data
-        intervals = [(rank.low, rank.high) for rank in cf.RATED_RANKS]
-        colors = [rank.color_graph for rank in cf.RATED_RANKS]
-
-        ratings = cf_common.cache2.rating_changes_cache.get_all_ratings()
-        ratings = np.array(sorted(ratings))
-        n = len(ratings)
-        perc = 100*np.arange(n)/n
+        cache = cf_common.cache2.rating_changes_cache
+        ratings = cache.get_all_ratings()
 
         users_to_mark = {}
         if not nomarker:
@@ -656,77 +873,15 @@ class Graphs(commands.Cog):
             for info in infos:
                 if info.rating is None:
                     raise GraphCogError(f'User `{info.handle}` is not rated')
-                ix = bisect.bisect_left(ratings, info.rating)
-                cent = 100*ix/len(ratings)
+                cent = cache.get_rating_percentile(info.rating)
                 users_to_mark[info.handle] = info.rating,cent
 
-        # Plot
-        plt.clf()
-        fig,ax = plt.subplots(1)
-        ax.plot(ratings, perc, color='#00000099')
-
-        plt.xlabel('Rating')
-        plt.ylabel('Percentile')
-
-        for pos in ['right','top','bottom','left']:
-            ax.spines[pos].set_visible(False)
-        ax.tick_params(axis='both', which='both',length=0)
-
-        # Color intervals by rank
-        for interval,color in zip(intervals,colors):
-            alpha = '99'
-            l,r = interval
-            col = color + alpha
-            rect = patches.Rectangle((l,-50), r-l, 200,
-                                     edgecolor='none',
-                                     facecolor=col)
-            ax.add_patch(rect)
-
-        # Mark users in plot
-        for user,point in users_to_mark.items():
-            x,y = point
-            plt.annotate(user,
-                         xy=point,
-                         xytext=(0, 0),
-                         textcoords='offset points',
-                         ha='right',
-                         va='bottom')
-            plt.plot(*point,
-                     marker='o',
-                     markersize=5,
-                     color='red',
-                     markeredgecolor='darkred')
-
-        # Set limits (before drawing tick lines)
-        if users_to_mark and zoom:
-            xmargin = 50
-            ymargin = 5
-            xmin = min(point[0] for point in users_to_mark.values())
-            xmax = max(point[0] for point in users_to_mark.values())
-            ymin = min(point[1] for point in users_to_mark.values())
-            ymax = max(point[1] for point in users_to_mark.values())
-            plt.xlim(xmin - xmargin, xmax + xmargin)
-            plt.ylim(ymin - ymargin, ymax + ymargin)
-        else:
-            plt.xlim(ratings[0], ratings[-1])
-            plt.ylim(-1.5, 101.5)
-
-        # Draw tick lines
-        linecolor = '#00000022'
-        inf = 10000
-        def horz_line(y):
-            l = mlines.Line2D([-inf,inf], [y,y], color=linecolor)
-            ax.add_line(l)
-        def vert_line(x):
-            l = mlines.Line2D([x,x], [-inf,inf], color=linecolor)
-            ax.add_line(l)
-        for y in ax.get_yticks():
-            horz_line(y)
-        for x in ax.get_xticks():
-            vert_line(x)
+        cache_key = cache.version if nomarker else None
+        png = await gc.render(_render_centile, ratings, users_to_mark, zoom, key=ctx.guild.id,
+                              cache_key=cache_key)
 
         # Discord stuff
-        discord_file = gc.get_current_figure_as_file()
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title=f'Rating/percentile relationship')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -744,14 +899,8 @@ class Graphs(commands.Cog):
         labels = [gc.StrWrap(f'{member.display_name}: {len(delta)}')
                   for member, delta in zip(members, deltas)]
 
-        plt.clf()
-        plt.margins(x=0)
-        plt.hist(deltas, bins=hist_bins, rwidth=1)
-        plt.xlabel('Problem delta')
-        plt.ylabel('Number solved')
-        plt.legend(labels, prop=gc.fontprop)
-
-        discord_file = gc.get_current_figure_as_file()
+        png = await gc.render(_render_howgud, deltas, labels, hist_bins, key=ctx.guild.id)
+        discord_file = gc.get_png_as_file(png)
         embed = discord_common.cf_color_embed(title='Histogram of gudgitting')
         discord_common.attach_image(embed, discord_file)
         discord_common.set_author_footer(embed, ctx.author)
@@ -774,25 +923,8 @@ class Graphs(commands.Cog):
         if not countries:
             # list because seaborn complains for tuple.
             countries, counts = map(list, zip(*counter.most_common()))
-            plt.clf()
-            fig = plt.figure(figsize=(15, 5))
-            with sns.axes_style(rc={'xtick.bottom': True}):
-                sns.barplot(x=countries, y=counts)
-
-            # Show counts on top of bars.
-            ax = plt.gca()
-            for p in ax.patches:
-                x = p.get_x() + p.get_width() / 2
-                y = p.get_y() + p.get_height() + 0.5
-                ax.text(x, y, int(p.get_height()), horizontalalignment='center', color='#30304f',
-                        fontsize='x-small')
-
-            plt.xticks(rotation=40, horizontalalignment='right')
-            ax.tick_params(axis='x', length=4, color=ax.spines['bottom'].get_edgecolor())
-            plt.xlabel('Country')
-            plt.ylabel('Number of members')
-            discord_file = gc.get_current_figure_as_file()
-            plt.close(fig)
+            png = await gc.render(_render_country_counts, countries, counts, key=ctx.guild.id)
+            discord_file = gc.get_png_as_file(png)
             embed = discord_common.cf_color_embed(title='Distribution of server members by country')
         else:
             countries = [country.title() for country in countries]
@@ -802,25 +934,11 @@ class Graphs(commands.Cog):
                 raise GraphCogError('No rated members from the specified countries are present.')
 
             color_map = {rating: f'#{cf.rating2rank(rating).color_embed:06x}' for _, rating in data}
-            df = pd.DataFrame(data, columns=['Country', 'Rating'])
             column_order = sorted((country for country in countries if counter[country]),
                                   key=counter.get, reverse=True)
-            plt.clf()
-            if len(column_order) <= 5:
-                sns.swarmplot(x='Country', y='Rating', hue='Rating', data=df, order=column_order,
-                              palette=color_map)
-            else:
-                # Add ticks and rotate tick labels to avoid overlap.
-                with sns.axes_style(rc={'xtick.bottom': True}):
-                    sns.swarmplot(x='Country', y='Rating', hue='Rating', data=df,
-                                  order=column_order, palette=color_map)
-                plt.xticks(rotation=30, horizontalalignment='right')
-                ax = plt.gca()
-                ax.tick_params(axis='x', color=ax.spines['bottom'].get_edgecolor())
-            plt.legend().remove()
-            plt.xlabel('Country')
-            plt.ylabel('Rating')
-            discord_file = gc.get_current_figure_as_file()
+            png = await gc.render(_render_country_ratings, data, column_order, color_map,
+                                  key=ctx.guild.id)
+            discord_file = gc.get_png_as_file(png)
             embed = discord_common.cf_color_embed(title='Rating distribution of server members by '
                                                         'country')
 
@@ -886,32 +1004,14 @@ class Graphs(commands.Cog):
 
         title = rating_changes[0].contestName
 
-        plt.clf()
-        fig = plt.figure(figsize=(12, 8))
-        plt.title(title)
-        plt.xlabel('Rank')
-        plt.ylabel('Rating Changes')
-
-        mark_size = 2e4 / len(ranks)
-        plt.xlim(xmin - xmargin, xmax + xmargin)
-        plt.ylim(ymin - ymargin, ymax + ymargin)
-        plt.scatter(ranks, delta, s=mark_size, c=color)
-
-        for handle, point in users_to_mark.items():
-            plt.annotate(handle,
-                         xy=point,
-                         xytext=(0, 0),
-                         textcoords='offset points',
-                         ha='left',
-                         va='bottom',
-                         fontsize='large')
-            plt.plot(*point,
-                     marker='o',
-                     markersize=5,
-                     color='black')
-
-        discord_file = gc.get_current_figure_as_file()
-        plt.close(fig)
+        xlim = xmin - xmargin, xmax + xmargin
+        ylim = ymin - ymargin, ymax + ymargin
+        cache_key = (contest_id, zoom, sorted(handles), cf_common.cache2.rating_changes_cache.version)
+        if in_server:
+            cache_key += (ctx.guild.id, cf_common.user_db.version)
+        png = await gc.render(_render_visualrank, title, ranks, delta, color, users_to_mark, xlim,
+                              ylim, key=ctx.guild.id, cache_key=cache_key)
+        discord_file = gc.get_png_as_file(png)
 
         embed = discord_common.cf_color_embed(title=title)
         discord_common.attach_image(embed, discord_file)
@@ -1,6 +1,7 @@
 import io
 import asyncio
 import contextlib
+import functools
 import logging
 import math
 import html
@@ -21,6 +22,7 @@ from tle.util import codeforces_api as cf
 from tle.util import codeforces_common as cf_common
 from tle.util import discord_common
 from tle.util import events
+from tle.util import graph_common as gc
 from tle.util import paginator
 from tle.util import table
 from tle.util import tasks
@@ -36,12 +38,25 @@ _PRETTY_HANDLES_PER_PAGE = 10
 _TOP_DELTAS_COUNT = 10
 _MAX_RATING_CHANGES_PER_EMBED = 15
 _UPDATE_HANDLE_STATUS_INTERVAL = 6 * 60 * 60  # 6 hours
+_MAX_CONCURRENT_ROLE_EDITS = 4  # per guild
+
+# Discord rate limits role edits per guild, so edits are bounded by a semaphore per guild.
+_role_edit_semaphore_by_guild = {}
 
 
 class HandleCogError(commands.CommandError):
     pass
 
 
+def _role_edit_semaphore(guild_id):
+    try:
+        return _role_edit_semaphore_by_guild[guild_id]
+    except KeyError:
+        semaphore = _role_edit_semaphore_by_guild[guild_id] = asyncio.Semaphore(
+            _MAX_CONCURRENT_ROLE_EDITS)
+        return semaphore
+
+
 def rating_to_color(rating):
     """returns (r, g, b) pixels values corresponding to rating"""
     # TODO: Integrate these colors with the ranks in codeforces_api.py
@@ -163,8 +178,25 @@ def get_gudgitters_image(rankings):
     return discord_file
 """
 
-def get_prettyhandles_image(rows, font):
-    """return PIL image for rankings"""
+@functools.lru_cache(maxsize=None)
+def _get_prettyhandles_font():
+    """Loads the font for ;handle pretty once per process."""
+    return ImageFont.truetype(constants.NOTO_SANS_CJK_BOLD_FONT_PATH, size=26)
+
+
+@functools.lru_cache(maxsize=4096)
+def _trim_to_width(text, width):
+    """Trims text to fit in the given width in pixels, measuring with the font for
+    ;handle pretty. Names repeat across pages and requests, so results are memoized."""
+    font = _get_prettyhandles_font()
+    while font.getsize(text)[0] > width:
+        text = text[:-4] + '...'  # "…" is printed as floating dots
+    return text
+
+
+def get_prettyhandles_image(rows):
+    """return PNG image for rankings, meant to run in a render worker"""
+    font = _get_prettyhandles_font()
     SMOKE_WHITE = (250, 250, 250)
     BLACK = (0, 0, 0)
     img = Image.new('RGB', (900, 450), color=SMOKE_WHITE)
@@ -192,10 +224,7 @@ def get_prettyhandles_image(rows, font):
 
     # trim name to fit in the column width
     def _trim(name):
-        width = WIDTH_NAME - 10
-        while font.getsize(name)[0] > width:
-            name = name[:-4] + '...'  # "…" is printed as floating dots
-        return name
+        return _trim_to_width(name, WIDTH_NAME - 10)
 
     for pos, name, handle, rating in rows:
         name = _trim(name)
@@ -209,7 +238,9 @@ def get_prettyhandles_image(rows, font):
             draw.text((nutella_x, y), handle[0], fill=BLACK, font=font)
         y += Y_INC
 
-    return img
+    buffer = io.BytesIO()
+    img.save(buffer, 'png')
+    return buffer.getvalue()
 
 
 def _make_profile_embed(member, user, *, mode):
@@ -257,7 +288,6 @@ class Handles(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.font = ImageFont.truetype(constants.NOTO_SANS_CJK_BOLD_FONT_PATH, size=26) # font for ;handle pretty
 
     @commands.Cog.listener()
     @discord_common.once
@@ -267,7 +297,7 @@ class Handles(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        cf_common.user_db.set_inactive([(member.guild.id, member.id)])
+        await cf_common.user_db.set_inactive_async([(member.guild.id, member.id)])
 
     @commands.command(brief='update status, mark guild members as active')
     @commands.has_role('Admin')
@@ -294,7 +324,7 @@ class Handles(commands.Cog):
             user_id_handle_pairs = cf_common.user_db.get_handles_for_guild(guild.id)
             to_set_inactive += [(guild.id, user_id) for user_id, _ in user_id_handle_pairs
                                 if guild.get_member(user_id) is None]
-        cf_common.user_db.set_inactive(to_set_inactive)
+        await cf_common.user_db.set_inactive_async(to_set_inactive)
 
     @events.listener_spec(name='RatingChangesListener',
                           event_cls=events.RatingChangesUpdate,
@@ -303,20 +333,40 @@ class Handles(commands.Cog):
         contest, changes = event.contest, event.rating_changes
         change_by_handle = {change.handle: change for change in changes}
 
-        async def update_for_guild(guild):
-            if cf_common.user_db.has_auto_role_update_enabled(guild.id):
+        handles_by_guild = {guild: cf_common.user_db.get_handles_for_guild(guild.id)
+                            for guild in self.bot.guilds}
+        role_update_guilds = [guild for guild in self.bot.guilds
+                              if cf_common.user_db.has_auto_role_update_enabled(guild.id)]
+
+        async def update_for_guild(guild, user_by_handle):
+            res = handles_by_guild[guild]
+            if guild in role_update_guilds:
                 with contextlib.suppress(HandleCogError):
-                    await self._update_ranks_all(guild)
+                    await self._update_ranks(guild, res, user_by_handle=user_by_handle)
             channel_id = cf_common.user_db.get_rankup_channel(guild.id)
             channel = guild.get_channel(channel_id)
             if channel is not None:
                 with contextlib.suppress(HandleCogError):
-                    embeds = self._make_rankup_embeds(guild, contest, change_by_handle)
+                    embeds = self._make_rankup_embeds(guild, contest, change_by_handle,
+                                                      user_id_handle_pairs=res)
                     for embed in embeds:
                         await channel.send(embed=embed)
 
-        await asyncio.gather(*(update_for_guild(guild) for guild in self.bot.guilds),
-                             return_exceptions=True)
+        with cf.request_lane(cf.LANE_REFRESH):
+            # Users are fetched once for the members of all guilds, many handles are registered
+            # in several guilds.
+            handles = {handle for guild in role_update_guilds
+                       for user_id, handle in handles_by_guild[guild]
+                       if guild.get_member(int(user_id)) is not None}
+            try:
+                user_by_handle = await self._fetch_users_by_handle(handles, skip_missing=True)
+            except cf.CodeforcesApiError:
+                # Rankup embeds do not need the users, send them anyway.
+                self.logger.warning('Could not fetch users for rank role updates.', exc_info=True)
+                role_update_guilds, user_by_handle = [], {}
+            await asyncio.gather(*(update_for_guild(guild, user_by_handle)
+                                   for guild in self.bot.guilds),
+                                 return_exceptions=True)
         self.logger.info(f'All guilds updated for contest {contest.id}.')
 
     @commands.group(brief='Commands that have to do with handles', invoke_without_command=True)
@@ -325,10 +375,9 @@ class Handles(commands.Cog):
         await ctx.send_help(ctx.command)
 
     @staticmethod
-    async def update_member_rank_role(member, role_to_assign, *, reason):
-        """Sets the `member` to only have the rank role of `role_to_assign`. All other rank roles
-        on the member, if any, will be removed. If `role_to_assign` is None all existing rank roles
-        on the member will be removed.
+    def _rank_role_diff(member, role_to_assign):
+        """Returns the lists of roles to remove from and add to `member` so that it only has the
+        rank role of `role_to_assign`, as described in `update_member_rank_role`.
         """
         role_names_to_remove = {rank.title for rank in cf.RATED_RANKS}
         if role_to_assign is not None:
@@ -336,10 +385,30 @@ class Handles(commands.Cog):
             if role_to_assign.name not in ['Newbie', 'Pupil', 'Specialist', 'Expert']:
                 role_names_to_remove.add('Purgatory')
         to_remove = [role for role in member.roles if role.name in role_names_to_remove]
-        if to_remove:
-            await member.remove_roles(*to_remove, reason=reason)
+        to_add = []
         if role_to_assign is not None and role_to_assign not in member.roles:
-            await member.add_roles(role_to_assign, reason=reason)
+            to_add.append(role_to_assign)
+        return to_remove, to_add
+
+    @staticmethod
+    async def _apply_role_diff(member, to_remove, to_add, *, reason):
+        # Only the changed roles are sent, so that roles others granted or removed since
+        # member.roles was cached are left as they are.
+        async with _role_edit_semaphore(member.guild.id):
+            if to_remove:
+                await member.remove_roles(*to_remove, reason=reason)
+            if to_add:
+                await member.add_roles(*to_add, reason=reason)
+
+    @staticmethod
+    async def update_member_rank_role(member, role_to_assign, *, reason):
+        """Sets the `member` to only have the rank role of `role_to_assign`. All other rank roles
+        on the member, if any, will be removed. If `role_to_assign` is None all existing rank roles
+        on the member will be removed.
+        """
+        to_remove, to_add = Handles._rank_role_diff(member, role_to_assign)
+        if to_remove or to_add:
+            await Handles._apply_role_diff(member, to_remove, to_add, reason=reason)
 
     @handle.command(brief='Set Codeforces handle of a user')
     @commands.has_any_role('Admin', 'Moderator')
@@ -352,10 +421,10 @@ class Handles(commands.Cog):
     async def _set(self, ctx, member, user):
         handle = user.handle
         try:
-            cf_common.user_db.set_handle(member.id, ctx.guild.id, handle)
+            await cf_common.user_db.set_handle_async(member.id, ctx.guild.id, handle)
         except db.UniqueConstraintFailed:
             raise HandleCogError(f'The handle `{handle}` is already associated with another user.')
-        cf_common.user_db.cache_cf_user(user)
+        await cf_common.user_db.cache_cf_users_async([user])
 
         if user.rank == cf.UNRATED_RANK:
             role_to_assign = None
@@ -387,8 +456,7 @@ class Handles(commands.Cog):
         users = await cf.user.info(handles=[handle])
         invoker = str(ctx.author)
         handle = users[0].handle
-        problems = [prob for prob in cf_common.cache2.problem_cache.problems
-                    if prob.rating <= 1200]
+        problems = cf_common.cache2.problem_cache.select(max_rating=1200)
         problem = random.choice(problems)
         await ctx.send(f'`{invoker}`, submit a compile error to <{problem.url}> within 60 seconds')
         await asyncio.sleep(60)
@@ -425,7 +493,7 @@ class Handles(commands.Cog):
     @commands.has_any_role('Admin', 'Moderator')
     async def remove(self, ctx, member: discord.Member):
         """Remove Codeforces handle of a user."""
-        rc = cf_common.user_db.remove_handle(member.id, ctx.guild.id)
+        rc = await cf_common.user_db.remove_handle_async(member.id, ctx.guild.id)
         if not rc:
             raise HandleCogError(f'Handle for {member.mention} not found in database')
         await self.update_member_rank_role(member, role_to_assign=None,
@@ -524,11 +592,10 @@ class Handles(commands.Cog):
             num_before = (_PRETTY_HANDLES_PER_PAGE - 1) // 2
             start_idx = max(0, author_idx - num_before)
         rows_to_display = rows[start_idx : start_idx + _PRETTY_HANDLES_PER_PAGE]
-        img = get_prettyhandles_image(rows_to_display, self.font)
-        buffer = io.BytesIO()
-        img.save(buffer, 'png')
-        buffer.seek(0)
-        await ctx.send(msg, file=discord.File(buffer, 'handles.png'))
+        # The rows are everything the image depends on, repeated requests reuse the image.
+        png = await gc.render(get_prettyhandles_image, rows_to_display, key=ctx.guild.id,
+                              cache_key=rows_to_display)
+        await ctx.send(msg, file=discord.File(io.BytesIO(png), 'handles.png'))
 
     async def _update_ranks_all(self, guild):
         """For each member in the guild, fetches their current ratings and updates their role if
@@ -537,15 +604,42 @@ class Handles(commands.Cog):
         res = cf_common.user_db.get_handles_for_guild(guild.id)
         await self._update_ranks(guild, res)
 
-    async def _update_ranks(self, guild, res):
+    async def _fetch_users_by_handle(self, handles, *, skip_missing=False):
+        """Fetches and caches the users of the given handles. Returns a dict of handle to user.
+        With `skip_missing`, handles not found on Codeforces are left out instead of failing the
+        whole fetch.
+        """
+        handles = list(handles)
+        while True:
+            try:
+                users = await cf.user.info(handles=handles) if handles else []
+                break
+            except cf.HandleNotFoundError as e:
+                if not skip_missing:
+                    raise
+                missing = [handle for handle in handles if handle.lower() == e.handle.lower()]
+                if not missing:
+                    raise
+                self.logger.warning(f'Skipping handle {e.handle} not found on Codeforces.')
+                handles = [handle for handle in handles if handle not in missing]
+        await cf_common.user_db.cache_cf_users_async(users)
+        return dict(zip(handles, users))
+
+    async def _update_ranks(self, guild, res, *, user_by_handle=None):
+        """Updates the rank roles of the members given by `res`, pairs of user id and handle.
+        Users are fetched from Codeforces unless `user_by_handle` is given.
+        """
         member_handles = [(guild.get_member(int(user_id)), handle) for user_id, handle in res]
         member_handles = [(member, handle) for member, handle in member_handles if member is not None]
+        if user_by_handle is None:
+            user_by_handle = await self._fetch_users_by_handle(
+                handle for _, handle in member_handles)
+        member_handles = [(member, handle) for member, handle in member_handles
+                          if handle in user_by_handle]
         if not member_handles:
             raise HandleCogError('Handles not set for any user')
         members, handles = zip(*member_handles)
-        users = await cf.user.info(handles=handles)
-        for user in users:
-            cf_common.user_db.cache_cf_user(user)
+        users = [user_by_handle[handle] for handle in handles]
 
         required_roles = {user.rank.title for user in users if user.rank != cf.UNRATED_RANK}
         rank2role = {role.name: role for role in guild.roles if role.name in required_roles}
@@ -555,17 +649,34 @@ class Handles(commands.Cog):
             plural = 's' if len(missing_roles) > 1 else ''
             raise HandleCogError(f'Role{plural} for rank{plural} {roles_str} not present in the server')
 
+        diffs = []
         for member, user in zip(members, users):
             role_to_assign = None if user.rank == cf.UNRATED_RANK else rank2role[user.rank.title]
-            await self.update_member_rank_role(member, role_to_assign,
-                                               reason='Codeforces rank update')
+            to_remove, to_add = self._rank_role_diff(member, role_to_assign)
+            if to_remove or to_add:
+                diffs.append((member, to_remove, to_add))
+        self.logger.info(f'Updating rank roles of {len(diffs)} of {len(members)} members '
+                         f'in guild {guild.id}.')
+
+        # discord.py waits out the rate limits of each route by itself, the semaphore of the
+        # guild in _apply_role_diff keeps edits from piling up in its queue.
+        results = await asyncio.gather(*(self._apply_role_diff(member, to_remove, to_add,
+                                                               reason='Codeforces rank update')
+                                         for member, to_remove, to_add in diffs),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            self.logger.warning(f'Failed to update rank roles of {len(errors)} members in guild '
+                                f'{guild.id}.')
+            raise errors[0]
 
     @staticmethod
-    def _make_rankup_embeds(guild, contest, change_by_handle):
+    def _make_rankup_embeds(guild, contest, change_by_handle, *, user_id_handle_pairs=None):
         """Make an embed containing a list of rank changes and top rating increases for the members
         of this guild.
         """
-        user_id_handle_pairs = cf_common.user_db.get_handles_for_guild(guild.id)
+        if user_id_handle_pairs is None:
+            user_id_handle_pairs = cf_common.user_db.get_handles_for_guild(guild.id)
         member_handle_pairs = [(guild.get_member(int(user_id)), handle)
                                for user_id, handle in user_id_handle_pairs]
         def ispurg(member):
@@ -591,7 +702,7 @@ class Handles(commands.Cog):
         for member, change in member_change_pairs:
             cache = cf_common.cache2.rating_changes_cache
             if (change.oldRating == 1500
-                    and len(cache.get_rating_changes_for_handle(change.handle)) == 1):
+                    and cache.get_num_contests(change.handle) == 1):
                 # If this is the user's first rated contest.
                 old_role = 'Unrated'
             else:
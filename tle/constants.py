@@ -7,6 +7,7 @@ ASSETS_DIR = os.path.join(DATA_DIR, 'assets')
 DB_DIR = os.path.join(DATA_DIR, 'db')
 MISC_DIR = os.path.join(DATA_DIR, 'misc')
 TEMP_DIR = os.path.join(DATA_DIR, 'temp')
+RANKLIST_SNAPSHOT_DIR = os.path.join(DATA_DIR, 'ranklists')
 
 USER_DB_FILE_PATH = os.path.join(DB_DIR, 'user.db')
 CACHE_DB_FILE_PATH = os.path.join(DB_DIR, 'cache.db')
@@ -17,6 +18,7 @@ NOTO_SANS_CJK_BOLD_FONT_PATH = os.path.join(FONTS_DIR, 'NotoSansCJK-Bold.ttc')
 NOTO_SANS_CJK_REGULAR_FONT_PATH = os.path.join(FONTS_DIR, 'NotoSansCJK-Regular.ttc')
 
 CONTEST_WRITERS_JSON_FILE_PATH = os.path.join(MISC_DIR, 'contest_writers.json')
+TASK_STATE_FILE_PATH = os.path.join(MISC_DIR, 'task_state.json')
 
 LOG_FILE_PATH = os.path.join(LOGS_DIR, 'tle.log')
 
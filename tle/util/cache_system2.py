@@ -1,20 +1,121 @@
 import asyncio
 import logging
+import os
 import time
-from aiocache import cached
 
 from collections import defaultdict
 from discord.ext import commands
 
+from tle import constants
 from tle.util import codeforces_common as cf_common
 from tle.util import codeforces_api as cf
 from tle.util import events
 from tle.util import tasks
 from tle.util import paginator
+from tle.util import problem_index
+from tle.util.rating_index import RatingIndex
 from tle.util.ranklist import Ranklist
 
 logger = logging.getLogger(__name__)
 _CONTESTS_PER_BATCH_IN_CACHE_UPDATES = 100
+_MAX_CONCURRENT_CONTEST_FETCHES = 3
+# Rebuilding the indexes of a table takes time in the order of its size, which only pays off when
+# loading many contests.
+_MIN_CONTESTS_TO_DROP_INDEXES = 200
+_bulk_load_lock_by_table = {}
+
+
+async def _fetch_concurrently(fetch, contests, *, timeout, what, logger):
+    """Runs `fetch(contest)` for every contest, at most `_MAX_CONCURRENT_CONTEST_FETCHES` at a
+    time and each for at most `timeout` seconds. Returns (contest, result) pairs for the fetches
+    that succeeded, in the order of `contests`. Failed fetches are logged and left out so that
+    they do not hold back the others."""
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_CONTEST_FETCHES)
+
+    async def fetch_one(contest):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(fetch(contest), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'{what} fetch timed out for contest {contest.id}, ignoring.')
+            except cf.CodeforcesApiError as er:
+                logger.warning(f'{what} fetch failed for contest {contest.id}, ignoring. {er!r}')
+            return None
+
+    results = await asyncio.gather(*(fetch_one(contest) for contest in contests))
+    return [(contest, result) for contest, result in zip(contests, results) if result is not None]
+
+
+class _BulkLoad:
+    """Async context manager for loading contests' worth of rows into a table of the cache
+    database. Loads of the same table run one at a time. When at least
+    `_MIN_CONTESTS_TO_DROP_INDEXES` contests are to be loaded, the secondary indexes of the table
+    are dropped for the duration and rebuilt at the end, smaller loads keep them. Each chunk is
+    saved in its own transaction together with a checkpoint, so that a load interrupted midway
+    resumes after the last saved chunk when started again. Without a `name` no checkpoints are
+    kept.
+
+    The contests left to load, those after the checkpoint if any, are in `contests` once the
+    load is entered."""
+
+    def __init__(self, conn, table, contests, *, name=None, logger):
+        self.conn = conn
+        self.table = table
+        self.contests = contests
+        self.name = name
+        self.logger = logger
+        self.rows = 0
+        self.start_time = None
+        self.indexes_dropped = False
+
+    async def __aenter__(self):
+        lock = _bulk_load_lock_by_table.setdefault(self.table, asyncio.Lock())
+        await lock.acquire()
+        try:
+            if self.name is not None:
+                resume_after = await self.conn.aio.get_bulk_load_checkpoint(self.name)
+                if resume_after is not None:
+                    self.logger.info(f'Resuming bulk load {self.name} after contest '
+                                     f'{resume_after}')
+                    self.contests = self._after(self.contests, resume_after)
+            if len(self.contests) >= _MIN_CONTESTS_TO_DROP_INDEXES:
+                await self.conn.aio.drop_secondary_indexes(self.table)
+                self.indexes_dropped = True
+        except BaseException:
+            lock.release()
+            raise
+        self.start_time = time.time()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            elapsed = time.time() - self.start_time
+            if self.indexes_dropped:
+                await self.conn.aio.create_secondary_indexes(self.table)
+            if exc_type is None and self.name is not None:
+                await self.conn.aio.clear_bulk_load_checkpoint(self.name)
+            index_time = time.time() - self.start_time - elapsed
+            self.logger.info(f'Bulk load into {self.table} wrote {self.rows} rows in '
+                             f'{elapsed:.1f}s ({self.rows / max(elapsed, 1e-3):.0f} rows/s)' +
+                             (f', indexes rebuilt in {index_time:.1f}s'
+                              if self.indexes_dropped else ''))
+        finally:
+            _bulk_load_lock_by_table[self.table].release()
+
+    @staticmethod
+    def _after(contests, contest_id):
+        """Returns the contests after the one with the given id, or all if it is not there."""
+        ids = [contest.id for contest in contests]
+        if contest_id not in ids:
+            return contests
+        return contests[ids.index(contest_id) + 1:]
+
+    async def save(self, save, rows, contests):
+        """Saves rows fetched for the given contests with `save`, a bulk save method of the
+        connection, and checkpoints the last of the contests."""
+        checkpoint = None if self.name is None else (self.name, contests[-1].id)
+        self.rows += await save(rows, checkpoint=checkpoint)
+
 
 class CacheError(commands.CommandError):
     pass
@@ -85,7 +186,7 @@ class ContestCache:
 
     async def _try_disk(self):
         async with self.reload_lock:
-            contests = self.cache_master.conn.fetch_contests()
+            contests = await self.cache_master.conn.aio.fetch_contests()
             if not contests:
                 self.logger.info('Contest cache on disk is empty.')
                 return
@@ -107,7 +208,8 @@ class ContestCache:
         self.next_delay = self._EXCEPTION_CONTEST_RELOAD_DELAY
 
     async def _reload_contests(self):
-        contests = await cf.contest.list()
+        with cf.request_lane(cf.LANE_REFRESH):
+            contests = await cf.contest.list()
         delay = await self._update(contests)
         return delay
 
@@ -116,7 +218,7 @@ class ContestCache:
         contests.sort(key=lambda contest: (contest.startTimeSeconds, contest.id))
 
         if from_api:
-            rc = self.cache_master.conn.cache_contests(contests)
+            rc = await self.cache_master.conn.aio.cache_contests(contests)
             self.logger.info(f'{rc} contests stored in database')
 
         contests_by_phase = {phase: [] for phase in cf.Contest.PHASES}
@@ -157,12 +259,14 @@ class ContestCache:
 
 class ProblemCache:
     _RELOAD_INTERVAL = 6 * 60 * 60
+    _RELOAD_JITTER = 10 * 60
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
 
         self.problems = []
         self.problem_by_name = {}
+        self.problem_index = problem_index.ProblemIndex([], {})
         self.problems_last_cache = 0
 
         self.reload_lock = asyncio.Lock()
@@ -172,7 +276,7 @@ class ProblemCache:
 
     async def run(self):
         await self._try_disk()
-        self._update_task.start()
+        self._update_task.start(force_run=not self.problems)
 
     async def reload_now(self):
         """Force a reload. If currently reloading it will wait until done."""
@@ -190,16 +294,17 @@ class ProblemCache:
 
     async def _try_disk(self):
         async with self.reload_lock:
-            problems = self.cache_master.conn.fetch_problems()
+            problems = await self.cache_master.conn.aio.fetch_problems()
             if not problems:
                 self.logger.info('Problem cache on disk is empty.')
                 return
             self.problems = problems
             self.problem_by_name = {problem.name: problem for problem in problems}
+            self._build_index()
             self.logger.info(f'{len(self.problems)} problems fetched from disk')
 
     @tasks.task_spec(name='ProblemCacheUpdate',
-                     waiter=tasks.Waiter.fixed_delay(_RELOAD_INTERVAL))
+                     waiter=tasks.Waiter.fixed_delay(_RELOAD_INTERVAL, jitter=_RELOAD_JITTER))
     async def _update_task(self, _):
         async with self.reload_lock:
             await self._reload_problems()
@@ -210,7 +315,8 @@ class ProblemCache:
         self.reload_exception = ex
 
     async def _reload_problems(self):
-        problems, _ = await cf.problemset.problems()
+        with cf.request_lane(cf.LANE_REFRESH):
+            problems, _ = await cf.problemset.problems()
         await self._update(problems)
 
     async def _update(self, problems):
@@ -231,11 +337,20 @@ class ProblemCache:
 
         self.problems = list(problem_by_name.values())
         self.problem_by_name = problem_by_name
+        self._build_index()
         self.problems_last_cache = time.time()
 
-        rc = self.cache_master.conn.cache_problems(self.problems)
+        rc = await self.cache_master.conn.aio.cache_problems(self.problems)
         self.logger.info(f'{rc} problems stored in database')
 
+    def _build_index(self):
+        contest_by_id = self.cache_master.contest_cache.contest_by_id
+        self.problem_index = problem_index.ProblemIndex(self.problems, contest_by_id)
+
+    def select(self, **criteria):
+        """Returns cached problems matching the criteria, see `ProblemIndex.select`."""
+        return self.problem_index.select(**criteria)
+
 
 class ProblemsetCacheError(CacheError):
     pass
@@ -249,6 +364,7 @@ class ProblemsetNotCached(ProblemsetCacheError):
 class ProblemsetCache:
     _MONITOR_PERIOD_SINCE_CONTEST_END = 14 * 24 * 60 * 60
     _RELOAD_DELAY = 60 * 60
+    _RELOAD_JITTER = 5 * 60
 
     def __init__(self, cache_master):
         self.problems = []
@@ -259,37 +375,52 @@ class ProblemsetCache:
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        if self.cache_master.conn.problemset_empty():
+        empty = self.cache_master.conn.problemset_empty()
+        if empty:
             self.logger.warning('Problemset cache on disk is empty. This must be populated '
                                 'manually before use.')
-        self._update_task.start()
+        else:
+            # The first run of the update task may be up to a reload delay away.
+            async with self.update_lock:
+                await self._update_from_disk()
+        self._update_task.start(force_run=empty)
 
     async def update_for_contest(self, contest_id):
         """Update problemset for a particular contest. Intended for manual trigger."""
         async with self.update_lock:
             contest = self.cache_master.contest_cache.get_contest(contest_id)
             problemset, _ = await self._fetch_problemsets([contest], force_fetch=True)
-            self.cache_master.conn.clear_problemset(contest_id)
-            self._save_problems(problemset)
+            await self.cache_master.conn.aio.clear_problemset(contest_id)
+            await self._save_problems(problemset)
             return len(problemset)
 
     async def update_for_all(self):
         """Update problemsets for all finished contests. Intended for manual trigger."""
+        conn = self.cache_master.conn
         async with self.update_lock:
             contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
-            problemsets, _ = await self._fetch_problemsets(contests, force_fetch=True)
-            self.cache_master.conn.clear_problemset()
-            self._save_problems(problemsets)
-            return len(problemsets)
+            total_problems = 0
+            async with _BulkLoad(conn, 'problem2', contests, name='problemset',
+                                 logger=self.logger) as bulk_load:
+                for contests_chunk in paginator.chunkify(bulk_load.contests,
+                                                         _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
+                    with cf.request_lane(cf.LANE_BACKFILL):
+                        problems, _ = await self._fetch_problemsets(contests_chunk,
+                                                                    force_fetch=True)
+                    await bulk_load.save(conn.aio.bulk_save_problemset, problems, contests_chunk)
+                    total_problems += len(problems)
+            await self._update_from_disk()
+            return total_problems
 
     @tasks.task_spec(name='ProblemsetCacheUpdate',
-                     waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
+                     waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY, jitter=_RELOAD_JITTER))
     async def _update_task(self, _):
         async with self.update_lock:
             contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
-            new_problems, updated_problems = await self._fetch_problemsets(contests)
-            self._save_problems(new_problems + updated_problems)
-            self._update_from_disk()
+            with cf.request_lane(cf.LANE_REFRESH):
+                new_problems, updated_problems = await self._fetch_problemsets(contests)
+            await self._save_problems(new_problems + updated_problems)
+            await self._update_from_disk()
             self.logger.info(f'{len(new_problems)} new problems saved and {len(updated_problems)} '
                              'saved problems updated.')
 
@@ -332,8 +463,8 @@ class ProblemsetCache:
             problemset = []
         return problemset
 
-    def _save_problems(self, problems):
-        rc = self.cache_master.conn.cache_problemset(problems)
+    async def _save_problems(self, problems):
+        rc = await self.cache_master.conn.aio.cache_problemset(problems)
         self.logger.info(f'Saved {rc} problems to database.')
 
     def get_problemset(self, contest_id):
@@ -342,8 +473,8 @@ class ProblemsetCache:
             raise ProblemsetNotCached(contest_id)
         return problemset
 
-    def _update_from_disk(self):
-        self.problems = self.cache_master.conn.fetch_problems2()
+    async def _update_from_disk(self):
+        self.problems = await self.cache_master.conn.aio.fetch_problems2()
         self.problem_to_contests = defaultdict(list)
         for problem in self.problems:
             try:
@@ -357,16 +488,20 @@ class ProblemsetCache:
 class RatingChangesCache:
     _RATED_DELAY = 36 * 60 * 60
     _RELOAD_DELAY = 10 * 60
+    _FETCH_TIMEOUT = 2 * 60
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
         self.monitored_contests = []
-        self.handle_rating_cache = {}
+        self.rating_index = RatingIndex()
+        # Bumped whenever the cached ratings change, so that anything derived from them can be
+        # cached until then.
+        self.version = 0
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
-        self._refresh_handle_cache()
-        if not self.handle_rating_cache:
+        await self._load_index()
+        if not self.rating_index:
             self.logger.warning('Rating changes cache on disk is empty. This must be populated '
                                 'manually before use.')
         self._update_task.start()
@@ -375,17 +510,15 @@ class RatingChangesCache:
         """Fetch rating changes for a particular contest. Intended for manual trigger."""
         contest = self.cache_master.contest_cache.contest_by_id[contest_id]
         changes = await self._fetch([contest])
-        self.cache_master.conn.clear_rating_changes(contest_id=contest_id)
-        self._save_changes(changes)
+        await self.cache_master.conn.aio.clear_rating_changes(contest_id=contest_id)
+        await self._load_index()
+        await self._save_changes(changes)
         return len(changes)
 
     async def fetch_all_contests(self):
         """Fetch rating changes for all contests. Intended for manual trigger."""
         contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
-        changes = await self._fetch(contests)
-        self.cache_master.conn.clear_rating_changes()
-        self._save_changes(changes)
-        return len(changes)
+        return await self._bulk_fetch(contests, name='rating_changes')
 
     async def fetch_missing_contests(self):
         """Fetch rating changes for contests which are not saved in database. Intended for
@@ -393,11 +526,34 @@ class RatingChangesCache:
         contests = self.cache_master.contest_cache.contests_by_phase['FINISHED']
         contests = [
             contest for contest in contests if not self.has_rating_changes_saved(contest.id)]
+        # Resumes by itself since saved contests are skipped, no checkpoints are needed.
+        return await self._bulk_fetch(contests)
+
+    async def _bulk_fetch(self, contests, *, name=None):
+        conn = self.cache_master.conn
         total_changes = 0
-        for contests_chunk in paginator.chunkify(contests, _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
-            contests_chunk = await self._fetch(contests_chunk)
-            self._save_changes(contests_chunk)
-            total_changes += len(contests_chunk)
+        handles = set()
+        bulk_load = _BulkLoad(conn, 'rating_change', contests, name=name, logger=self.logger)
+        try:
+            async with bulk_load:
+                for contests_chunk in paginator.chunkify(bulk_load.contests,
+                                                         _CONTESTS_PER_BATCH_IN_CACHE_UPDATES):
+                    with cf.request_lane(cf.LANE_BACKFILL):
+                        contest_changes_pairs = await self._fetch(contests_chunk)
+                    changes = [change for _, changes in contest_changes_pairs
+                               for change in changes]
+                    await bulk_load.save(conn.aio.bulk_save_rating_changes, changes,
+                                         contests_chunk)
+                    handles.update(change.handle for change in changes)
+                    total_changes += len(contest_changes_pairs)
+        finally:
+            # Also bring the handle ratings up to date with the chunks saved before a failure.
+            # Rebuilding the whole table only pays off for loads large enough to drop indexes.
+            if bulk_load.indexes_dropped:
+                await conn.aio.rebuild_handle_rating()
+            elif handles:
+                await conn.aio.update_handle_rating(handles)
+            await self._load_index()
         return total_changes
 
     def is_newly_finished_without_rating_changes(self, contest):
@@ -438,46 +594,50 @@ class RatingChangesCache:
             await self._monitor_task.stop()
             return
 
-        contest_changes_pairs = await self._fetch(self.monitored_contests)
+        with cf.request_lane(cf.LANE_REFRESH):
+            contest_changes_pairs = await self._fetch(self.monitored_contests)
         # Sort by the rating update time of the first change in the list of changes, assuming
         # every change in the list has the same time.
         contest_changes_pairs.sort(key=lambda pair: pair[1][0].ratingUpdateTimeSeconds)
-        self._save_changes(contest_changes_pairs)
+        await self._save_changes(contest_changes_pairs)
         for contest, changes in contest_changes_pairs:
             cf_common.event_sys.dispatch(events.RatingChangesUpdate, contest=contest,
                                          rating_changes=changes)
 
     async def _fetch(self, contests):
-        all_changes = []
-        for contest in contests:
-            try:
-                changes = await cf.contest.ratingChanges(contest_id=contest.id)
-                self.logger.info(f'{len(changes)} rating changes fetched for contest {contest.id}')
-                if changes:
-                    all_changes.append((contest, changes))
-            except cf.CodeforcesApiError as er:
-                self.logger.warning(f'Fetch rating changes failed for contest {contest.id}, ignoring. {er!r}')
-                pass
-        return all_changes
-
-    def _save_changes(self, contest_changes_pairs):
+        async def fetch(contest):
+            changes = await cf.contest.ratingChanges(contest_id=contest.id)
+            self.logger.info(f'{len(changes)} rating changes fetched for contest {contest.id}')
+            return changes
+
+        contest_changes_pairs = await _fetch_concurrently(fetch, contests,
+                                                          timeout=self._FETCH_TIMEOUT,
+                                                          what='Rating changes',
+                                                          logger=self.logger)
+        return [(contest, changes) for contest, changes in contest_changes_pairs if changes]
+
+    async def _save_changes(self, contest_changes_pairs):
         flattened = [change for _, changes in contest_changes_pairs for change in changes]
         if not flattened:
             return
-        rc = self.cache_master.conn.save_rating_changes(flattened)
+        rc = await self.cache_master.conn.aio.save_rating_changes(flattened)
         self.logger.info(f'Saved {rc} changes to database.')
-        self._refresh_handle_cache()
+        # Saved contests are never saved again without being cleared first, so the changes are
+        # new to the index.
+        self.rating_index.apply_changes(flattened)
+        self.version += 1
 
-    def _refresh_handle_cache(self):
-        changes = self.cache_master.conn.get_all_rating_changes()
-        handle_rating_cache = {}
-        for change in changes:
-            handle_rating_cache[change.handle] = change.newRating
-        self.handle_rating_cache = handle_rating_cache
-        self.logger.info(f'Ratings for {len(handle_rating_cache)} handles cached')
+    async def _load_index(self):
+        rows = await self.cache_master.conn.aio.get_latest_rating_by_handle()
+        self.rating_index = RatingIndex.from_rows(rows)
+        self.version += 1
+        self.logger.info(f'Ratings for {len(self.rating_index)} handles cached')
 
     def get_users_with_more_than_n_contests(self, time_cutoff, n):
-        return self.cache_master.conn.get_users_with_more_than_n_contests(time_cutoff, n)
+        return self.rating_index.handles_with_min_contests(time_cutoff, n)
+
+    def get_ratings_of_users_with_more_than_n_contests(self, time_cutoff, n):
+        return self.rating_index.ratings_with_min_contests(time_cutoff, n)
 
     def get_rating_changes_for_contest(self, contest_id):
         return self.cache_master.conn.get_rating_changes_for_contest(contest_id)
@@ -488,12 +648,193 @@ class RatingChangesCache:
     def get_rating_changes_for_handle(self, handle):
         return self.cache_master.conn.get_rating_changes_for_handle(handle)
 
+    def get_num_contests(self, handle):
+        return self.rating_index.get_num_contests(handle)
+
     def get_current_rating(self, handle, default_if_absent=False):
-        return self.handle_rating_cache.get(handle,
-                                            cf.DEFAULT_RATING if default_if_absent else None)
+        rating = self.rating_index.get_rating(handle)
+        if rating is None and default_if_absent:
+            return cf.DEFAULT_RATING
+        return rating
 
     def get_all_ratings(self):
-        return list(self.handle_rating_cache.values())
+        """Returns a sorted numpy array of the current ratings of all handles."""
+        return self.rating_index.sorted_ratings()
+
+    def get_rating_percentile(self, rating):
+        return self.rating_index.percentile(rating)
+
+
+class SubmissionCache:
+    """Persistent per-handle cache of submissions from the user.status endpoint. Submissions are
+    synced incrementally, only those newer than the ones already saved are fetched."""
+
+    _FULL_SYNC_INTERVAL = 7 * 24 * 60 * 60
+    _INITIAL_PAGE_SIZE = 50
+    _MAX_PAGE_SIZE = 1000
+
+    # Which submissions count towards each kind of per-handle problem bits.
+    _PROBLEM_BITS_KINDS = {
+        'solved': lambda sub: sub.verdict == 'OK',
+        'attempted': lambda sub: True,
+        'compiled': lambda sub: sub.verdict != 'COMPILATION_ERROR',
+    }
+
+    def __init__(self, cache_master):
+        self.cache_master = cache_master
+        self.sync_lock_by_handle = defaultdict(asyncio.Lock)
+        # Bumped whenever submissions of the handle are saved, invalidating derived data.
+        self.generation_by_handle = defaultdict(int)
+        self.derived_by_handle = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def _synced_key(self, handle):
+        key = handle.lower()
+        async with self.sync_lock_by_handle[key]:
+            await self._sync(handle, key)
+        return key
+
+    async def get_submissions(self, handle):
+        """Returns all submissions of the handle, most recent first, like `cf.user.status`."""
+        key = await self._synced_key(handle)
+        return await self.cache_master.conn.aio.fetch_submissions(key)
+
+    async def get_derived(self, handle, what, version, compute):
+        """Returns `compute(submissions)` for the handle. The result is memoized under `what`
+        until the submissions of the handle change or `version` is no longer the same object."""
+        key = await self._synced_key(handle)
+        generation = self.generation_by_handle[key]
+        entry = self.derived_by_handle.get((key, what))
+        if entry is not None and entry[0] == generation and entry[1] is version:
+            return entry[2]
+        value = compute(await self.cache_master.conn.aio.fetch_submissions(key))
+        self.derived_by_handle[(key, what)] = generation, version, value
+        return value
+
+    async def get_problem_bits(self, handles, kind):
+        """Returns packed bits over the positions of the current problem index, set for the
+        problems that any of the handles has a submission of the given kind for. The kind is
+        one of 'solved', 'attempted' or 'compiled' (any verdict other than compilation error)."""
+        counts = self._PROBLEM_BITS_KINDS[kind]
+        problem_cache = self.cache_master.problem_cache
+        while True:
+            index = problem_cache.problem_index
+
+            def compute(submissions):
+                return index.bits_for_names(sub.problem.name for sub in submissions
+                                            if counts(sub))
+
+            bits = index.empty_bits()
+            for handle in handles:
+                bits |= await self.get_derived(handle, kind, index, compute)
+            # The problems may have been reloaded while syncing submissions.
+            if index is problem_cache.problem_index:
+                return bits
+
+    async def _sync(self, handle, key):
+        conn = self.cache_master.conn
+        last_full_sync, max_id, first_unsettled_id = conn.get_submission_sync_state(key)
+        if last_full_sync is None or time.time() - last_full_sync > self._FULL_SYNC_INTERVAL:
+            # Refetch everything once in a while to pick up rejudges of old submissions.
+            submissions = await cf.user.status(handle=handle)
+            rc = await conn.aio.save_submissions(key, submissions, full_sync=True)
+            self.generation_by_handle[key] += 1
+            self.logger.info(f'Full sync of submissions for {handle}, {rc} saved')
+            return
+
+        # Saved submissions up to known_id have final verdicts, everything after is refetched.
+        known_id = max_id or 0
+        if first_unsettled_id is not None:
+            known_id = first_unsettled_id - 1
+
+        submissions = []
+        from_, count = 1, self._INITIAL_PAGE_SIZE
+        while True:
+            page = await cf.user.status(handle=handle, from_=from_, count=count)
+            submissions += [sub for sub in page if sub.id > known_id]
+            if len(page) < count or page[-1].id <= known_id:
+                break
+            from_ += count
+            count = min(2 * count, self._MAX_PAGE_SIZE)
+        if submissions:
+            await conn.aio.save_submissions(key, submissions)
+            self.generation_by_handle[key] += 1
+
+
+class UserRatingCache:
+    """Effective ratings of all users from the user.ratedList endpoint, persisted in the cache
+    database. The list is by far the largest response of the API, so once any version of it is
+    available it is never waited for: old ratings are returned while a refresh runs in the
+    background. Refreshes start on access some time before the ratings would have expired, so
+    that ratings in regular use, as during running contests, never go stale."""
+
+    _REFRESH_AGE = 20 * 60
+    _MAX_AGE = 30 * 60
+    _RETRY_DELAY = 5 * 60
+
+    def __init__(self, cache_master):
+        self.cache_master = cache_master
+        self.rating_by_handle = None
+        self.fetch_time = None
+        self._refresh_task = None
+        self._last_refresh_attempt = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def run(self):
+        await self._try_disk()
+        if self.rating_by_handle is None:
+            # Fetch the first ratings ever ahead of time, so that no prediction waits for them.
+            self._refresh_in_background()
+
+    async def _try_disk(self):
+        fetch_time, rating_by_handle = await self.cache_master.conn.aio.fetch_user_ratings()
+        if fetch_time is None:
+            self.logger.info('No user ratings on disk')
+            return
+        self.rating_by_handle, self.fetch_time = rating_by_handle, fetch_time
+        self.logger.info(f'{len(rating_by_handle)} user ratings fetched at {fetch_time} loaded '
+                         'from disk')
+
+    async def get_effective_ratings(self):
+        """Returns a dict of handle to effective rating for all users. Do not modify it."""
+        if self.rating_by_handle is None:
+            # Nothing to fall back on, wait for the fetch.
+            await self._refresh()
+            return self.rating_by_handle
+        age = time.time() - self.fetch_time
+        if age > self._REFRESH_AGE:
+            if age > self._MAX_AGE:
+                self.logger.info(f'Using user ratings {int(age)}s old while refreshing')
+            self._refresh_in_background()
+        return self.rating_by_handle
+
+    def _refresh(self):
+        """Returns the task of the running refresh, starting one if there is none."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._last_refresh_attempt = time.time()
+            self._refresh_task = asyncio.create_task(self._fetch())
+        return self._refresh_task
+
+    def _refresh_in_background(self):
+        running = self._refresh_task is not None and not self._refresh_task.done()
+        if running or time.time() - self._last_refresh_attempt < self._RETRY_DELAY:
+            return
+
+        def log_failure(task):
+            if not task.cancelled() and task.exception() is not None:
+                self.logger.warning('Background refresh of user ratings failed.',
+                                    exc_info=task.exception())
+
+        self._refresh().add_done_callback(log_failure)
+
+    async def _fetch(self):
+        fetch_time = time.time()
+        with cf.request_lane(cf.LANE_REFRESH):
+            rating_by_handle = {user.handle: user.effective_rating
+                                async for user in cf.user.ratedList_stream(activeOnly=False)}
+        self.rating_by_handle, self.fetch_time = rating_by_handle, fetch_time
+        rc = await self.cache_master.conn.aio.save_user_ratings(rating_by_handle, fetch_time)
+        self.logger.info(f'{rc} user ratings fetched and saved')
 
 
 class RanklistCacheError(CacheError):
@@ -507,6 +848,8 @@ class RanklistNotMonitored(RanklistCacheError):
 
 class RanklistCache:
     _RELOAD_DELAY = 2 * 60
+    _FETCH_TIMEOUT = 3 * 60
+    _SNAPSHOT_MAX_AGE = 24 * 60 * 60
 
     def __init__(self, cache_master):
         self.cache_master = cache_master
@@ -515,8 +858,56 @@ class RanklistCache:
         self.logger = logging.getLogger(self.__class__.__name__)
 
     async def run(self):
+        # Serve the ranklists of the last run until they are fetched again.
+        loop = asyncio.get_running_loop()
+        self.ranklist_by_contest = await loop.run_in_executor(None, self._load_snapshots)
         self._update_task.start()
 
+    @staticmethod
+    def _snapshot_path(contest_id):
+        return os.path.join(constants.RANKLIST_SNAPSHOT_DIR, f'{contest_id}.npz')
+
+    def _load_snapshots(self):
+        ranklist_by_contest = {}
+        for filename in os.listdir(constants.RANKLIST_SNAPSHOT_DIR):
+            path = os.path.join(constants.RANKLIST_SNAPSHOT_DIR, filename)
+            try:
+                ranklist = Ranklist.load(path)
+            except Exception as ex:
+                self.logger.warning(f'Ignoring unreadable ranklist snapshot {filename}: {ex!r}')
+                os.remove(path)
+                continue
+            if time.time() - ranklist.fetch_time > self._SNAPSHOT_MAX_AGE:
+                os.remove(path)
+                continue
+            ranklist_by_contest[ranklist.contest.id] = ranklist
+        self.logger.info(f'Loaded ranklist snapshots for contests {list(ranklist_by_contest)}')
+        return ranklist_by_contest
+
+    def _save_snapshots(self, ranklist_by_contest):
+        """Saves snapshots of the given ranklists and removes those of all other contests."""
+        for contest_id, ranklist in ranklist_by_contest.items():
+            path = self._snapshot_path(contest_id)
+            # Write to a temporary file first so that a crash does not leave a partial snapshot.
+            with open(path + '.tmp', 'wb') as f:
+                ranklist.save(f)
+            os.replace(path + '.tmp', path)
+        keep = {os.path.basename(self._snapshot_path(contest_id))
+                for contest_id in ranklist_by_contest}
+        for filename in os.listdir(constants.RANKLIST_SNAPSHOT_DIR):
+            if filename not in keep:
+                os.remove(os.path.join(constants.RANKLIST_SNAPSHOT_DIR, filename))
+
+    async def _snapshot(self):
+        ranklist_by_contest = {contest.id: self.ranklist_by_contest[contest.id]
+                               for contest in self.monitored_contests
+                               if contest.id in self.ranklist_by_contest}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._save_snapshots, ranklist_by_contest)
+        except OSError:
+            self.logger.warning('Could not save ranklist snapshots.', exc_info=True)
+
     def get_ranklist(self, contest):
         try:
             return self.ranklist_by_contest[contest.id]
@@ -536,9 +927,12 @@ class RanklistCache:
             await self._monitor_task.stop()
             if to_monitor:
                 self.monitored_contests = to_monitor
-                self._monitor_task.start()
+                # Fetch right away unless every ranklist was loaded from a snapshot.
+                missing = any(contest.id not in self.ranklist_by_contest for contest in to_monitor)
+                self._monitor_task.start(force_run=missing)
             else:
                 self.ranklist_by_contest = {}
+                await self._snapshot()
 
     @tasks.task_spec(name='RanklistCacheUpdate.MonitorActiveContests',
                      waiter=tasks.Waiter.fixed_delay(_RELOAD_DELAY))
@@ -548,25 +942,30 @@ class RanklistCache:
                                    if contest.phase != 'FINISHED' or check(contest)]
         if not self.monitored_contests:
             self.ranklist_by_contest = {}
+            await self._snapshot()
             self.logger.info('No more active contests for which to monitor ranklists.')
             await self._monitor_task.stop()
             return
 
-        ranklist_by_contest = await self._fetch(self.monitored_contests)
+        with cf.request_lane(cf.LANE_REFRESH):
+            ranklist_by_contest = await self._fetch(self.monitored_contests)
         # If any ranklist could not be fetched, the old ranklist is kept.
         for contest_id, ranklist in ranklist_by_contest.items():
             self.ranklist_by_contest[contest_id] = ranklist
+        await self._snapshot()
 
-    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False):
+    async def generate_ranklist(self, contest_id, *, fetch_changes=False, predict_changes=False,
+                                previous=None):
+        """Fetches the ranklist of a contest. With `predict_changes`, `previous` can be an earlier
+        ranklist of the contest to update in place instead of building a new one."""
         assert fetch_changes ^ predict_changes
 
-        contest, problems, standings = await cf.contest.standings(contest_id=contest_id,
-                                                                  show_unofficial=True)
+        async with cf.contest.standings_stream(contest_id=contest_id,
+                                               show_unofficial=True) as (contest, problems, rows):
+            # Exclude PRACTICE and MANAGER
+            standings = [row async for row in rows
+                         if row.party.participantType in ('CONTESTANT', 'OUT_OF_COMPETITION', 'VIRTUAL')]
         now = time.time()
-
-        # Exclude PRACTICE and MANAGER
-        standings = [row for row in standings
-                     if row.party.participantType in ('CONTESTANT', 'OUT_OF_COMPETITION', 'VIRTUAL')]
         if fetch_changes:
             # Fetch final rating changes from CF.
             # For older contests.
@@ -585,34 +984,47 @@ class RanklistCache:
         elif predict_changes:
             # Rating changes have not been applied yet, predict rating changes.
             # For running/recent contests.
-            _, _, standings_official = await cf.contest.standings(contest_id=contest_id)
-
-            has_teams = any(row.party.teamId is not None for row in standings_official)
-            if cf_common.is_nonstandard_contest(contest) or has_teams:
-                # The contest is not rated
-                ranklist = Ranklist(contest, problems, standings, now, is_rated=False)
-            else:
-                current_rating = await CacheSystem.getUsersEffectiveRating(activeOnly=False)
-                current_rating = {row.party.members[0].handle: current_rating.get(row.party.members[0].handle, 1500)
-                                  for row in standings_official}
+            has_teams = False
+            official_handles = []
+            async with cf.contest.standings_stream(contest_id=contest_id) as (_, _, rows):
+                async for row in rows:
+                    has_teams = has_teams or row.party.teamId is not None
+                    official_handles.append(row.party.members[0].handle)
+
+            # Nonstandard and team contests are not rated.
+            is_rated = not (cf_common.is_nonstandard_contest(contest) or has_teams)
+            if is_rated:
+                user_rating_cache = self.cache_master.user_rating_cache
+                current_rating = await user_rating_cache.get_effective_ratings()
+                current_rating = {handle: current_rating.get(handle, 1500)
+                                  for handle in official_handles}
                 if 'Educational' in contest.name:
                     # For some reason educational contests return all contestants in ranklist even
                     # when unofficial contestants are not requested.
                     current_rating = {handle: rating
                                       for handle, rating in current_rating.items() if rating < 2100}
-                ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
+
+            if previous is not None and previous.is_rated == is_rated:
+                num_changed = previous.update(contest, problems, standings, now)
+                self.logger.info(f'{num_changed} ranklist rows changed for contest {contest_id}')
+                ranklist = previous
+            else:
+                ranklist = Ranklist(contest, problems, standings, now, is_rated=is_rated)
+            if is_rated:
+                # Deltas are only recalculated if the points, penalty or rating of a rated
+                # contestant changed.
                 ranklist.predict(current_rating)
 
         return ranklist
 
     async def generate_vc_ranklist(self, contest_id, handle_to_member_id):
         handles = list(handle_to_member_id.keys())
-        contest, problems, standings = await cf.contest.standings(contest_id=contest_id,
-                                                                  show_unofficial=True)
-        # Exclude PRACTICE, MANAGER and OUR_OF_COMPETITION
-        standings = [row for row in standings
-                     if row.party.participantType == 'CONTESTANT' or
-                        row.party.members[0].handle in handles]
+        async with cf.contest.standings_stream(contest_id=contest_id,
+                                               show_unofficial=True) as (contest, problems, rows):
+            # Exclude PRACTICE, MANAGER and OUR_OF_COMPETITION
+            standings = [row async for row in rows
+                         if row.party.participantType == 'CONTESTANT' or
+                            row.party.members[0].handle in handles]
         standings.sort(key=lambda row: row.rank)
         standings = [row._replace(rank=i + 1) for i, row in enumerate(standings)]
         now = time.time()
@@ -627,27 +1039,24 @@ class RanklistCache:
         current_vc_rating = {handle: cf_common.user_db.get_vc_rating(handle_to_member_id.get(handle))
                                 for handle in handles}
         ranklist = Ranklist(contest, problems, standings, now, is_rated=True)
-        delta_by_handle = {}
-        for handle in handles:
-            mixed_ratings = current_official_rating.copy()
-            mixed_ratings[handle] = current_vc_rating.get(handle)
-            ranklist.predict(mixed_ratings)
-            delta_by_handle[handle] = ranklist.delta_by_handle.get(handle, 0)
-
-        ranklist.delta_by_handle = delta_by_handle
+        # Each virtual participant is predicted against the official contestants alone.
+        delta_by_handle = ranklist.predict_insertions(current_official_rating, current_vc_rating)
+        ranklist.delta_by_handle = {handle: delta_by_handle.get(handle, 0) for handle in handles}
+        ranklist.deltas_status = 'Predicted'
         return ranklist
 
     async def _fetch(self, contests):
-        ranklist_by_contest = {}
-        for contest in contests:
-            try:
-                ranklist = await self.generate_ranklist(contest.id, predict_changes=True)
-                ranklist_by_contest[contest.id] = ranklist
-                self.logger.info(f'Ranklist fetched for contest {contest.id}')
-            except cf.CodeforcesApiError as er:
-                self.logger.warning(f'Ranklist fetch failed for contest {contest.id}. {er!r}')
+        async def fetch(contest):
+            ranklist = await self.generate_ranklist(
+                contest.id, predict_changes=True,
+                previous=self.ranklist_by_contest.get(contest.id))
+            self.logger.info(f'Ranklist fetched for contest {contest.id}')
+            return ranklist
 
-        return ranklist_by_contest
+        contest_ranklist_pairs = await _fetch_concurrently(fetch, contests,
+                                                           timeout=self._FETCH_TIMEOUT,
+                                                           what='Ranklist', logger=self.logger)
+        return {contest.id: ranklist for contest, ranklist in contest_ranklist_pairs}
 
 
 class CacheSystem:
@@ -658,21 +1067,13 @@ class CacheSystem:
         self.rating_changes_cache = RatingChangesCache(self)
         self.ranklist_cache = RanklistCache(self)
         self.problemset_cache = ProblemsetCache(self)
+        self.submission_cache = SubmissionCache(self)
+        self.user_rating_cache = UserRatingCache(self)
 
     async def run(self):
         await self.rating_changes_cache.run()
+        await self.user_rating_cache.run()
         await self.ranklist_cache.run()
         await self.contest_cache.run()
         await self.problem_cache.run()
         await self.problemset_cache.run()
-
-    @staticmethod
-    @cached(ttl=30 * 60)
-    async def getUsersEffectiveRating(*, activeOnly=None):
-        """ Returns a dictionary mapping user handle to his effective rating for all the users.
-        """
-        ratedList = await cf.user.ratedList(activeOnly=activeOnly)
-        users_effective_rating_dict = {user.handle: user.effective_rating
-                                  for user in ratedList}
-        return users_effective_rating_dict
-
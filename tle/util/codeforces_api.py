@@ -1,4 +1,8 @@
 import asyncio
+import codecs
+import contextlib
+import contextvars
+import json
 import logging
 import time
 import functools
@@ -145,6 +149,19 @@ def make_from_dict(namedtuple_cls, dict_):
     return namedtuple_cls._make(field_vals)
 
 
+def _make_party(party_dict):
+    members = [make_from_dict(Member, member) for member in party_dict['members']]
+    return make_from_dict(Party, {**party_dict, 'members': members})
+
+
+def _make_ranklist_row(row_dict):
+    problem_results = [make_from_dict(ProblemResult, problem_result)
+                       for problem_result in row_dict['problemResults']]
+    return make_from_dict(RanklistRow, {**row_dict,
+                                        'party': _make_party(row_dict['party']),
+                                        'problemResults': problem_results})
+
+
 # Error classes
 
 class CodeforcesApiError(commands.CommandError):
@@ -169,6 +186,7 @@ class ClientError(CodeforcesApiError):
 class HandleNotFoundError(TrueApiError):
     def __init__(self, comment, handle):
         super().__init__(comment, f'Handle `{handle}` not found on Codeforces')
+        self.handle = handle
 
 
 class HandleInvalidError(TrueApiError):
@@ -207,28 +225,152 @@ def _bool_to_str(value):
     raise TypeError(f'Expected bool, got {value} of type {type(value)}')
 
 
-def cf_ratelimit(f):
-    tries = 3
-    per_second = 5
-    last = deque([0]*per_second)
+# Request scheduling
+
+LANE_INTERACTIVE = 'interactive'
+LANE_REFRESH = 'refresh'
+LANE_BACKFILL = 'backfill'
+
+LaneStats = namedtuple('LaneStats', 'queued in_flight served avg_wait max_wait')
+
+_request_lane = contextvars.ContextVar('cf_request_lane', default=LANE_INTERACTIVE)
 
-    @functools.wraps(f)
-    async def wrapped(*args, **kwargs):
-        for i in range(tries):
-            now = time.time()
 
-            # Next valid slot is 1s after the `per_second`th last request
-            next_valid = max(now, 1 + last[0])
-            last.append(next_valid)
-            last.popleft()
+@contextlib.contextmanager
+def request_lane(lane):
+    """Queries made inside this context go through the given lane of the request scheduler.
+    Tasks created inside the context inherit the lane. The default lane is interactive."""
+    token = _request_lane.set(lane)
+    try:
+        yield
+    finally:
+        _request_lane.reset(token)
+
+
+class RequestScheduler:
+    """Schedules API queries from all lanes under one global rate limit.
+
+    Every request takes one of `per_second` tokens, which becomes available again one second
+    later. Lanes are served by smooth weighted round robin, so a busy low priority lane still
+    leaves most of the budget to the others, and each lane has its own cap on requests in flight.
+    """
+
+    def __init__(self, *, per_second, lanes):
+        """`lanes` maps each lane to a pair of (weight, max requests in flight)."""
+        self.per_second = per_second
+        self.lanes = lanes
+        self._last = deque([0] * per_second)
+        self._queues = {lane: deque() for lane in lanes}
+        self._credit = {lane: 0 for lane in lanes}
+        self._in_flight = {lane: 0 for lane in lanes}
+        self._served = {lane: 0 for lane in lanes}
+        self._total_wait = {lane: 0.0 for lane in lanes}
+        self._max_wait = {lane: 0.0 for lane in lanes}
+        self._wakeup = None
+        self._dispatcher = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane):
+        """Waits until a request may be made in the given lane and holds the slot while inside."""
+        await self._acquire(lane)
+        try:
+            yield
+        finally:
+            self._in_flight[lane] -= 1
+            self._wakeup.set()
+
+    def get_stats(self):
+        stats = {}
+        for lane in self.lanes:
+            served = self._served[lane]
+            avg_wait = self._total_wait[lane] / served if served else 0.0
+            stats[lane] = LaneStats(len(self._queues[lane]), self._in_flight[lane], served,
+                                    avg_wait, self._max_wait[lane])
+        return stats
+
+    async def _acquire(self, lane):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        future = asyncio.get_running_loop().create_future()
+        self._queues[lane].append((time.time(), future))
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as we were cancelled, give it back.
+                self._in_flight[lane] -= 1
+                self._wakeup.set()
+            raise
 
-            # Delay as needed
-            delay = next_valid - now
+    def _ready_lanes(self):
+        ready = []
+        for lane, queue in self._queues.items():
+            while queue and queue[0][1].cancelled():
+                queue.popleft()
+            if queue and self._in_flight[lane] < self.lanes[lane][1]:
+                ready.append(lane)
+            elif not queue:
+                self._credit[lane] = 0
+        return ready
+
+    def _pick_lane(self, ready):
+        total = 0
+        for lane in ready:
+            weight = self.lanes[lane][0]
+            self._credit[lane] += weight
+            total += weight
+        lane = max(ready, key=self._credit.get)
+        self._credit[lane] -= total
+        return lane
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            ready = self._ready_lanes()
+            if not ready:
+                await self._wakeup.wait()
+                continue
+
+            # Next token is available 1s after the `per_second`th last request.
+            delay = 1 + self._last[0] - time.time()
             if delay > 0:
                 await asyncio.sleep(delay)
+                # Waiters may have arrived or left in the meantime.
+                continue
 
+            lane = self._pick_lane(ready)
+            enqueue_time, future = self._queues[lane].popleft()
+            future.set_result(None)
+            now = time.time()
+            self._last.append(now)
+            self._last.popleft()
+            self._in_flight[lane] += 1
+            wait = now - enqueue_time
+            self._served[lane] += 1
+            self._total_wait[lane] += wait
+            self._max_wait[lane] = max(self._max_wait[lane], wait)
+
+
+request_scheduler = RequestScheduler(per_second=5, lanes={
+    # lane: (weight, max requests in flight)
+    LANE_INTERACTIVE: (8, 5),
+    LANE_REFRESH: (3, 3),
+    LANE_BACKFILL: (1, 2),
+})
+
+
+def cf_ratelimit(f):
+    tries = 3
+
+    @functools.wraps(f)
+    async def wrapped(*args, **kwargs):
+        lane = _request_lane.get()
+        for i in range(tries):
             try:
-                return await f(*args, **kwargs)
+                async with request_scheduler.slot(lane):
+                    return await f(*args, **kwargs)
             except (ClientError, CallLimitExceededError) as e:
                 logger.info(f'Try {i+1}/{tries} at query failed.')
                 logger.info(repr(e))
@@ -240,8 +382,51 @@ def cf_ratelimit(f):
     return wrapped
 
 
-@cf_ratelimit
+# Seconds for which a successful response is reused by identical queries. Queries to other
+# endpoints are only shared while they are in flight.
+_RESPONSE_TTL = {
+    'contest.ratingChanges': 60,
+    'user.info': 30,
+    'user.rating': 60,
+}
+
+_in_flight = {}
+_response_cache = {}
+
+
 async def _query_api(path, params=None):
+    """Queries the API. Concurrent identical queries share one request, and responses from some
+    endpoints are reused for a short while. The returned result must not be modified."""
+    key = (path, tuple(sorted((params or {}).items())))
+    cached = _response_cache.get(key)
+    if cached is not None:
+        expiry, result = cached
+        if time.time() < expiry:
+            return result
+        del _response_cache[key]
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_request_api(path, params))
+        future.add_done_callback(functools.partial(_on_query_done, key, path))
+        _in_flight[key] = future
+    # Shielded so that a cancelled caller does not cancel the request for the others.
+    return await asyncio.shield(future)
+
+
+def _on_query_done(key, path, future):
+    del _in_flight[key]
+    if future.cancelled() or future.exception() is not None:
+        return
+    ttl = _RESPONSE_TTL.get(path)
+    if ttl:
+        now = time.time()
+        for expired_key in [k for k, (expiry, _) in _response_cache.items() if expiry <= now]:
+            del _response_cache[expired_key]
+        _response_cache[key] = (now + ttl, future.result())
+
+
+@cf_ratelimit
+async def _request_api(path, params=None):
     url = API_BASE_URL + path
     try:
         logger.info(f'Querying CF API at {url} with {params}')
@@ -259,10 +444,146 @@ async def _query_api(path, params=None):
     except aiohttp.ClientError as e:
         logger.error(f'Request to CF API encountered error: {e!r}')
         raise ClientError from e
+    raise _api_error(comment)
+
+
+def _api_error(comment):
     logger.warning(f'Query to CF API failed: {comment}')
     if 'limit exceeded' in comment:
-        raise CallLimitExceededError(comment)
-    raise TrueApiError(comment)
+        return CallLimitExceededError(comment)
+    return TrueApiError(comment)
+
+
+_JSON_WHITESPACE = ' \t\n\r'
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _JsonStreamReader:
+    """Decodes a JSON document incrementally from an aiohttp stream. Objects and arrays walked
+    through with `object_keys` and `array_values` are decoded piece by piece, anything read with
+    `value` is decoded whole. Only the unread part of the current chunk is kept in memory."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    async def _fill(self):
+        if self._eof:
+            raise ValueError('Unexpected end of JSON stream')
+        chunk = await self._stream.read(_STREAM_CHUNK_SIZE)
+        self._eof = not chunk
+        text = self._text_decoder.decode(chunk, final=self._eof)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+    async def _peek(self):
+        """Skips whitespace and returns the next character."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _JSON_WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            await self._fill()
+
+    async def _expect(self, chars):
+        char = await self._peek()
+        if char not in chars:
+            raise ValueError(f'Expected one of {chars!r} in JSON stream, found {char!r}')
+        self._pos += 1
+        return char
+
+    async def value(self):
+        """Decodes the next value as a whole."""
+        await self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                await self._fill()
+                continue
+            if end == len(self._buf) and not self._eof:
+                # A number at the end of the buffer may continue in the next chunk.
+                await self._fill()
+                continue
+            self._pos = end
+            return value
+
+    async def object_keys(self):
+        """Iterates over the keys of the next object. The value of each key must be read before
+        advancing to the next key."""
+        await self._expect('{')
+        if await self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = await self.value()
+            await self._expect(':')
+            yield key
+            if await self._expect(',}') == '}':
+                return
+
+    async def array_values(self):
+        """Iterates over the elements of the next array, decoding each as a whole."""
+        await self._expect('[')
+        if await self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield await self.value()
+            if await self._expect(',]') == ']':
+                return
+
+
+@contextlib.asynccontextmanager
+async def _stream_api(path, params=None):
+    """Like `_query_api`, but yields a `_JsonStreamReader` positioned at the result instead of
+    decoding the whole response at once. The request slot is held until the caller is done. Queries
+    are retried only if they fail before the result is reached."""
+    url = API_BASE_URL + path
+    lane = _request_lane.get()
+    tries = 3
+    for i in range(tries):
+        streaming = False
+        try:
+            async with request_scheduler.slot(lane):
+                logger.info(f'Streaming from CF API at {url} with {params}')
+                headers = {'Accept-Encoding': 'gzip'}
+                async with _session.get(url, params=params, headers=headers) as resp:
+                    if resp.status != 200:
+                        try:
+                            respjson = await resp.json()
+                        except aiohttp.ContentTypeError:
+                            logger.warning(f'CF API did not respond with JSON, status {resp.status}.')
+                            raise CodeforcesApiError
+                        raise _api_error(f'HTTP Error {resp.status}, {respjson.get("comment")}')
+                    reader = _JsonStreamReader(resp.content)
+                    async for key in reader.object_keys():
+                        if key == 'result':
+                            break
+                        await reader.value()
+                    else:
+                        raise CodeforcesApiError('Codeforces API response has no result')
+                    streaming = True
+                    yield reader
+                    return
+        except aiohttp.ClientError as e:
+            logger.error(f'Request to CF API encountered error: {e!r}')
+            error = ClientError()
+            error.__cause__ = e
+        except ValueError as e:
+            logger.warning(f'CF API responded with malformed JSON: {e!r}')
+            raise CodeforcesApiError from e
+        except CallLimitExceededError as e:
+            error = e
+        if streaming or i == tries - 1:
+            raise error
+        logger.info(f'Try {i+1}/{tries} at streaming query failed, retrying...')
 
 
 class contest:
@@ -309,16 +630,61 @@ class contest:
             raise
         contest_ = make_from_dict(Contest, resp['contest'])
         problems = [make_from_dict(Problem, problem_dict) for problem_dict in resp['problems']]
-        for row in resp['rows']:
-            row['party']['members'] = [make_from_dict(Member, member)
-                                       for member in row['party']['members']]
-            row['party'] = make_from_dict(Party, row['party'])
-            row['problemResults'] = [make_from_dict(ProblemResult, problem_result)
-                                     for problem_result in row['problemResults']]
-        ranklist = [make_from_dict(RanklistRow, row_dict) for row_dict in resp['rows']]
+        ranklist = [_make_ranklist_row(row_dict) for row_dict in resp['rows']]
         return contest_, problems, ranklist
 
 
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def standings_stream(*, contest_id, from_=None, count=None, handles=None, room=None,
+                               show_unofficial=None):
+        """Like `standings`, but yields the contest, its problems and an async iterator over
+        ranklist rows which are decoded while they are being downloaded. Use as
+        `async with cf.contest.standings_stream(...) as (contest, problems, rows)`."""
+        params = {'contestId': contest_id}
+        if from_ is not None:
+            params['from'] = from_
+        if count is not None:
+            params['count'] = count
+        if handles is not None:
+            params['handles'] = ';'.join(handles)
+        if room is not None:
+            params['room'] = room
+        if show_unofficial is not None:
+            params['showUnofficial'] = _bool_to_str(show_unofficial)
+        try:
+            async with _stream_api('contest.standings', params) as reader:
+                async def stream_rows():
+                    async for row_dict in reader.array_values():
+                        yield _make_ranklist_row(row_dict)
+
+                contest_, problems, buffered_rows = None, None, None
+                async for key in reader.object_keys():
+                    if key == 'rows' and contest_ is not None and problems is not None:
+                        yield contest_, problems, stream_rows()
+                        return
+                    if key == 'rows':
+                        # Rows came before the header, there is no choice but to buffer them.
+                        buffered_rows = [row async for row in stream_rows()]
+                    elif key == 'contest':
+                        contest_ = make_from_dict(Contest, await reader.value())
+                    elif key == 'problems':
+                        problems = [make_from_dict(Problem, problem_dict)
+                                    for problem_dict in await reader.value()]
+                    else:
+                        await reader.value()
+
+                async def iter_buffered_rows():
+                    for row in buffered_rows or []:
+                        yield row
+
+                yield contest_, problems, iter_buffered_rows()
+        except TrueApiError as e:
+            if 'not found' in e.comment:
+                raise ContestNotFoundError(e.comment, contest_id)
+            raise
+
+
 class problemset:
     @staticmethod
     async def problems(*, tags=None, problemset_name=None):
@@ -377,6 +743,16 @@ class user:
         resp = await _query_api('user.ratedList', params=params)
         return [make_from_dict(User, user_dict) for user_dict in resp]
 
+    @staticmethod
+    async def ratedList_stream(*, activeOnly=None):
+        """Like `ratedList`, but yields users while the list is being downloaded."""
+        params = {}
+        if activeOnly is not None:
+            params['activeOnly'] = _bool_to_str(activeOnly)
+        async with _stream_api('user.ratedList', params=params) as reader:
+            async for user_dict in reader.array_values():
+                yield make_from_dict(User, user_dict)
+
     @staticmethod
     async def status(*, handle, from_=None, count=None):
         params = {'handle': handle}
@@ -392,9 +768,7 @@ class user:
             if 'should contain' in e.comment:
                 raise HandleInvalidError(e.comment, handle)
             raise
-        for submission in resp:
-            submission['problem'] = make_from_dict(Problem, submission['problem'])
-            submission['author']['members'] = [make_from_dict(Member, member)
-                                               for member in submission['author']['members']]
-            submission['author'] = make_from_dict(Party, submission['author'])
-        return [make_from_dict(Submission, submission_dict) for submission_dict in resp]
+        return [make_from_dict(Submission, {**submission_dict,
+                                            'problem': make_from_dict(Problem, submission_dict['problem']),
+                                            'author': _make_party(submission_dict['author'])})
+                for submission_dict in resp]
@@ -5,7 +5,6 @@ import math
 import time
 import datetime
 from collections import defaultdict
-import itertools
 from discord.ext import commands
 import discord
 
@@ -115,20 +114,27 @@ async def get_visited_contests(handles : [str]):
     """ Returns a set of contest ids of contests that any of the given handles
         has at least one non-CE submission.
     """
-    user_submissions = [await cf.user.status(handle=handle) for handle in handles]
     problem_to_contests = cache2.problemset_cache.problem_to_contests
 
-    contest_ids = []
-    for sub in itertools.chain.from_iterable(user_submissions):
-        if sub.verdict == 'COMPILATION_ERROR':
-            continue
-        try:
-            contest = cache2.contest_cache.get_contest(sub.problem.contestId)
-            problem_id = (sub.problem.name, contest.startTimeSeconds)
-            contest_ids += problem_to_contests[problem_id]
-        except cache_system2.ContestNotFound:
-            pass
-    return set(contest_ids)
+    def visited_contests(submissions):
+        contest_ids = set()
+        for sub in submissions:
+            if sub.verdict == 'COMPILATION_ERROR':
+                continue
+            try:
+                contest = cache2.contest_cache.get_contest(sub.problem.contestId)
+                problem_id = (sub.problem.name, contest.startTimeSeconds)
+                contest_ids.update(problem_to_contests.get(problem_id, ()))
+            except cache_system2.ContestNotFound:
+                pass
+        return contest_ids
+
+    # Memoized per handle until its submissions or the problemsets change.
+    contest_ids = set()
+    for handle in handles:
+        contest_ids |= await cache2.submission_cache.get_derived(
+            handle, 'visited_contests', problem_to_contests, visited_contests)
+    return contest_ids
 
 # These are special rated-for-all contests which have a combined ranklist for onsite and online
 # participants. The onsite participants have their submissions marked as out of competition. Just
@@ -244,9 +250,10 @@ async def resolve_handles(ctx, converter, handles, *, mincnt=1, maxcnt=5, defaul
     return resolved_handles
 
 def members_to_handles(members: [discord.Member], guild_id):
+    handle_by_member_id = user_db.get_handles([member.id for member in members], guild_id)
     handles = []
     for member in members:
-        handle = user_db.get_handle(member.id, guild_id)
+        handle = handle_by_member_id.get(member.id)
         if handle is None:
             raise HandleNotRegisteredError(member)
         handles.append(handle)
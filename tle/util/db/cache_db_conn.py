@@ -1,13 +1,22 @@
 import json
-import sqlite3
+import time
 
 from tle.util import codeforces_api as cf
+from tle.util.db.sqlite_conn import SqliteConn
 
 
-class CacheDbConn:
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
+class CacheDbConn(SqliteConn):
+    # Secondary indexes by table, as (name, columns) pairs. These are dropped during bulk loads.
+    _SECONDARY_INDEXES = {
+        'rating_change': [('ix_rating_change_contest_id', 'contest_id'),
+                          ('ix_rating_change_handle', 'handle')],
+        'problem2': [('ix_problem2_contest_id', 'contest_id')],
+    }
+
+    def __init__(self, db_file, **kwargs):
+        super().__init__(db_file, **kwargs)
         self.create_tables()
+        self._populate_handle_rating()
 
     def create_tables(self):
         # Table for contests from the contest.list endpoint.
@@ -51,10 +60,19 @@ class CacheDbConn:
             'UNIQUE (contest_id, handle)'
             ')'
         )
-        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_contest_id '
-                          'ON rating_change (contest_id)')
-        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_rating_change_handle '
-                          'ON rating_change (handle)')
+        self.create_secondary_indexes('rating_change')
+
+        # Latest rating of every handle in rating_change, maintained along with it.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS handle_rating ('
+            'handle        TEXT NOT NULL,'
+            'contest_id    INTEGER,'
+            'rating        INTEGER,'
+            'update_time   INTEGER,'
+            'num_contests  INTEGER,'
+            'PRIMARY KEY (handle)'
+            ')'
+        )
 
         # Table for problems fetched from contest.standings endpoint for every contest.
         # This is separate from table problem as it contains the same problem twice if it
@@ -72,8 +90,87 @@ class CacheDbConn:
             'PRIMARY KEY (contest_id, [index])'
             ')'
         )
-        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_problem2_contest_id '
-                          'ON problem2 (contest_id)')
+        self.create_secondary_indexes('problem2')
+
+        # Table for submissions fetched from the user.status endpoint, stored per handle.
+        # Handles are stored in lowercase since Codeforces handles are case insensitive.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS submission ('
+            'handle                TEXT NOT NULL,'
+            'id                    INTEGER NOT NULL,'
+            'contest_id            INTEGER,'
+            'problem               TEXT,'
+            'author                TEXT,'
+            'programming_language  TEXT,'
+            'verdict               TEXT,'
+            'creation_time         INTEGER,'
+            'relative_time         INTEGER,'
+            'PRIMARY KEY (handle, id)'
+            ')'
+        )
+        # Time of the last full (non-incremental) fetch of submissions for every handle.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS submission_sync ('
+            'handle          TEXT NOT NULL,'
+            'last_full_sync  INTEGER,'
+            'PRIMARY KEY (handle)'
+            ')'
+        )
+
+        # Progress of interrupted bulk loads, so that they can be resumed.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS bulk_load_checkpoint ('
+            'name             TEXT NOT NULL,'
+            'last_contest_id  INTEGER,'
+            'update_time      INTEGER,'
+            'PRIMARY KEY (name)'
+            ')'
+        )
+
+        # Effective ratings of all users from the user.ratedList endpoint, replaced as a whole on
+        # every fetch. The time of the fetch is kept in the single row of user_rating_fetch.
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_rating ('
+            'handle  TEXT NOT NULL,'
+            'rating  INTEGER,'
+            'PRIMARY KEY (handle)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_rating_fetch ('
+            'id          INTEGER NOT NULL CHECK (id = 0),'
+            'fetch_time  INTEGER,'
+            'PRIMARY KEY (id)'
+            ')'
+        )
+
+    def create_secondary_indexes(self, table):
+        for name, columns in self._SECONDARY_INDEXES[table]:
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+        self.conn.commit()
+
+    def drop_secondary_indexes(self, table):
+        for name, _ in self._SECONDARY_INDEXES[table]:
+            self.conn.execute(f'DROP INDEX IF EXISTS {name}')
+        self.conn.commit()
+
+    def get_bulk_load_checkpoint(self, name):
+        query = 'SELECT last_contest_id FROM bulk_load_checkpoint WHERE name = ?'
+        res = self.conn.execute(query, (name,)).fetchone()
+        return res[0] if res else None
+
+    def clear_bulk_load_checkpoint(self, name):
+        self.conn.execute('DELETE FROM bulk_load_checkpoint WHERE name = ?', (name,))
+        self.conn.commit()
+
+    def _save_bulk_load_checkpoint(self, checkpoint):
+        if checkpoint is None:
+            return
+        name, last_contest_id = checkpoint
+        query = ('INSERT OR REPLACE INTO bulk_load_checkpoint '
+                 '(name, last_contest_id, update_time) '
+                 'VALUES (?, ?, ?)')
+        self.conn.execute(query, (name, last_contest_id, int(time.time())))
 
     def cache_contests(self, contests):
         query = ('INSERT OR REPLACE INTO contest '
@@ -113,7 +210,34 @@ class CacheDbConn:
         res = self.conn.execute(query).fetchall()
         return list(map(self._unsquish_tags, res))
 
+    _RECOMPUTE_HANDLE_RATING_QUERY = (
+        'INSERT OR REPLACE INTO handle_rating '
+        '(handle, contest_id, rating, update_time, num_contests) '
+        # SQLite takes bare columns from the row with the maximum when MAX is used.
+        'SELECT handle, contest_id, new_rating, MAX(rating_update_time), COUNT(*) '
+        'FROM rating_change '
+    )
+
+    def _populate_handle_rating(self):
+        """Builds handle_rating from rating_change if it is missing, as for a database
+        created before the table existed."""
+        if (self.conn.execute('SELECT 1 FROM handle_rating LIMIT 1').fetchone() is not None or
+                self.conn.execute('SELECT 1 FROM rating_change LIMIT 1').fetchone() is None):
+            return
+        self.conn.execute(self._RECOMPUTE_HANDLE_RATING_QUERY + 'GROUP BY handle')
+        self.conn.commit()
+
+    def _recompute_handle_rating(self, handles):
+        """Recomputes handle_rating for the given handles from rating_change. Handles left
+        without changes are removed."""
+        handles = [(handle,) for handle in handles]
+        self.conn.executemany('DELETE FROM handle_rating WHERE handle = ?', handles)
+        self.conn.executemany(self._RECOMPUTE_HANDLE_RATING_QUERY +
+                              'WHERE handle = ? GROUP BY handle', handles)
+
     def save_rating_changes(self, changes):
+        """Saves rating changes and recomputes handle_rating for their handles, so that saving
+        the changes of a contest again does not count it twice."""
         change_tuples = [(change.contestId,
                           change.handle,
                           change.rank,
@@ -124,16 +248,57 @@ class CacheDbConn:
                  '(contest_id, handle, rank, rating_update_time, old_rating, new_rating) '
                  'VALUES (?, ?, ?, ?, ?, ?)')
         rc = self.conn.executemany(query, change_tuples).rowcount
+        self._recompute_handle_rating({change.handle for change in changes})
         self.conn.commit()
         return rc
 
+    def bulk_save_rating_changes(self, changes, *, checkpoint=None):
+        """Upserts rating changes, writing only rows that are new or differ from the saved ones,
+        and records `checkpoint`, a (name, last contest id) pair, in the same transaction.
+        handle_rating is not maintained, call `rebuild_handle_rating` or `update_handle_rating`
+        when done."""
+        change_tuples = [(change.contestId,
+                          change.handle,
+                          change.rank,
+                          change.ratingUpdateTimeSeconds,
+                          change.oldRating,
+                          change.newRating) for change in changes]
+        query = ('INSERT INTO rating_change '
+                 '(contest_id, handle, rank, rating_update_time, old_rating, new_rating) '
+                 'VALUES (?, ?, ?, ?, ?, ?) '
+                 'ON CONFLICT (contest_id, handle) DO UPDATE SET '
+                 'rank = excluded.rank, '
+                 'rating_update_time = excluded.rating_update_time, '
+                 'old_rating = excluded.old_rating, '
+                 'new_rating = excluded.new_rating '
+                 'WHERE rank IS NOT excluded.rank '
+                 'OR rating_update_time IS NOT excluded.rating_update_time '
+                 'OR old_rating IS NOT excluded.old_rating '
+                 'OR new_rating IS NOT excluded.new_rating')
+        with self.conn:
+            rc = self.conn.executemany(query, change_tuples).rowcount
+            self._save_bulk_load_checkpoint(checkpoint)
+        return rc
+
+    def rebuild_handle_rating(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM handle_rating')
+            self.conn.execute(self._RECOMPUTE_HANDLE_RATING_QUERY + 'GROUP BY handle')
+
+    def update_handle_rating(self, handles):
+        with self.conn:
+            self._recompute_handle_rating(handles)
+
     def clear_rating_changes(self, contest_id=None):
         if contest_id is None:
-            query = 'DELETE FROM rating_change'
-            self.conn.execute(query)
+            self.conn.execute('DELETE FROM rating_change')
+            self.conn.execute('DELETE FROM handle_rating')
         else:
+            query = 'SELECT handle FROM rating_change WHERE contest_id = ?'
+            handles = [handle for handle, in self.conn.execute(query, (contest_id,))]
             query = 'DELETE FROM rating_change WHERE contest_id = ?'
             self.conn.execute(query, (contest_id,))
+            self._recompute_handle_rating(handles)
         self.conn.commit()
 
     def get_users_with_more_than_n_contests(self, time_cutoff, n):
@@ -143,6 +308,13 @@ class CacheDbConn:
         res = self.conn.execute(query, (n, time_cutoff,)).fetchall()
         return [user[0] for user in res]
 
+    def get_latest_rating_by_handle(self):
+        """Returns (handle, contest id, new rating, rating update time, number of contests) for
+        every handle, taken from its latest rating change."""
+        query = ('SELECT handle, contest_id, rating, update_time, num_contests '
+                 'FROM handle_rating')
+        return self.conn.execute(query).fetchall()
+
     def get_all_rating_changes(self):
         query = ('SELECT contest_id, name, handle, rank, rating_update_time, old_rating, new_rating '
                  'FROM rating_change r '
@@ -185,6 +357,30 @@ class CacheDbConn:
         self.conn.commit()
         return rc
 
+    def bulk_save_problemset(self, problemset, *, checkpoint=None):
+        """Upserts problems, writing only rows that are new or differ from the saved ones, and
+        records `checkpoint`, a (name, last contest id) pair, in the same transaction."""
+        query = ('INSERT INTO problem2 '
+                 '(contest_id, problemset_name, [index], name, type, points, rating, tags) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                 'ON CONFLICT (contest_id, [index]) DO UPDATE SET '
+                 'problemset_name = excluded.problemset_name, '
+                 'name = excluded.name, '
+                 'type = excluded.type, '
+                 'points = excluded.points, '
+                 'rating = excluded.rating, '
+                 'tags = excluded.tags '
+                 'WHERE problemset_name IS NOT excluded.problemset_name '
+                 'OR name IS NOT excluded.name '
+                 'OR type IS NOT excluded.type '
+                 'OR points IS NOT excluded.points '
+                 'OR rating IS NOT excluded.rating '
+                 'OR tags IS NOT excluded.tags')
+        with self.conn:
+            rc = self.conn.executemany(query, list(map(self._squish_tags, problemset))).rowcount
+            self._save_bulk_load_checkpoint(checkpoint)
+        return rc
+
     def fetch_problems2(self):
         query = ('SELECT contest_id, problemset_name, [index], name, type, points, rating, tags '
                  'FROM problem2 ')
@@ -211,5 +407,78 @@ class CacheDbConn:
         res = self.conn.execute(query).fetchone()
         return res is None
 
-    def close(self):
-        self.conn.close()
+    def save_user_ratings(self, rating_by_handle, fetch_time):
+        """Replaces the saved effective ratings of all users."""
+        with self.conn:
+            self.conn.execute('DELETE FROM user_rating')
+            rc = self.conn.executemany('INSERT INTO user_rating (handle, rating) VALUES (?, ?)',
+                                       rating_by_handle.items()).rowcount
+            self.conn.execute('INSERT OR REPLACE INTO user_rating_fetch (id, fetch_time) '
+                              'VALUES (0, ?)', (int(fetch_time),))
+        return rc
+
+    def fetch_user_ratings(self):
+        """Returns the time of the last saved fetch of user ratings and a dict of handle to
+        effective rating, or None and an empty dict if none was saved."""
+        res = self.conn.execute('SELECT fetch_time FROM user_rating_fetch').fetchone()
+        if res is None:
+            return None, {}
+        rating_by_handle = dict(self.conn.execute('SELECT handle, rating FROM user_rating'))
+        return res[0], rating_by_handle
+
+    @staticmethod
+    def _squish_submission(handle, submission):
+        author = submission.author._asdict()
+        author['members'] = [member.handle for member in submission.author.members]
+        return (handle, submission.id, submission.contestId,
+                json.dumps(submission.problem._asdict()), json.dumps(author),
+                submission.programmingLanguage, submission.verdict,
+                submission.creationTimeSeconds, submission.relativeTimeSeconds)
+
+    @staticmethod
+    def _unsquish_submission(submission):
+        id_, contest_id, problem, author, language, verdict, creation_time, relative_time = submission
+        problem = cf.make_from_dict(cf.Problem, json.loads(problem))
+        author = json.loads(author)
+        author['members'] = [cf.Member(handle) for handle in author['members']]
+        author = cf.make_from_dict(cf.Party, author)
+        return cf.Submission(id_, contest_id, problem, author, language, verdict, creation_time,
+                             relative_time)
+
+    def save_submissions(self, handle, submissions, *, full_sync=False):
+        """Saves submissions of a handle. If `full_sync` is set, `submissions` is the complete
+        list of submissions of the handle and replaces any saved earlier."""
+        query = ('INSERT OR REPLACE INTO submission '
+                 '(handle, id, contest_id, problem, author, programming_language, verdict, '
+                 'creation_time, relative_time) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        submission_tuples = [self._squish_submission(handle, submission)
+                             for submission in submissions]
+        with self.conn:
+            if full_sync:
+                self.conn.execute('DELETE FROM submission WHERE handle = ?', (handle,))
+                self.conn.execute('INSERT OR REPLACE INTO submission_sync (handle, last_full_sync) '
+                                  'VALUES (?, ?)', (handle, int(time.time())))
+            rc = self.conn.executemany(query, submission_tuples).rowcount
+        return rc
+
+    def get_submission_sync_state(self, handle):
+        """Returns the time of the last full sync of the handle, the largest saved submission id
+        and the smallest saved submission id that does not have a final verdict yet."""
+        query = 'SELECT last_full_sync FROM submission_sync WHERE handle = ?'
+        res = self.conn.execute(query, (handle,)).fetchone()
+        last_full_sync = res[0] if res else None
+        query = ('SELECT MAX(id), '
+                 'MIN(CASE WHEN verdict IS NULL OR verdict = \'TESTING\' THEN id END) '
+                 'FROM submission WHERE handle = ?')
+        max_id, first_unsettled_id = self.conn.execute(query, (handle,)).fetchone()
+        return last_full_sync, max_id, first_unsettled_id
+
+    def fetch_submissions(self, handle):
+        query = ('SELECT id, contest_id, problem, author, programming_language, verdict, '
+                 'creation_time, relative_time '
+                 'FROM submission '
+                 'WHERE handle = ? '
+                 'ORDER BY id DESC')
+        res = self.conn.execute(query, (handle,)).fetchall()
+        return [self._unsquish_submission(submission) for submission in res]
@@ -0,0 +1,102 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Pragmas applied to every connection. Each can be overridden with an environment variable named
+# TLE_DB_<PRAGMA>, such as TLE_DB_SYNCHRONOUS=FULL.
+_DEFAULT_PRAGMAS = {
+    # WAL lets reads proceed while the database thread is writing.
+    'journal_mode': 'WAL',
+    # With WAL, NORMAL is safe against corruption and only risks the last transactions on a
+    # power loss.
+    'synchronous': 'NORMAL',
+    # Negative values are in KiB.
+    'cache_size': '-16000',
+}
+# Seconds to wait for a lock held by another connection. Connections on the database thread can
+# afford to wait, while those on other threads, such as the event loop, give up soon so as not to
+# freeze the bot while the database thread is writing.
+_BUSY_TIMEOUT = 30
+_OFF_DB_THREAD_BUSY_TIMEOUT = 1
+
+
+def _pragmas_from_environ():
+    return {pragma: os.environ.get(f'TLE_DB_{pragma.upper()}', value)
+            for pragma, value in _DEFAULT_PRAGMAS.items()}
+
+
+class _AsyncMethods:
+    """Exposes the methods of a connection as coroutine functions which run them on the
+    database thread."""
+
+    def __init__(self, db_conn):
+        self._db_conn = db_conn
+
+    def __getattr__(self, name):
+        method = getattr(self._db_conn, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+
+        async def run(*args, **kwargs):
+            return await self._db_conn.run_on_db_thread(method, *args, **kwargs)
+
+        return run
+
+
+class SqliteConn:
+    """Base class for the database connections of the bot.
+
+    Every thread gets its own sqlite3 connection through the `conn` property, so methods can be
+    called directly from the event loop as before, or through `aio` to run them on a dedicated
+    database thread without blocking the loop, as in `await db_conn.aio.cache_problems(...)`.
+    Writes should use `aio`, connections on other threads only wait `_OFF_DB_THREAD_BUSY_TIMEOUT`
+    seconds for a write on the database thread to finish. There is a single database thread, so
+    writes made through `aio` are serialized.
+    """
+
+    def __init__(self, db_file, *, pragmas=None):
+        self.db_file = db_file
+        self.pragmas = _pragmas_from_environ()
+        self.pragmas.update(pragmas or {})
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix=self.__class__.__name__,
+                                            initializer=self._init_db_thread)
+        self.aio = _AsyncMethods(self)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _init_db_thread(self):
+        self._local.on_db_thread = True
+
+    def _connect(self):
+        on_db_thread = getattr(self._local, 'on_db_thread', False)
+        timeout = _BUSY_TIMEOUT if on_db_thread else _OFF_DB_THREAD_BUSY_TIMEOUT
+        conn = sqlite3.connect(self.db_file, timeout=timeout)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    async def run_on_db_thread(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(fn, *args, **kwargs))
+
+    def _close_thread_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close(self):
+        self._executor.submit(self._close_thread_conn).result()
+        self._executor.shutdown()
+        self._close_thread_conn()
@@ -1,11 +1,13 @@
-import sqlite3
+import logging
 from enum import IntEnum
 from collections import namedtuple
 
 from discord.ext import commands
 
 from tle.util import codeforces_api as cf
+from tle.util.db.sqlite_conn import SqliteConn
 
+logger = logging.getLogger(__name__)
 _DEFAULT_VC_RATING = 1500
 
 class Gitgud(IntEnum):
@@ -60,11 +62,134 @@ def namedtuple_factory(cursor, row):
     return Row(*row)
 
 
-class UserDbConn:
-    def __init__(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
-        self.conn.row_factory = namedtuple_factory
+# Schema migrations, applied in order at startup. The number of migrations applied so far is kept
+# in the user_version pragma of the database. Only append to this list.
+_MIGRATIONS = [
+    # Indexes for the lookups made by most commands.
+    [
+        'CREATE INDEX IF NOT EXISTS ix_user_handle_guild_active '
+        'ON user_handle (guild_id, active, handle, user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_duel_challenger_status ON duel (challenger, status)',
+        'CREATE INDEX IF NOT EXISTS ix_duel_challengee_status ON duel (challengee, status)',
+        'CREATE INDEX IF NOT EXISTS ix_duel_status_start_time ON duel (status, start_time)',
+        'CREATE INDEX IF NOT EXISTS ix_challenge_user_id_status ON challenge (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS ix_rated_vcs_status ON rated_vcs (status)',
+        'CREATE INDEX IF NOT EXISTS ix_rated_vc_users_user_id '
+        'ON rated_vc_users (user_id, vc_id, rating)',
+    ],
+]
+
+# Queries run on almost every command. check_query_plans verifies that none of them scans a table.
+_GET_GUILD_HANDLES_QUERY = ('SELECT user_id, handle, active '
+                            'FROM user_handle '
+                            'WHERE guild_id = ?')
+_CACHE_CF_USER_QUERY = ('INSERT OR REPLACE INTO cf_user_cache '
+                        '(handle, first_name, last_name, country, city, organization, '
+                        '    contribution, rating, last_online_time, registration_time, '
+                        '    friend_of_count, title_photo) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+_FETCH_CF_USER_QUERY = ('SELECT handle, first_name, last_name, country, city, organization, '
+                        '    contribution, rating, last_online_time, registration_time, '
+                        '    friend_of_count, title_photo '
+                        'FROM cf_user_cache '
+                        'WHERE handle = ?')
+_FETCH_CF_USERS_QUERY = ('SELECT handle, first_name, last_name, country, city, organization, '
+                         '    contribution, rating, last_online_time, registration_time, '
+                         '    friend_of_count, title_photo '
+                         'FROM cf_user_cache '
+                         'WHERE handle IN ({})')
+# Keeps the number of parameters of a query under the limit of older SQLite versions.
+_MAX_PARAMS_PER_QUERY = 500
+_ACTIVE_CHALLENGE_QUERY = ('SELECT active_challenge_id, issue_time '
+                           'FROM user_challenge '
+                           'WHERE user_id = ?')
+_CHALLENGE_BY_ID_QUERY = ('SELECT problem_name, contest_id, p_index, rating_delta '
+                          'FROM challenge '
+                          'WHERE id = ?')
+_GET_NOGUDS_QUERY = ('SELECT problem_name '
+                     'FROM challenge '
+                     f'WHERE user_id = ? AND status = {Gitgud.NOGUD}')
+_CHECK_DUEL_CHALLENGE_QUERY = ('SELECT id FROM duel '
+                               'WHERE (challengee = ? OR challenger = ?) '
+                               f'AND (status == {Duel.ONGOING} OR status == {Duel.PENDING})')
+_CHECK_DUEL_ACCEPT_QUERY = ('SELECT id, challenger, problem_name FROM duel '
+                            f'WHERE challengee = ? AND status == {Duel.PENDING}')
+_CHECK_DUEL_DECLINE_QUERY = ('SELECT id, challenger FROM duel '
+                             f'WHERE challengee = ? AND status == {Duel.PENDING}')
+_CHECK_DUEL_WITHDRAW_QUERY = ('SELECT id, challengee FROM duel '
+                              f'WHERE challenger = ? AND status == {Duel.PENDING}')
+_CHECK_DUEL_DRAW_QUERY = ('SELECT id, challenger, challengee, start_time, type FROM duel '
+                          f'WHERE (challenger = ? OR challengee = ?) AND status == {Duel.ONGOING}')
+_CHECK_DUEL_COMPLETE_QUERY = ('SELECT id, challenger, challengee, start_time, problem_name, '
+                              '    contest_id, p_index, type FROM duel '
+                              f'WHERE (challenger = ? OR challengee = ?) AND status == {Duel.ONGOING}')
+_GET_DUEL_PROBLEM_NAMES_QUERY = ('SELECT problem_name FROM duel '
+                                 'WHERE (challengee = ? OR challenger = ?) '
+                                 f'AND (status == {Duel.COMPLETE} OR status == {Duel.INVALID})')
+_IS_DUELIST_QUERY = 'SELECT 1 FROM duelist WHERE user_id = ?'
+
+_HOT_QUERIES = [
+    _GET_GUILD_HANDLES_QUERY,
+    _FETCH_CF_USER_QUERY,
+    _ACTIVE_CHALLENGE_QUERY,
+    _CHALLENGE_BY_ID_QUERY,
+    _GET_NOGUDS_QUERY,
+    _CHECK_DUEL_CHALLENGE_QUERY,
+    _CHECK_DUEL_ACCEPT_QUERY,
+    _CHECK_DUEL_DECLINE_QUERY,
+    _CHECK_DUEL_WITHDRAW_QUERY,
+    _CHECK_DUEL_DRAW_QUERY,
+    _CHECK_DUEL_COMPLETE_QUERY,
+    _GET_DUEL_PROBLEM_NAMES_QUERY,
+    _IS_DUELIST_QUERY,
+]
+
+
+class _GuildHandles:
+    """Handles set in a guild, mirroring its rows of user_handle. User ids are strings as in the
+    table."""
+
+    def __init__(self, rows):
+        self.handle_by_user_id = {}
+        self.active_by_user_id = {}
+        self.user_id_by_handle = {}
+        for user_id, handle, active in rows:
+            self.set(user_id, handle, active)
+
+    def set(self, user_id, handle, active):
+        self.remove(user_id)
+        # Like the INSERT OR REPLACE into user_handle, replaces whoever had the handle.
+        self.remove(self.user_id_by_handle.get(handle))
+        self.handle_by_user_id[user_id] = handle
+        self.active_by_user_id[user_id] = active
+        self.user_id_by_handle[handle] = user_id
+
+    def remove(self, user_id):
+        handle = self.handle_by_user_id.pop(user_id, None)
+        self.active_by_user_id.pop(user_id, None)
+        if handle is not None:
+            del self.user_id_by_handle[handle]
+
+
+class UserDbConn(SqliteConn):
+    def __init__(self, dbfile, **kwargs):
+        super().__init__(dbfile, **kwargs)
+        # Read-through caches of user_handle by guild id and of cf_user_cache by handle. All
+        # writes to these tables go through this class and update them.
+        self._handles_by_guild = {}
+        self._cf_user_by_handle = {}
+        # Bumped on every write to these tables, so that anything derived from them can be
+        # cached until then.
+        self.version = 0
         self.create_tables()
+        self.migrate()
+        for query, plan in self.check_query_plans():
+            logger.warning(f'Query scans a table, it may be missing an index: {query!r} {plan}')
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.row_factory = namedtuple_factory
+        return conn
 
     def create_tables(self):
         self.conn.execute(
@@ -208,6 +333,28 @@ class UserDbConn:
             )
         ''')
 
+    def migrate(self):
+        """Applies the schema migrations that are not yet applied to the database."""
+        version, = self.conn.execute('PRAGMA user_version').fetchone()
+        for new_version, statements in enumerate(_MIGRATIONS[version:], start=version + 1):
+            with self.conn:
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(f'PRAGMA user_version = {new_version}')
+            logger.info(f'User database migrated to version {new_version}')
+
+    def check_query_plans(self):
+        """Returns (query, plan) pairs for the hot queries whose plan scans a table or a whole
+        index instead of searching it."""
+        regressions = []
+        for query in _HOT_QUERIES:
+            params = (0,) * query.count('?')
+            rows = self.conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()
+            plan = [row[-1] for row in rows]
+            if any(detail.startswith('SCAN') for detail in plan):
+                regressions.append((query, plan))
+        return regressions
+
 
     # Helper functions.
 
@@ -271,18 +418,10 @@ class UserDbConn:
         return 1
 
     def check_challenge(self, user_id):
-        query1 = '''
-            SELECT active_challenge_id, issue_time FROM user_challenge
-            WHERE user_id = ?
-        '''
-        res = self.conn.execute(query1, (user_id,)).fetchone()
+        res = self.conn.execute(_ACTIVE_CHALLENGE_QUERY, (user_id,)).fetchone()
         if res is None: return None
         c_id, issue_time = res
-        query2 = '''
-            SELECT problem_name, contest_id, p_index, rating_delta FROM challenge
-            WHERE id = ?
-        '''
-        res = self.conn.execute(query2, (c_id,)).fetchone()
+        res = self.conn.execute(_CHALLENGE_BY_ID_QUERY, (c_id,)).fetchone()
         if res is None: return None
         return c_id, issue_time, res[0], res[1], res[2], res[3]
 
@@ -299,10 +438,7 @@ class UserDbConn:
         return self.conn.execute(query, (user_id,)).fetchall()
 
     def get_noguds(self, user_id):
-        query = ('SELECT problem_name '
-                 'FROM challenge '
-                 f'WHERE user_id = ? AND status = {Gitgud.NOGUD}')
-        return {name for name, in self.conn.execute(query, (user_id,)).fetchall()}
+        return {name for name, in self.conn.execute(_GET_NOGUDS_QUERY, (user_id,)).fetchall()}
 
     def gitlog(self, user_id):
         query = f'''
@@ -352,79 +488,178 @@ class UserDbConn:
         return 1
 
     def cache_cf_user(self, user):
-        query = ('INSERT OR REPLACE INTO cf_user_cache '
-                 '(handle, first_name, last_name, country, city, organization, contribution, '
-                 '    rating, last_online_time, registration_time, friend_of_count, title_photo) '
-                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        return self.cache_cf_users([user])
+
+    def _save_cf_users(self, users):
         with self.conn:
-            return self.conn.execute(query, user).rowcount
+            return self.conn.executemany(_CACHE_CF_USER_QUERY, users).rowcount
+
+    def _remember_cf_users(self, users):
+        for user in users:
+            self._cf_user_by_handle[user.handle] = user
+        self.version += 1
+
+    def cache_cf_users(self, users):
+        """Caches several users in a single transaction."""
+        users = [cf.User._make(user) for user in users]
+        rc = self._save_cf_users(users)
+        self._remember_cf_users(users)
+        return rc
 
-    def fetch_cf_user(self, handle):
-        query = ('SELECT handle, first_name, last_name, country, city, organization, contribution, '
-                 '    rating, last_online_time, registration_time, friend_of_count, title_photo '
-                 'FROM cf_user_cache '
-                 'WHERE handle = ?')
-        user = self.conn.execute(query, (handle,)).fetchone()
-        return cf.User._make(user) if user else None
+    async def cache_cf_users_async(self, users):
+        """Like `cache_cf_users`, but writes on the database thread. The in-memory cache is
+        updated on the calling thread once the write is done, so that a read filling it from the
+        database in the meantime cannot overwrite the new users with old rows.
+        """
+        users = [cf.User._make(user) for user in users]
+        rc = await self.run_on_db_thread(self._save_cf_users, users)
+        self._remember_cf_users(users)
+        return rc
 
-    def set_handle(self, user_id, guild_id, handle):
-        query = ('SELECT user_id '
-                 'FROM user_handle '
-                 'WHERE guild_id = ? AND handle = ?')
-        existing = self.conn.execute(query, (guild_id, handle)).fetchone()
-        if existing and int(existing[0]) != user_id:
+    def fetch_cf_user(self, handle):
+        try:
+            return self._cf_user_by_handle[handle]
+        except KeyError:
+            pass
+        user = self.conn.execute(_FETCH_CF_USER_QUERY, (handle,)).fetchone()
+        user = cf.User._make(user) if user else None
+        self._cf_user_by_handle[handle] = user
+        return user
+
+    def fetch_cf_users(self, handles):
+        """Returns a dict of handle to the cached `cf.User` for those of the handles that are
+        cached."""
+        handles = list(handles)
+        missing = [handle for handle in set(handles) if handle not in self._cf_user_by_handle]
+        for i in range(0, len(missing), _MAX_PARAMS_PER_QUERY):
+            chunk = missing[i: i + _MAX_PARAMS_PER_QUERY]
+            query = _FETCH_CF_USERS_QUERY.format(', '.join(['?'] * len(chunk)))
+            for handle in chunk:
+                self._cf_user_by_handle[handle] = None
+            for user in self.conn.execute(query, chunk).fetchall():
+                user = cf.User._make(user)
+                self._cf_user_by_handle[user.handle] = user
+        users = {handle: self._cf_user_by_handle[handle] for handle in handles}
+        return {handle: user for handle, user in users.items() if user is not None}
+
+    def _guild_handles(self, guild_id):
+        guild_id = str(guild_id)
+        try:
+            return self._handles_by_guild[guild_id]
+        except KeyError:
+            pass
+        rows = self.conn.execute(_GET_GUILD_HANDLES_QUERY, (guild_id,)).fetchall()
+        guild_handles = self._handles_by_guild[guild_id] = _GuildHandles(rows)
+        return guild_handles
+
+    def _check_handle_free(self, user_id, guild_id, handle):
+        existing = self._guild_handles(guild_id).user_id_by_handle.get(handle)
+        if existing and int(existing) != user_id:
             raise UniqueConstraintFailed
 
+    def _save_handle(self, user_id, guild_id, handle):
         query = ('INSERT OR REPLACE INTO user_handle '
                  '(user_id, guild_id, handle, active) '
                  'VALUES (?, ?, ?, 1)')
         with self.conn:
             return self.conn.execute(query, (user_id, guild_id, handle)).rowcount
 
-    def set_inactive(self, guild_id_user_id_pairs):
+    def _remember_handle(self, user_id, guild_id, handle):
+        self._guild_handles(guild_id).set(str(user_id), handle, 1)
+        self.version += 1
+
+    def set_handle(self, user_id, guild_id, handle):
+        self._check_handle_free(user_id, guild_id, handle)
+        rc = self._save_handle(user_id, guild_id, handle)
+        self._remember_handle(user_id, guild_id, handle)
+        return rc
+
+    async def set_handle_async(self, user_id, guild_id, handle):
+        """Like `set_handle`, but writes on the database thread as `cache_cf_users_async`."""
+        self._check_handle_free(user_id, guild_id, handle)
+        rc = await self.run_on_db_thread(self._save_handle, user_id, guild_id, handle)
+        self._remember_handle(user_id, guild_id, handle)
+        return rc
+
+    def _save_inactive(self, pairs):
         query = ('UPDATE user_handle '
                  'SET active = 0 '
                  'WHERE guild_id = ? AND user_id = ?')
         with self.conn:
-            return self.conn.executemany(query, guild_id_user_id_pairs).rowcount
+            return self.conn.executemany(query, pairs).rowcount
+
+    def _remember_inactive(self, pairs):
+        for guild_id, user_id in pairs:
+            guild_handles = self._guild_handles(guild_id)
+            if str(user_id) in guild_handles.active_by_user_id:
+                guild_handles.active_by_user_id[str(user_id)] = 0
+        self.version += 1
+
+    def set_inactive(self, guild_id_user_id_pairs):
+        # Read twice below, so that a one-shot iterable is not used up by the query.
+        pairs = list(guild_id_user_id_pairs)
+        rc = self._save_inactive(pairs)
+        self._remember_inactive(pairs)
+        return rc
+
+    async def set_inactive_async(self, guild_id_user_id_pairs):
+        """Like `set_inactive`, but writes on the database thread as `cache_cf_users_async`."""
+        pairs = list(guild_id_user_id_pairs)
+        rc = await self.run_on_db_thread(self._save_inactive, pairs)
+        self._remember_inactive(pairs)
+        return rc
 
     def get_handle(self, user_id, guild_id):
-        query = ('SELECT handle '
-                 'FROM user_handle '
-                 'WHERE user_id = ? AND guild_id = ?')
-        res = self.conn.execute(query, (user_id, guild_id)).fetchone()
-        return res[0] if res else None
+        return self._guild_handles(guild_id).handle_by_user_id.get(str(user_id))
+
+    def get_handles(self, user_ids, guild_id):
+        """Returns a dict of user id to handle for those of the users that have a handle set in
+        the guild."""
+        handle_by_user_id = self._guild_handles(guild_id).handle_by_user_id
+        handles = {user_id: handle_by_user_id.get(str(user_id)) for user_id in user_ids}
+        return {user_id: handle for user_id, handle in handles.items() if handle is not None}
 
     def get_user_id(self, handle, guild_id):
-        query = ('SELECT user_id '
-                 'FROM user_handle '
-                 'WHERE handle = ? AND guild_id = ? AND active = 1')
-        res = self.conn.execute(query, (handle, guild_id)).fetchone()
-        return int(res[0]) if res else None
+        guild_handles = self._guild_handles(guild_id)
+        user_id = guild_handles.user_id_by_handle.get(handle)
+        if user_id is None or guild_handles.active_by_user_id[user_id] != 1:
+            return None
+        return int(user_id)
 
-    def remove_handle(self, user_id, guild_id):
+    def _save_removed_handle(self, user_id, guild_id):
         query = ('DELETE FROM user_handle '
                  'WHERE user_id = ? AND guild_id = ?')
         with self.conn:
             return self.conn.execute(query, (user_id, guild_id)).rowcount
 
+    def _remember_removed_handle(self, user_id, guild_id):
+        self._guild_handles(guild_id).remove(str(user_id))
+        self.version += 1
+
+    def remove_handle(self, user_id, guild_id):
+        rc = self._save_removed_handle(user_id, guild_id)
+        self._remember_removed_handle(user_id, guild_id)
+        return rc
+
+    async def remove_handle_async(self, user_id, guild_id):
+        """Like `remove_handle`, but writes on the database thread as `cache_cf_users_async`."""
+        rc = await self.run_on_db_thread(self._save_removed_handle, user_id, guild_id)
+        self._remember_removed_handle(user_id, guild_id)
+        return rc
+
     def get_handles_for_guild(self, guild_id):
-        query = ('SELECT user_id, handle '
-                 'FROM user_handle '
-                 'WHERE guild_id = ? AND active = 1')
-        res = self.conn.execute(query, (guild_id,)).fetchall()
-        return [(int(user_id), handle) for user_id, handle in res]
+        guild_handles = self._guild_handles(guild_id)
+        return [(int(user_id), handle)
+                for user_id, handle in guild_handles.handle_by_user_id.items()
+                if guild_handles.active_by_user_id[user_id] == 1]
 
     def get_cf_users_for_guild(self, guild_id):
-        query = ('SELECT u.user_id, c.handle, c.first_name, c.last_name, c.country, c.city, '
-                 '    c.organization, c.contribution, c.rating, c.last_online_time, '
-                 '    c.registration_time, c.friend_of_count, c.title_photo '
-                 'FROM user_handle AS u '
-                 'LEFT JOIN cf_user_cache AS c '
-                 'ON u.handle = c.handle '
-                 'WHERE u.guild_id = ? AND u.active = 1')
-        res = self.conn.execute(query, (guild_id,)).fetchall()
-        return [(int(t[0]), cf.User._make(t[1:])) for t in res]
+        user_id_handle_pairs = self.get_handles_for_guild(guild_id)
+        user_by_handle = self.fetch_cf_users(handle for _, handle in user_id_handle_pairs)
+        # Handles missing from cf_user_cache give a user with all fields None, as a LEFT JOIN.
+        missing = cf.User._make([None] * len(cf.User._fields))
+        return [(user_id, user_by_handle.get(handle, missing))
+                for user_id, handle in user_id_handle_pairs]
 
     def get_reminder_settings(self, guild_id):
         query = '''
@@ -501,46 +736,22 @@ class UserDbConn:
         return rc
 
     def check_duel_challenge(self, userid):
-        query = f'''
-            SELECT id FROM duel
-            WHERE (challengee = ? OR challenger = ?) AND (status == {Duel.ONGOING} OR status == {Duel.PENDING})
-        '''
-        return self.conn.execute(query, (userid, userid)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_CHALLENGE_QUERY, (userid, userid)).fetchone()
 
     def check_duel_accept(self, challengee):
-        query = f'''
-            SELECT id, challenger, problem_name FROM duel
-            WHERE challengee = ? AND status == {Duel.PENDING}
-        '''
-        return self.conn.execute(query, (challengee,)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_ACCEPT_QUERY, (challengee,)).fetchone()
 
     def check_duel_decline(self, challengee):
-        query = f'''
-            SELECT id, challenger FROM duel
-            WHERE challengee = ? AND status == {Duel.PENDING}
-        '''
-        return self.conn.execute(query, (challengee,)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_DECLINE_QUERY, (challengee,)).fetchone()
 
     def check_duel_withdraw(self, challenger):
-        query = f'''
-            SELECT id, challengee FROM duel
-            WHERE challenger = ? AND status == {Duel.PENDING}
-        '''
-        return self.conn.execute(query, (challenger,)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_WITHDRAW_QUERY, (challenger,)).fetchone()
 
     def check_duel_draw(self, userid):
-        query = f'''
-            SELECT id, challenger, challengee, start_time, type FROM duel
-            WHERE (challenger = ? OR challengee = ?) AND status == {Duel.ONGOING}
-        '''
-        return self.conn.execute(query, (userid, userid)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_DRAW_QUERY, (userid, userid)).fetchone()
 
     def check_duel_complete(self, userid):
-        query = f'''
-            SELECT id, challenger, challengee, start_time, problem_name, contest_id, p_index, type FROM duel
-            WHERE (challenger = ? OR challengee = ?) AND status == {Duel.ONGOING}
-        '''
-        return self.conn.execute(query, (userid, userid)).fetchone()
+        return self.conn.execute(_CHECK_DUEL_COMPLETE_QUERY, (userid, userid)).fetchone()
 
     def create_duel(self, challenger, challengee, issue_time, prob, dtype):
         query = f'''
@@ -622,10 +833,7 @@ class UserDbConn:
         return self.conn.execute(query, (userid, userid)).fetchall()
 
     def get_duel_problem_names(self, userid):
-        query = f'''
-            SELECT problem_name FROM duel WHERE (challengee = ? OR challenger = ?) AND (status == {Duel.COMPLETE} OR status == {Duel.INVALID})
-        '''
-        return self.conn.execute(query, (userid, userid)).fetchall()
+        return self.conn.execute(_GET_DUEL_PROBLEM_NAMES_QUERY, (userid, userid)).fetchall()
 
     def get_pair_duels(self, userid1, userid2):
         query = f'''
@@ -685,10 +893,7 @@ class UserDbConn:
         return self.conn.execute(query, (userid,)).fetchone()[0]
 
     def is_duelist(self, userid):
-        query = '''
-            SELECT 1 FROM duelist WHERE user_id = ?
-        '''
-        return self.conn.execute(query, (userid,)).fetchone()
+        return self.conn.execute(_IS_DUELIST_QUERY, (userid,)).fetchone()
 
     def register_duelist(self, userid):
         query = '''
@@ -758,6 +963,8 @@ class UserDbConn:
         '''
         self.conn.execute(inactive_query, (id,))
         self.conn.commit()
+        self._handles_by_guild.pop(str(id), None)
+        self.version += 1
 
     def update_status(self, guild_id: str, active_ids: list):
         placeholders = ', '.join(['?'] * len(active_ids))
@@ -770,6 +977,8 @@ class UserDbConn:
         '''.format(placeholders)
         rc = self.conn.execute(active_query, (*active_ids, guild_id)).rowcount
         self.conn.commit()
+        self._handles_by_guild.pop(str(guild_id), None)
+        self.version += 1
         return rc
 
     # Rated VC stuff
@@ -877,6 +1086,3 @@ class UserDbConn:
                  'WHERE user_id = ? AND vc_id = ? ')
         with self.conn:
             return self.conn.execute(query, (user_id, vc_id)).rowcount
-
-    def close(self):
-        self.conn.close()
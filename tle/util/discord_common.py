@@ -116,16 +116,15 @@ async def presence(bot):
     await asyncio.sleep(60)
 
     @tasks.task(name='OrzUpdate',
-               waiter=tasks.Waiter.fixed_delay(5*60))
+               waiter=tasks.Waiter.fixed_delay(10*60))
     async def presence_task(_):
-        while True:
-            target = random.choice([
-                member for member in bot.get_all_members()
-                if 'Purgatory' not in {role.name for role in member.roles}
-            ])
-            await bot.change_presence(activity=discord.Game(
-                name=f'{target.display_name} orz'))
-            await asyncio.sleep(10 * 60)
-
-    presence_task.start()
+        target = random.choice([
+            member for member in bot.get_all_members()
+            if 'Purgatory' not in {role.name for role in member.roles}
+        ])
+        await bot.change_presence(activity=discord.Game(
+            name=f'{target.display_name} orz'))
+
+    # The presence is not kept across restarts.
+    presence_task.start(force_run=True)
 
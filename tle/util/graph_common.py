@@ -1,16 +1,31 @@
-import os
+import asyncio
+import collections
+import hashlib
 import io
-import discord
+import logging
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import discord
 import matplotlib.font_manager
 import matplotlib
 matplotlib.use('agg') # Explicitly set the backend to avoid issues
 
+import seaborn as sns
 from tle import constants
-from matplotlib import pyplot as plt
 from matplotlib import rcParams
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from cycler import cycler
 
+logger = logging.getLogger(__name__)
+
+_RENDER_WORKERS = 2
+_SLOW_RENDER_TIME = 2
+_RENDER_CACHE_BYTES = 32 * 1024 * 1024
+
 rating_color_cycler = cycler('color', ['#5d4dff',
                                        '#009ccc',
                                        '#00ba6a',
@@ -20,6 +35,19 @@ rating_color_cycler = cycler('color', ['#5d4dff',
 fontprop = matplotlib.font_manager.FontProperties(fname=constants.NOTO_SANS_CJK_REGULAR_FONT_PATH)
 
 
+def setup_style():
+    """Sets the matplotlib and seaborn style of all plots. Runs in the bot process and in every
+    render worker."""
+    rcParams['figure.figsize'] = 7.0, 3.5
+    sns.set()
+    options = {
+        'axes.edgecolor': '#A0A0C5',
+        'axes.spines.top': False,
+        'axes.spines.right': False,
+    }
+    sns.set_style('darkgrid', options)
+
+
 # String wrapper to avoid the underscore behavior in legends
 #
 # In legends, matplotlib ignores labels that begin with _
@@ -31,23 +59,176 @@ class StrWrap:
     def __str__(self):
         return self.string
 
-def get_current_figure_as_file():
-    filename = os.path.join(constants.TEMP_DIR, f'tempplot_{time.time()}.png')
-    plt.savefig(filename, facecolor=plt.gca().get_facecolor(), bbox_inches='tight', pad_inches=0.25)
 
-    with open(filename, 'rb') as file:
-        discord_file = discord.File(io.BytesIO(file.read()), filename='plot.png')
+def new_figure(figsize=None):
+    """Returns a new figure independent of pyplot's global state."""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def figure_to_png(fig):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', facecolor=fig.axes[0].get_facecolor(), bbox_inches='tight',
+                pad_inches=0.25)
+    return buffer.getvalue()
 
-    os.remove(filename)
-    return discord_file
 
-def plot_rating_bg(ranks):
-    ymin, ymax = plt.gca().get_ylim()
-    bgcolor = plt.gca().get_facecolor()
+def get_png_as_file(png):
+    return discord.File(io.BytesIO(png), filename='plot.png')
+
+
+def plot_rating_bg(ax, ranks):
+    ymin, ymax = ax.get_ylim()
+    bgcolor = ax.get_facecolor()
     for rank in ranks:
-        plt.axhspan(rank.low, rank.high, facecolor=rank.color_graph, alpha=0.8, edgecolor=bgcolor, linewidth=0.5)
+        ax.axhspan(rank.low, rank.high, facecolor=rank.color_graph, alpha=0.8, edgecolor=bgcolor, linewidth=0.5)
+
+    for loc in ax.get_xticks():
+        ax.axvline(loc, color=bgcolor, linewidth=0.5)
+    ax.set_ylim(ymin, ymax)
+
+
+class _RenderStats:
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total_wait_time = 0
+        self.total_render_time = 0
+        self.max_render_time = 0
+
+    def record(self, wait_time, render_time, *, failed):
+        self.count += 1
+        self.failures += failed
+        self.total_wait_time += wait_time
+        self.total_render_time += render_time
+        self.max_render_time = max(self.max_render_time, render_time)
+
+
+class RenderQueue:
+    """Runs render functions in a pool of worker processes, so that plotting neither blocks the
+    event loop nor shares pyplot state between commands.
+
+    Jobs wait in a queue per key, usually the guild they are for, and keys take turns in round
+    robin order whenever a worker is free, so that one busy guild does not hold up the others.
+    Time spent waiting and rendering is recorded per render function in `stats`.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.stats = collections.defaultdict(_RenderStats)
+        self._pool = None
+        self._jobs_by_key = collections.OrderedDict()
+        self._running = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Workers are spawned rather than forked, the bot process has threads of its own.
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=setup_style)
+        return self._pool
+
+    async def render(self, fn, *args, key=None):
+        """Returns `fn(*args)` computed in a worker process. `fn` must be a module level function
+        and `args` must be picklable."""
+        future = asyncio.get_running_loop().create_future()
+        job = fn, args, future, time.perf_counter()
+        self._jobs_by_key.setdefault(key, collections.deque()).append(job)
+        self._dispatch()
+        return await future
+
+    def _dispatch(self):
+        while self._running < self.max_workers and self._jobs_by_key:
+            key, jobs = next(iter(self._jobs_by_key.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._jobs_by_key.move_to_end(key)
+            else:
+                del self._jobs_by_key[key]
+            if job[2].cancelled():
+                continue
+            self._running += 1
+            asyncio.create_task(self._run(*job))
+
+    async def _run(self, fn, args, future, queue_time):
+        start_time = time.perf_counter()
+        failed = False
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._get_pool(), fn, *args)
+        except Exception as ex:
+            failed = True
+            if isinstance(ex, BrokenProcessPool):
+                # A worker died, start a new pool for the next job.
+                self._pool = None
+            if not future.done():
+                future.set_exception(ex)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            render_time = time.perf_counter() - start_time
+            self.stats[fn.__name__].record(start_time - queue_time, render_time, failed=failed)
+            if render_time > _SLOW_RENDER_TIME:
+                logger.warning(f'Rendering {fn.__name__} took {render_time:.2f}s')
+            self._running -= 1
+            self._dispatch()
+
+
+class RenderCache:
+    """LRU cache of rendered images, bounded by their total size in bytes.
+
+    Images are addressed by a digest of the render function and a cache key, which must capture
+    everything the image depends on: the arguments of the command and the version of the data
+    plotted, such as `RatingChangesCache.version`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._png_by_digest = collections.OrderedDict()
+
+    @staticmethod
+    def digest(fn, cache_key):
+        return hashlib.sha256(repr((fn.__name__, cache_key)).encode()).hexdigest()
+
+    def get(self, digest):
+        png = self._png_by_digest.get(digest)
+        if png is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._png_by_digest.move_to_end(digest)
+        return png
+
+    def put(self, digest, png):
+        if len(png) > self.max_bytes:
+            return
+        old_png = self._png_by_digest.pop(digest, None)
+        if old_png is not None:
+            self.size -= len(old_png)
+        self._png_by_digest[digest] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            _, evicted = self._png_by_digest.popitem(last=False)
+            self.size -= len(evicted)
+
+
+render_queue = RenderQueue(_RENDER_WORKERS)
+render_cache = RenderCache(_RENDER_CACHE_BYTES)
+
 
-    locs, labels = plt.xticks()
-    for loc in locs:
-        plt.axvline(loc, color=bgcolor, linewidth=0.5)
-    plt.ylim(ymin, ymax)
+async def render(fn, *args, key=None, cache_key=None):
+    """Renders in the shared render queue, see `RenderQueue.render`. If `cache_key` is given the
+    image is looked up in and saved to the shared render cache, see `RenderCache`."""
+    if cache_key is None:
+        return await render_queue.render(fn, *args, key=key)
+    digest = render_cache.digest(fn, cache_key)
+    png = render_cache.get(digest)
+    if png is None:
+        png = await render_queue.render(fn, *args, key=key)
+        render_cache.put(digest, png)
+    return png
@@ -0,0 +1,112 @@
+import bisect
+
+import numpy as np
+
+from tle.util import codeforces_common as cf_common
+
+
+class ProblemIndex:
+    """Index over the problems of the problem cache for selecting problems by rating and tags.
+
+    Problems are kept sorted by the start time of their contest, stably so that problems of the
+    same contest keep their original order. Every selection is a list of positions into this
+    order, so results come out sorted without further work.
+    """
+
+    def __init__(self, problems, contest_by_id):
+        def start_time(problem):
+            contest = contest_by_id.get(problem.contestId)
+            return contest.startTimeSeconds if contest else 0
+
+        self.problems = sorted(problems, key=start_time)
+        self.position_by_name = {problem.name: pos for pos, problem in enumerate(self.problems)}
+        self.start_time = np.array([start_time(problem) for problem in self.problems],
+                                   dtype=np.int64)
+        self.contest_id = np.array([problem.contestId for problem in self.problems],
+                                   dtype=np.int64)
+
+        nonstandard_contest_ids = {contest_id for contest_id, contest in contest_by_id.items()
+                                   if cf_common.is_nonstandard_contest(contest)}
+        self.nonstandard = np.array([problem.contestId in nonstandard_contest_ids or
+                                     bool(problem.tag_matches(['*special']))
+                                     for problem in self.problems], dtype=bool)
+
+        positions_by_rating = {}
+        positions_by_tag = {}
+        for pos, problem in enumerate(self.problems):
+            positions_by_rating.setdefault(problem.rating, []).append(pos)
+            for tag in problem.tags:
+                positions_by_tag.setdefault(tag, []).append(pos)
+        self.ratings = sorted(positions_by_rating)
+        self.positions_by_rating = {rating: np.array(positions, dtype=np.int64)
+                                    for rating, positions in positions_by_rating.items()}
+        self.tag_mask = {}
+        for tag, positions in positions_by_tag.items():
+            mask = np.zeros(len(self.problems), dtype=bool)
+            mask[positions] = True
+            self.tag_mask[tag] = mask
+
+    def empty_bits(self):
+        """Returns packed bits over the problem positions with no bit set."""
+        return np.zeros((len(self.problems) + 7) // 8, dtype=np.uint8)
+
+    def bits_for_names(self, names):
+        """Returns packed bits over the problem positions, set for problems with the given names.
+        Bits of several sets can be combined with numpy bitwise operations."""
+        mask = np.zeros(len(self.problems), dtype=bool)
+        positions = [self.position_by_name.get(name) for name in names]
+        mask[[pos for pos in positions if pos is not None]] = True
+        return np.packbits(mask)
+
+    def _rating_positions(self, min_rating, max_rating):
+        lo = 0 if min_rating is None else bisect.bisect_left(self.ratings, min_rating)
+        hi = len(self.ratings) if max_rating is None else bisect.bisect_right(self.ratings, max_rating)
+        buckets = [self.positions_by_rating[rating] for rating in self.ratings[lo:hi]]
+        if not buckets:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(buckets))
+
+    def _tags_mask(self, tags):
+        """Mask of the problems for which `Problem.tag_matches(tags)` is truthy."""
+        mask = np.ones(len(self.problems), dtype=bool)
+        for query_tag in tags:
+            query_mask = np.zeros(len(self.problems), dtype=bool)
+            for tag, tag_mask in self.tag_mask.items():
+                if query_tag in tag:
+                    query_mask |= tag_mask
+            mask &= query_mask
+        return mask
+
+    def select(self, *, rating=None, min_rating=None, max_rating=None, tags=None,
+               contest_ids=None, standard_only=False, exclude_bits=None, exclude_names=(),
+               exclude_writers=(), newest_first=False):
+        """Returns the problems matching all the given criteria sorted by contest start time,
+        oldest first unless `newest_first` is set.
+
+        `exclude_bits` are packed bits of problems to leave out, as from `bits_for_names`.
+        `exclude_names` is a collection of problem names to leave out and `exclude_writers` a
+        collection of handles whose own contests are left out.
+        """
+        if rating is not None:
+            min_rating = max_rating = rating
+        positions = self._rating_positions(min_rating, max_rating)
+
+        keep = np.ones(len(positions), dtype=bool)
+        if tags:
+            keep &= self._tags_mask(tags)[positions]
+        if contest_ids is not None:
+            keep &= np.isin(self.contest_id[positions], list(contest_ids))
+        if standard_only:
+            keep &= ~self.nonstandard[positions]
+        if exclude_bits is not None:
+            excluded = np.unpackbits(exclude_bits, count=len(self.problems)).astype(bool)
+            keep &= ~excluded[positions]
+        positions = positions[keep]
+        if newest_first:
+            positions = positions[np.argsort(-self.start_time[positions], kind='stable')]
+
+        problems = (self.problems[pos] for pos in positions.tolist())
+        return [problem for problem in problems
+                if problem.name not in exclude_names and
+                not any(cf_common.is_contest_writer(problem.contestId, handle)
+                        for handle in exclude_writers)]
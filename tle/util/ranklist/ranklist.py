@@ -1,7 +1,12 @@
+import json
+import math
+from collections import defaultdict
+
+import numpy as np
 from discord.ext import commands
 
+from tle.util import codeforces_api as cf
 from tle.util.ranklist.rating_calculator import CodeforcesRatingCalculator
-from tle.util.handledict import HandleDict
 
 
 class RanklistError(commands.CommandError):
@@ -27,26 +32,289 @@ class DeltasNotPresentError(RanklistError):
         super().__init__(contest, f'Rating changes for `{contest.name}` not calculated or set.')
 
 
+# Storage of the fields of standings rows, fields not listed are stored separately. Optional
+# integers are stored with None as _MISSING, optional floats with None as NaN, and fields with few
+# distinct values as codes into a list of the values.
+_INT, _FLOAT, _CATEGORY = 'int', 'float', 'category'
+_MISSING = -1
+_SNAPSHOT_VERSION = 1
+_PARTY_FIELDS = {'contestId': _INT, 'participantType': _CATEGORY, 'teamId': _INT,
+                 'teamName': _CATEGORY, 'ghost': _CATEGORY, 'room': _INT,
+                 'startTimeSeconds': _INT}
+_ROW_FIELDS = {'rank': _INT, 'points': _FLOAT, 'penalty': _INT}
+_RESULT_FIELDS = {'points': _FLOAT, 'penalty': _INT, 'rejectedAttemptCount': _INT,
+                  'type': _CATEGORY, 'bestSubmissionTimeSeconds': _INT}
+# Fields that change as a contest goes on. When a ranklist is updated these are read for every
+# row and the other fields are only stored again for rows where one of these changed. Ranks shift
+# whenever a row above moves, so a change of rank alone does not count.
+_CHANGING_ROW_FIELDS = ('rank', 'points', 'penalty')
+_CHANGING_RESULT_FIELDS = ('points', 'rejectedAttemptCount', 'type')
+
+
+def _narrow(column):
+    """Returns the column with the smallest dtype of its kind that holds its values exactly."""
+    if column.dtype.kind == 'f':
+        narrowed = column.astype(np.float32)
+        exact = (narrowed == column) | np.isnan(column)
+        return narrowed if exact.all() else column
+    low, high = (column.min(), column.max()) if column.size else (0, 0)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return column.astype(dtype)
+    return column
+
+
+def _differ(old_column, new_column):
+    """Mask of the rows of two columns of the same shape whose values differ, NaN equals NaN."""
+    differ = old_column != new_column
+    if new_column.dtype.kind == 'f':
+        differ &= ~(np.isnan(old_column) & np.isnan(new_column))
+    if differ.ndim > 1:
+        differ = differ.any(axis=1)
+    return differ
+
+
+class _Categories:
+    """Codes for the values of a field, kept across updates of a ranklist so that codes of
+    different fetches can be compared."""
+
+    def __init__(self):
+        self.values = []
+        self.code_by_value = {}
+
+    def encode(self, values):
+        codes = []
+        for value in values:
+            code = self.code_by_value.get(value)
+            if code is None:
+                code = self.code_by_value[value] = len(self.values)
+                self.values.append(value)
+            codes.append(code)
+        return np.array(codes, dtype=np.int64)
+
+
 class Ranklist:
+    """Standings of a contest with rating changes.
+
+    Rows are not kept as namedtuples but as columns: numpy arrays for the fields of the rows and
+    their parties, 2-D arrays with a column per problem for the problem results, and the member
+    handles in a flat list. Rows are materialized again by `get_standing_row`.
+    """
+
     def __init__(self, contest, problems, standings, fetch_time, *, is_rated):
         self.contest = contest
         self.problems = problems
-        self.standings = standings
         self.fetch_time = fetch_time
 
         self.is_rated = is_rated
 
-        self.standing_by_id = HandleDict()
-        for row in self.standings:
-            if row.party.ghost:
-                # Apparently ghosts don't have team ID.
-                id_ = row.party.teamName
-            else:
-                id_ = row.party.teamId or row.party.members[0].handle
-            self.standing_by_id[id_] = row
+        self._categories = defaultdict(_Categories)
+        self._store(standings)
 
         self.delta_by_handle = None
         self.deltas_status = None
+        self._calculator = None
+        self._prediction_input = None
+
+    @staticmethod
+    def _row_id(row):
+        if row.party.ghost:
+            # Apparently ghosts don't have team ID.
+            return row.party.teamName
+        return row.party.teamId or row.party.members[0].handle
+
+    @staticmethod
+    def _id_key(id_):
+        # Handles are case insensitive, like in HandleDict.
+        return id_.lower() if type(id_) == str else id_
+
+    def _encode(self, group, field, kind, values):
+        if kind == _INT:
+            column = np.array([_MISSING if value is None else value for value in values],
+                              dtype=np.int64)
+        elif kind == _FLOAT:
+            column = np.array([np.nan if value is None else value for value in values],
+                              dtype=np.float64)
+        else:
+            column = self._categories[group, field].encode(values)
+        return _narrow(column)
+
+    def _decode(self, group, field, kind, value):
+        if kind == _INT:
+            return None if value == _MISSING else value
+        if kind == _FLOAT:
+            return None if math.isnan(value) else value
+        return self._categories[group, field].values[value]
+
+    def _store(self, standings):
+        self._set_ids([self._row_id(row) for row in standings])
+
+        self._members = []
+        member_offsets = [0]
+        for row in standings:
+            self._members += [member.handle for member in row.party.members]
+            member_offsets.append(len(self._members))
+        self._member_offsets = np.array(member_offsets, dtype=np.int64)
+
+        self._columns = {}
+        for field, kind in _PARTY_FIELDS.items():
+            values = [getattr(row.party, field) for row in standings]
+            self._columns['party', field] = self._encode('party', field, kind, values)
+        for field, kind in _ROW_FIELDS.items():
+            values = [getattr(row, field) for row in standings]
+            self._columns['row', field] = self._encode('row', field, kind, values)
+        num_problems = max((len(row.problemResults) for row in standings), default=0)
+        for field, kind in _RESULT_FIELDS.items():
+            values = [getattr(result, field) for row in standings for result in row.problemResults]
+            column = self._encode('result', field, kind, values)
+            self._columns['result', field] = column.reshape(len(standings), num_problems)
+
+    def _row(self, pos):
+        def decode(group, field, kind):
+            return self._decode(group, field, kind, self._columns[group, field][pos].item())
+
+        members = [cf.Member(handle) for handle in
+                   self._members[self._member_offsets[pos]:self._member_offsets[pos + 1]]]
+        party = cf.Party(members=members, **{field: decode('party', field, kind)
+                                             for field, kind in _PARTY_FIELDS.items()})
+        num_problems = self._columns['result', 'points'].shape[1]
+        results = []
+        for problem in range(num_problems):
+            results.append(cf.ProblemResult(**{
+                field: self._decode('result', field, kind,
+                                    self._columns['result', field][pos, problem].item())
+                for field, kind in _RESULT_FIELDS.items()}))
+        return cf.RanklistRow(party=party, problemResults=results,
+                              **{field: decode('row', field, kind)
+                                 for field, kind in _ROW_FIELDS.items()})
+
+    def _set_ids(self, ids):
+        self._ids = ids
+        self._position_by_id = {self._id_key(id_): pos for pos, id_ in enumerate(ids)}
+
+    def update(self, contest, problems, standings, fetch_time):
+        """Updates the ranklist to newly fetched standings of the same contest. Returns the
+        number of rows that were added or changed.
+
+        Rows are matched to the stored ones by id and moved to their new positions. Only the
+        rank, points, penalty and problem results that change as a contest goes on are read for
+        every row, the other fields are only stored again for rows that are new or whose points,
+        penalty or problem results changed."""
+        num_problems = max((len(row.problemResults) for row in standings), default=0)
+        if not self._ids or num_problems != self._columns['result', 'points'].shape[1]:
+            self._store(standings)
+            changed = len(standings)
+        else:
+            changed = self._update_rows(standings, num_problems)
+        self.contest = contest
+        self.problems = problems
+        self.fetch_time = fetch_time
+        return changed
+
+    def _update_rows(self, standings, num_problems):
+        ids = [self._row_id(row) for row in standings]
+        old_pos = np.array([self._position_by_id.get(self._id_key(id_), -1) for id_ in ids],
+                           dtype=np.int64)
+        changed = old_pos == -1
+        columns = {key: column[np.where(changed, 0, old_pos)]
+                   for key, column in self._columns.items()}
+
+        for field in _CHANGING_ROW_FIELDS:
+            values = [getattr(row, field) for row in standings]
+            column = self._encode('row', field, _ROW_FIELDS[field], values)
+            if field != 'rank':
+                changed |= _differ(columns['row', field], column)
+            columns['row', field] = column
+        for field in _CHANGING_RESULT_FIELDS:
+            values = [getattr(result, field) for row in standings for result in row.problemResults]
+            column = self._encode('result', field, _RESULT_FIELDS[field], values)
+            column = column.reshape(len(standings), num_problems)
+            changed |= _differ(columns['result', field], column)
+            columns['result', field] = column
+
+        changed_pos = np.flatnonzero(changed)
+        changed_rows = [standings[pos] for pos in changed_pos.tolist()]
+
+        def write(key, kind, values):
+            column = self._encode(key[0], key[1], kind, values)
+            dtype = np.promote_types(columns[key].dtype, column.dtype)
+            columns[key] = columns[key].astype(dtype, copy=False)
+            columns[key][changed_pos] = column.reshape((len(changed_rows),) +
+                                                       columns[key].shape[1:])
+
+        for field, kind in _PARTY_FIELDS.items():
+            write(('party', field), kind, [getattr(row.party, field) for row in changed_rows])
+        for field, kind in _ROW_FIELDS.items():
+            if field not in _CHANGING_ROW_FIELDS:
+                write(('row', field), kind, [getattr(row, field) for row in changed_rows])
+        for field, kind in _RESULT_FIELDS.items():
+            if field not in _CHANGING_RESULT_FIELDS:
+                write(('result', field), kind, [getattr(result, field) for row in changed_rows
+                                                for result in row.problemResults])
+
+        # The members of a row are fixed by its id, they are only read for new rows.
+        old_offsets = self._member_offsets.tolist()
+        members = []
+        member_offsets = [0]
+        for row, pos in zip(standings, old_pos.tolist()):
+            if pos == -1:
+                members += [member.handle for member in row.party.members]
+            else:
+                members += self._members[old_offsets[pos]:old_offsets[pos + 1]]
+            member_offsets.append(len(members))
+
+        self._set_ids(ids)
+        self._members = members
+        self._member_offsets = np.array(member_offsets, dtype=np.int64)
+        self._columns = columns
+        return len(changed_pos)
+
+    def save(self, file):
+        """Saves a snapshot of the ranklist to `file`, a path or a binary file object, in the
+        .npz format of numpy. Everything that is not a column is stored as JSON."""
+        metadata = {
+            'version': _SNAPSHOT_VERSION,
+            'contest': self.contest._asdict(),
+            'problems': [problem._asdict() for problem in self.problems],
+            'fetch_time': self.fetch_time,
+            'is_rated': self.is_rated,
+            'ids': self._ids,
+            'members': self._members,
+            'categories': {f'{group}.{field}': categories.values
+                           for (group, field), categories in self._categories.items()},
+            'delta_by_handle': self.delta_by_handle,
+            'deltas_status': self.deltas_status,
+        }
+        arrays = {f'{group}.{field}': column for (group, field), column in self._columns.items()}
+        arrays['member_offsets'] = self._member_offsets
+        arrays['metadata'] = np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """Loads a ranklist saved by `save`."""
+        with np.load(file) as data:
+            metadata = json.loads(data['metadata'].tobytes())
+            if metadata.get('version') != _SNAPSHOT_VERSION:
+                raise ValueError(f'Unsupported ranklist snapshot version {metadata.get("version")}')
+            contest = cf.make_from_dict(cf.Contest, metadata['contest'])
+            problems = [cf.make_from_dict(cf.Problem, problem) for problem in metadata['problems']]
+            ranklist = cls(contest, problems, [], metadata['fetch_time'],
+                           is_rated=metadata['is_rated'])
+            ranklist._set_ids(metadata['ids'])
+            ranklist._members = metadata['members']
+            ranklist._member_offsets = data['member_offsets']
+            for key, values in metadata['categories'].items():
+                group, field = key.split('.')
+                categories = ranklist._categories[group, field]
+                categories.values = values
+                categories.code_by_value = {value: code for code, value in enumerate(values)}
+            ranklist._columns = {tuple(key.split('.')): data[key] for key in data.files
+                                 if '.' in key}
+        ranklist.delta_by_handle = metadata['delta_by_handle']
+        ranklist.deltas_status = metadata['deltas_status']
+        return ranklist
 
     def set_deltas(self, delta_by_handle):
         if not self.is_rated:
@@ -57,21 +325,66 @@ class Ranklist:
     def predict(self, current_rating):
         if not self.is_rated:
             raise ContestNotRatedError(self.contest)
-        standings = [(id_, row.points, row.penalty, current_rating[id_])
-                     for id_, row in self.standing_by_id.items() if id_ in current_rating]
-        if standings:
-            self.delta_by_handle = CodeforcesRatingCalculator(standings).calculate_rating_changes()
+        # Of rows with the same id the last one counts, as it did when rows were in a HandleDict.
+        positions = [pos for pos in self._position_by_id.values()
+                     if self._ids[pos] in current_rating]
+        ids = [self._ids[pos] for pos in positions]
+        points = self._columns['row', 'points'][positions]
+        penalty = self._columns['row', 'penalty'][positions]
+        rating = np.array([current_rating[id_] for id_ in ids], dtype=np.int64)
+        prediction_input = ids, points, penalty, rating
+        if ids and not self._same_prediction_input(prediction_input):
+            # Reuse the rating histogram of the previous prediction, only the contestants whose
+            # rating or presence changed need to be accounted for.
+            standings = list(zip(ids, points.tolist(), penalty.tolist(), rating.tolist()))
+            self._calculator = CodeforcesRatingCalculator(standings, previous=self._calculator)
+            self._prediction_input = prediction_input
+            self.delta_by_handle = self._calculator.calculate_rating_changes()
         self.deltas_status = 'Predicted'
 
-    def get_delta(self, handle):
+    def predict_insertions(self, current_rating, extra_rating):
+        """Returns a dict of handle to predicted delta for the handles of `extra_rating`, each
+        predicted as if it were the only one of them taking part along with the contestants of
+        `current_rating`. Handles not in the ranklist get no delta. The deltas of the ranklist
+        are not changed."""
         if not self.is_rated:
             raise ContestNotRatedError(self.contest)
-        if handle not in self.standing_by_id:
-            raise HandleNotPresentError(self.contest, handle)
-        return self.delta_by_handle.get(handle)
+        positions = [pos for pos in self._position_by_id.values()
+                     if self._ids[pos] in current_rating and self._ids[pos] not in extra_rating]
+        extra_positions = [pos for pos in self._position_by_id.values()
+                           if self._ids[pos] in extra_rating]
 
-    def get_standing_row(self, handle):
+        def standings(positions, rating):
+            points = self._columns['row', 'points'][positions].tolist()
+            penalty = self._columns['row', 'penalty'][positions].tolist()
+            ids = [self._ids[pos] for pos in positions]
+            return list(zip(ids, points, penalty, [rating[id_] for id_ in ids]))
+
+        # Extra contestants go where their rows are, for the same order of ties as in `predict`.
+        indices = np.searchsorted(positions, extra_positions).tolist()
+        return CodeforcesRatingCalculator.predict_insertions(
+            standings(positions, current_rating), standings(extra_positions, extra_rating),
+            indices=indices)
+
+    def _same_prediction_input(self, prediction_input):
+        if self._prediction_input is None:
+            return False
+        ids, *arrays = prediction_input
+        old_ids, *old_arrays = self._prediction_input
+        return ids == old_ids and all(np.array_equal(array, old_array)
+                                      for array, old_array in zip(arrays, old_arrays))
+
+    def _position(self, handle):
         try:
-            return self.standing_by_id[handle]
+            return self._position_by_id[self._id_key(handle)]
         except KeyError:
             raise HandleNotPresentError(self.contest, handle)
+
+    def get_delta(self, handle):
+        if not self.is_rated:
+            raise ContestNotRatedError(self.contest)
+        self._position(handle)
+        return self.delta_by_handle.get(handle)
+
+    def get_standing_row(self, handle):
+        return self._row(self._position(handle))
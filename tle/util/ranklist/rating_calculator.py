@@ -4,106 +4,234 @@ by Mike Mirzayanov (mirzayanovmr@gmail.com) at https://codeforces.com/contest/1/
 Updated to use the current rating formula.
 """
 
-from dataclasses import dataclass
-
 import numpy as np
 from numpy.fft import fft, ifft
 
+_MAX = 6144
+_SEARCH_LOW, _SEARCH_HIGH = 1, 8000
+# Half the width of the range searched around a guessed performance rating.
+_GUESS_RANGE = 16
+
+# The ELO win probability for all possible rating differences.
+_ELO_WIN_PROB = np.roll(1 / (1 + pow(10, np.arange(-_MAX, _MAX) / 400)), -_MAX)
+
 
 def intdiv(x, y):
     return -(-x // y) if x < 0 else x // y
 
 
-@dataclass
-class Contestant:
-    party: str
-    points: float
-    penalty: int
-    rating: int
-    need_rating: int = 0
-    delta: int = 0
-    rank: float = 0.0
-    seed: float = 0.0
+def _intdiv_array(x, y):
+    """Elementwise `intdiv` for an integer array `x`."""
+    return np.where(x < 0, -(-x // y), x // y)
+
+
+def _standings_to_arrays(standings):
+    parties, points, penalty, rating = zip(*standings) if standings else ((), (), (), ())
+    return (list(parties), np.array(points, dtype=np.float64),
+            np.array(penalty, dtype=np.int64), np.array(rating, dtype=np.int64))
+
+
+def _rank_order(points, penalty):
+    """Stable sort order by (-points, penalty)."""
+    order = np.argsort(penalty, kind='stable')
+    return order[np.argsort(-points[order], kind='stable')]
+
+
+def _mid_rank(rank, contestant_seed):
+    # Square roots are taken one by one with the same pow() as scalar code, numpy's vectorized
+    # sqrt can differ from it in the last bit.
+    return np.array([x ** 0.5 for x in (rank * contestant_seed).tolist()])
+
+
+def _performance_rating(seed, rating, rank, *, guess=None):
+    """Batched binary search for the highest rating whose seed, leaving out the contestant's own
+    term, is at least the given rank.
+
+    If `guess` is given, contestants whose answer is known to lie within `_GUESS_RANGE` of their
+    guess are only searched in that range. The seed decreases with the rating, so the answer is
+    the same as that of a search over the full range.
+    """
+    def below_rank(r):
+        return seed[r] - _ELO_WIN_PROB[r - rating] < rank
+
+    n = len(rank)
+    left = np.full(n, _SEARCH_LOW, dtype=np.int64)
+    right = np.full(n, _SEARCH_HIGH, dtype=np.int64)
+    if guess is not None:
+        low = np.maximum(guess - _GUESS_RANGE, _SEARCH_LOW)
+        high = np.minimum(guess + _GUESS_RANGE, _SEARCH_HIGH)
+        # The ends of the full search are taken as qualifying and not qualifying respectively.
+        known = (((low == _SEARCH_LOW) | ~below_rank(low)) &
+                 ((high == _SEARCH_HIGH) | below_rank(high)))
+        left = np.where(known, low, left)
+        right = np.where(known, high, right)
+    active = right - left > 1
+    while active.any():
+        mid = (left + right) // 2
+        lower = below_rank(mid)
+        right = np.where(active & lower, mid, right)
+        left = np.where(active & ~lower, mid, left)
+        active = right - left > 1
+    return left
 
 
 class CodeforcesRatingCalculator:
-    def __init__(self, standings):
-        """Calculate Codeforces rating changes and seeds given contest and user information."""
-        self.contestants = [Contestant(handle, points, penalty, rating)
-                            for handle, points, penalty, rating in standings]
-        self._precalc_seed()
-        self._reassign_ranks()
-        self._process()
+    def __init__(self, standings, *, previous=None):
+        """Calculate Codeforces rating changes and seeds given contest and user information.
+
+        Contestants are held as parallel numpy arrays, kept in the same order the original
+        per-contestant implementation sorted them in, so that results are identical to it.
+        If `previous` is a calculator for an earlier snapshot of the same contest, its rating
+        histogram is updated with the contestants that came, left or changed rating instead of
+        being rebuilt.
+        """
+        self._rank_and_search(*_standings_to_arrays(standings), previous=previous)
         self._update_delta()
 
-    def calculate_rating_changes(self):
-        """Return a mapping between contestants and their corresponding delta."""
-        return {contestant.party: contestant.delta for contestant in self.contestants}
-
-    def get_seed(self, rating, me=None):
-        """Get seed given a rating and user."""
-        seed = self.seed[rating]
-        if me:
-            seed -= self.elo_win_prob[rating - me.rating]
-        return seed
+    def _rank_and_search(self, parties, points, penalty, rating, *, previous=None):
+        """Calculates everything up to the zero sum corrections of `_update_delta`, leaving the
+        contestants sorted by rank."""
+        self.parties = parties
+        self.points = points
+        self.penalty = penalty
+        self.rating = rating
+        self.need_rating = np.zeros(len(self.parties), dtype=np.int64)
+        self.delta = np.zeros(len(self.parties), dtype=np.int64)
+        self.rank = np.zeros(len(self.parties), dtype=np.int64)
+        self.elo_win_prob = _ELO_WIN_PROB
+        self._precalc_seed(previous)
+        self._reassign_ranks()
+        self._process()
 
-    def _precalc_seed(self):
-        MAX = 6144
+    @classmethod
+    def predict_insertions(cls, standings, extra, *, indices=None):
+        """Returns a dict of party to delta for the contestants of `extra`, each calculated as if
+        it were the only one of them taking part along with the contestants of `standings`. Both
+        are given like the standings of the constructor. If given, `indices[i]` is the position
+        among `standings` at which `extra[i]` is inserted, by default it goes last.
+
+        The field of `standings` is ranked, seeded and searched once. Inserting a contestant
+        adds its shifted Elo term to the seed and moves the ranks from its tie group on down by
+        one, which moves the performance ratings of the field by a few points, so they are
+        searched for near those of the field. The zero sum corrections still take the deltas of
+        the whole field, so each extra contestant costs a few vectorized passes over it.
+
+        The result is that of a calculator for every extra contestant, except that the seed is
+        updated by adding the new term instead of convolving the histogram again. The two are
+        equal up to floating point rounding of the seed.
+        """
+        field = cls.__new__(cls)
+        field._rank_and_search(*_standings_to_arrays(standings))
+        n_field = len(field.parties)
+        if indices is None:
+            indices = [n_field] * len(extra)
+        position = np.arange(n_field)
+        # Stable, the extra contestant goes before field contestants with the same rating that
+        # are after it in rank order.
+        rating_order = np.argsort(-field.rating, kind='stable')
+        n = n_field + 1
+        zero_sum_count = min(4 * round(n ** 0.5), n)
 
-        # Precompute the ELO win probability for all possible rating differences.
-        self.elo_win_prob = np.roll(1 / (1 + pow(10, np.arange(-MAX, MAX) / 400)), -MAX)
+        delta_by_party = {}
+        for index, (party, x_points, x_penalty, x_rating) in zip(indices, extra):
+            # The field is sorted by rank, so those ranked strictly better come first followed
+            # by those tied with the extra contestant, among whom it keeps its index order.
+            tied = (field.points == x_points) & (field.penalty == x_penalty)
+            n_better = int(((field.points > x_points) |
+                            (field.points == x_points) & (field.penalty < x_penalty)).sum())
+            n_tied = int(tied.sum())
+            tied_before = field._rank_order[n_better:n_better + n_tied] < index
+            x_position = n_better + int(tied_before.sum())
+
+            seed = field.seed + np.roll(_ELO_WIN_PROB, x_rating)
+            rank = field.rank + (position >= n_better)
+            need = _performance_rating(seed, field.rating,
+                                       _mid_rank(rank, seed[field.rating] - _ELO_WIN_PROB[0]),
+                                       guess=field.need_rating)
+            x_rank = n_better + n_tied + 1
+            x_need, = _performance_rating(
+                seed, x_rating, _mid_rank(np.array([x_rank]), seed[x_rating] - _ELO_WIN_PROB[0]))
+
+            delta = _intdiv_array(need - field.rating, 2)
+            x_delta = intdiv(int(x_need) - x_rating, 2)
+            correction = intdiv(-(int(delta.sum()) + x_delta), n) - 1
+
+            x_rating_position = int((field.rating > x_rating).sum() +
+                                    ((field.rating == x_rating) & (position < x_position)).sum())
+            x_in_top = x_rating_position < zero_sum_count
+            top = rating_order[:zero_sum_count - x_in_top]
+            top_sum = int(delta[top].sum()) + (x_delta if x_in_top else 0)
+            delta_sum = -(top_sum + zero_sum_count * correction)
+            top_correction = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
+            delta_by_party[party] = x_delta + correction + top_correction
+        return delta_by_party
 
-        # Compute the rating histogram.
-        count = np.zeros(2 * MAX)
-        for a in self.contestants:
-            count[a.rating] += 1
+    def calculate_rating_changes(self):
+        """Return a mapping between contestants and their corresponding delta."""
+        return dict(zip(self.parties, self.delta.tolist()))
+
+    def _permute(self, order):
+        self.parties = [self.parties[i] for i in order]
+        for name in ('points', 'penalty', 'rating', 'rank', 'need_rating', 'delta'):
+            setattr(self, name, getattr(self, name)[order])
+
+    def _precalc_seed(self, previous):
+        if previous is not None:
+            self.count, changed = self._update_histogram(previous)
+            if not changed:
+                self.seed = previous.seed
+                return
+        else:
+            # Compute the rating histogram.
+            self.count = np.zeros(2 * _MAX)
+            np.add.at(self.count, self.rating, 1)
 
         # Precompute the seed for all possible ratings using FFT.
-        self.seed = 1 + ifft(fft(count) * fft(self.elo_win_prob)).real
+        self.seed = 1 + ifft(fft(self.count) * fft(self.elo_win_prob)).real
+
+    def _update_histogram(self, previous):
+        """Returns the rating histogram of `previous` updated to this set of contestants, and
+        whether it differs from the one of `previous`."""
+        old_rating = dict(zip(previous.parties, previous.rating.tolist()))
+        new_rating = dict(zip(self.parties, self.rating.tolist()))
+        removed = [rating for party, rating in old_rating.items()
+                   if new_rating.get(party) != rating]
+        added = [rating for party, rating in new_rating.items()
+                 if old_rating.get(party) != rating]
+        count = previous.count.copy()
+        np.add.at(count, np.array(removed, dtype=np.int64), -1)
+        np.add.at(count, np.array(added, dtype=np.int64), 1)
+        return count, bool(removed or added)
 
     def _reassign_ranks(self):
         """Find the rank of each contestant."""
-        contestants = self.contestants
-        contestants.sort(key=lambda o: (-o.points, o.penalty))
-        points = penalty = rank = None
-        for i in reversed(range(len(contestants))):
-            if contestants[i].points != points or contestants[i].penalty != penalty:
-                rank = i + 1
-                points = contestants[i].points
-                penalty = contestants[i].penalty
-            contestants[i].rank = rank
+        # Kept for `predict_insertions`, to place extra contestants among ties.
+        self._rank_order = _rank_order(self.points, self.penalty)
+        self._permute(self._rank_order)
+
+        # Tied contestants all get the rank of the last one among them.
+        points, penalty = self.points, self.penalty
+        is_last = np.ones(len(points), dtype=bool)
+        is_last[:-1] = (points[1:] != points[:-1]) | (penalty[1:] != penalty[:-1])
+        group = np.cumsum(is_last) - is_last
+        self.rank = np.flatnonzero(is_last)[group] + 1
 
     def _process(self):
         """Process and assign approximate delta for each contestant."""
-        for a in self.contestants:
-            a.seed = self.get_seed(a.rating, a)
-            mid_rank = (a.rank * a.seed) ** 0.5
-            a.need_rating = self._rank_to_rating(mid_rank, a)
-            a.delta = intdiv(a.need_rating - a.rating, 2)
-
-    def _rank_to_rating(self, rank, me):
-        """Binary Search to find the performance rating for a given rank."""
-        left, right = 1, 8000
-        while right - left > 1:
-            mid = (left + right) // 2
-            if self.get_seed(mid, me) < rank:
-                right = mid
-            else:
-                left = mid
-        return left
+        contestant_seed = self.seed[self.rating] - self.elo_win_prob[0]
+        mid_rank = _mid_rank(self.rank, contestant_seed)
+        self.need_rating = _performance_rating(self.seed, self.rating, mid_rank)
+        self.delta = _intdiv_array(self.need_rating - self.rating, 2)
 
     def _update_delta(self):
         """Update the delta of each contestant."""
-        contestants = self.contestants
-        n = len(contestants)
+        n = len(self.parties)
 
-        contestants.sort(key=lambda o: -o.rating)
-        correction = intdiv(-sum(c.delta for c in contestants), n) - 1
-        for contestant in contestants:
-            contestant.delta += correction
+        self._permute(np.argsort(-self.rating, kind='stable'))
+        correction = intdiv(-int(self.delta.sum()), n) - 1
+        self.delta += correction
 
         zero_sum_count = min(4 * round(n ** 0.5), n)
-        delta_sum = -sum(contestants[i].delta for i in range(zero_sum_count))
+        delta_sum = -int(self.delta[:zero_sum_count].sum())
         correction = min(0, max(-10, intdiv(delta_sum, zero_sum_count)))
-        for contestant in contestants:
-            contestant.delta += correction
+        self.delta += correction
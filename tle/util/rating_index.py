@@ -0,0 +1,114 @@
+import numpy as np
+
+
+class RatingIndex:
+    """Columnar index over saved rating changes, with one entry per handle.
+
+    For every handle it holds the latest rating along with the contest id and time of the change
+    that set it, and the number of rated contests. The columns are numpy arrays indexed by handle
+    id, so aggregate queries over all users are array operations. New changes are applied
+    incrementally.
+    """
+
+    _INITIAL_CAPACITY = 1024
+
+    def __init__(self):
+        self.handles = []
+        self.handle_ids = {}
+        self.rating = np.zeros(self._INITIAL_CAPACITY, dtype=np.int32)
+        self.contest_id = np.zeros(self._INITIAL_CAPACITY, dtype=np.int32)
+        self.update_time = np.zeros(self._INITIAL_CAPACITY, dtype=np.int64)
+        self.num_contests = np.zeros(self._INITIAL_CAPACITY, dtype=np.int32)
+        self._sorted_ratings = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the index from (handle, contest id, rating, update time, number of contests)
+        rows, one per handle."""
+        index = cls()
+        rows = list(rows)
+        if not rows:
+            return index
+        handles, contest_ids, ratings, update_times, num_contests = zip(*rows)
+        ids = index._intern(handles)
+        index.contest_id[ids] = contest_ids
+        index.rating[ids] = ratings
+        index.update_time[ids] = update_times
+        index.num_contests[ids] = num_contests
+        return index
+
+    def __len__(self):
+        return len(self.handles)
+
+    def _intern(self, handles):
+        ids = []
+        for handle in handles:
+            handle_id = self.handle_ids.get(handle)
+            if handle_id is None:
+                handle_id = self.handle_ids[handle] = len(self.handles)
+                self.handles.append(handle)
+            ids.append(handle_id)
+        if len(self.handles) > len(self.rating):
+            capacity = max(len(self.handles), 2 * len(self.rating))
+            for name in ('rating', 'contest_id', 'update_time', 'num_contests'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        return np.array(ids, dtype=np.int64)
+
+    def apply_changes(self, changes):
+        """Applies rating changes that are not yet accounted for in the index."""
+        if not changes:
+            return
+        changes = sorted(changes, key=lambda change: change.ratingUpdateTimeSeconds)
+        ids = self._intern([change.handle for change in changes])
+        np.add.at(self.num_contests, ids, 1)
+
+        # Of several changes for the same handle the latest one counts, the changes are sorted.
+        ids_reversed = ids[::-1]
+        _, first_in_reversed = np.unique(ids_reversed, return_index=True)
+        latest = len(changes) - 1 - first_in_reversed
+        latest_ids = ids[latest]
+        update_time = np.array([changes[i].ratingUpdateTimeSeconds for i in latest], dtype=np.int64)
+        newer = update_time >= self.update_time[latest_ids]
+        latest, latest_ids = latest[newer], latest_ids[newer]
+        self.rating[latest_ids] = [changes[i].newRating for i in latest]
+        self.contest_id[latest_ids] = [changes[i].contestId for i in latest]
+        self.update_time[latest_ids] = update_time[newer]
+        self._sorted_ratings = None
+
+    def get_rating(self, handle):
+        handle_id = self.handle_ids.get(handle)
+        return None if handle_id is None else int(self.rating[handle_id])
+
+    def get_num_contests(self, handle):
+        handle_id = self.handle_ids.get(handle)
+        return 0 if handle_id is None else int(self.num_contests[handle_id])
+
+    def sorted_ratings(self):
+        """Returns a sorted array of the current ratings of all handles. Do not modify it."""
+        if self._sorted_ratings is None:
+            self._sorted_ratings = np.sort(self.rating[:len(self.handles)])
+        return self._sorted_ratings
+
+    def percentile(self, rating):
+        """Percentage of handles with current rating lower than `rating`."""
+        ratings = self.sorted_ratings()
+        if not len(ratings):
+            return 0.0
+        return 100 * int(np.searchsorted(ratings, rating)) / len(ratings)
+
+    def _mask_with_min_contests(self, time_cutoff, n):
+        size = len(self.handles)
+        return (self.num_contests[:size] >= n) & (self.update_time[:size] >= time_cutoff)
+
+    def handles_with_min_contests(self, time_cutoff, n):
+        """Handles with at least `n` rated contests and a rating change at or after
+        `time_cutoff`."""
+        mask = self._mask_with_min_contests(time_cutoff, n)
+        return [self.handles[i] for i in np.flatnonzero(mask)]
+
+    def ratings_with_min_contests(self, time_cutoff, n):
+        """Current ratings of the handles given by `handles_with_min_contests`."""
+        return self.rating[:len(self.handles)][self._mask_with_min_contests(time_cutoff, n)]
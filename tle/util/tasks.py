@@ -1,10 +1,22 @@
 import asyncio
+import json
 import logging
+import os
+import random
+import time
 
 from discord.ext import commands
 
+from tle import constants
 import tle.util.codeforces_common as cf_common
 
+logger = logging.getLogger(__name__)
+
+# Runs of tasks on their schedule beyond this many wait for others to finish. Manual triggers are
+# not limited.
+_MAX_CONCURRENT_SCHEDULED_RUNS = 3
+_scheduled_run_semaphore = None
+
 
 class TaskError(commands.CommandError):
     pass
@@ -25,16 +37,86 @@ def _ensure_coroutine_func(func):
         raise TypeError('The decorated function must be a coroutine function.')
 
 
+def _get_scheduled_run_semaphore():
+    global _scheduled_run_semaphore
+    if _scheduled_run_semaphore is None:
+        # Created lazily to be bound to the running event loop.
+        _scheduled_run_semaphore = asyncio.Semaphore(_MAX_CONCURRENT_SCHEDULED_RUNS)
+    return _scheduled_run_semaphore
+
+
+class TaskStates:
+    """The last run and outcome of every task by name, persisted as JSON so that schedules
+    survive restarts. States saved by an earlier process are handed out once, when the task is
+    first started.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._state_by_name = None
+        self._previous_names = set()
+
+    def _load(self):
+        if self._state_by_name is None:
+            try:
+                with open(self.path) as f:
+                    self._state_by_name = json.load(f)
+            except FileNotFoundError:
+                self._state_by_name = {}
+            except (OSError, ValueError):
+                logger.warning(f'Could not read task states from {self.path}, ignoring.',
+                               exc_info=True)
+                self._state_by_name = {}
+            self._previous_names = set(self._state_by_name)
+        return self._state_by_name
+
+    def get(self, name):
+        """Returns a dict with the `start_time` and `finish_time` of the last run of the task and
+        its `error`, which is None if the run succeeded. Returns None if the task never ran."""
+        return self._load().get(name)
+
+    def pop_previous(self, name):
+        """Returns the state of the task saved by an earlier process, if it was not returned or
+        replaced yet."""
+        state_by_name = self._load()
+        if name not in self._previous_names:
+            return None
+        self._previous_names.remove(name)
+        return state_by_name[name]
+
+    def record(self, name, start_time, finish_time, error=None):
+        state_by_name = self._load()
+        state_by_name[name] = {
+            'start_time': start_time,
+            'finish_time': finish_time,
+            'error': error,
+        }
+        self._previous_names.discard(name)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state_by_name, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warning(f'Could not save task states to {self.path}.', exc_info=True)
+
+
+task_states = TaskStates(constants.TASK_STATE_FILE_PATH)
+
+
 class Waiter:
-    def __init__(self, func, *, run_first=False, needs_instance=False):
+    def __init__(self, func, *, run_first=False, needs_instance=False, delay=None, jitter=0):
         """`run_first` denotes whether this waiter should be run before the task's `func` when
         run for the first time. `needs_instance` indicates whether a self argument is required by
-        the `func`.
+        the `func`. `delay` and `jitter` are set by waiters that wait for a fixed time, so that the
+        task can wait out the rest of it after a restart.
         """
         _ensure_coroutine_func(func)
         self.func = func
         self.run_first = run_first
         self.needs_instance = needs_instance
+        self.delay = delay
+        self.jitter = jitter
 
     async def wait(self, instance=None):
         if self.needs_instance:
@@ -43,16 +125,18 @@ class Waiter:
             return await self.func()
 
     @staticmethod
-    def fixed_delay(delay, run_first=False):
+    def fixed_delay(delay, run_first=False, jitter=0):
         """Returns a waiter that always waits for the given time (in seconds) and returns the
-        time waited.
+        time waited. A random time of up to `jitter` seconds is added to every wait, to spread
+        out tasks with the same delay.
         """
 
         async def wait_func():
-            await asyncio.sleep(delay)
-            return delay
+            wait_time = delay + random.uniform(0, jitter)
+            await asyncio.sleep(wait_time)
+            return wait_time
 
-        return Waiter(wait_func, run_first=run_first)
+        return Waiter(wait_func, run_first=run_first, delay=delay, jitter=jitter)
 
     @staticmethod
     def for_event(event_cls, run_first=True):
@@ -85,6 +169,9 @@ class Task:
     execute periodically and another coroutine function `waiter` to wait on between calls to `func`.
     The return value of `waiter` is passed to `func` in the next call. An optional coroutine
     function `exception_handler` may be provided to which exceptions will be reported.
+
+    The time and outcome of every run are saved in `task_states` under the name of the task.
+    At most `_MAX_CONCURRENT_SCHEDULED_RUNS` tasks run on their schedule at once.
     """
 
     def __init__(self, name, func, waiter, exception_handler=None, *, instance=None):
@@ -124,14 +211,22 @@ class Task:
     def running(self):
         return self.asyncio_task is not None and not self.asyncio_task.done()
 
-    def start(self):
-        """Starts up the task."""
+    @property
+    def state(self):
+        """The last run and outcome of the task, see `TaskStates.get`."""
+        return task_states.get(self.name)
+
+    def start(self, *, force_run=False):
+        """Starts up the task. If the task waits for a fixed delay and last ran successfully in an
+        earlier process, the first run only happens once the rest of the delay has passed.
+        `force_run` runs it right away instead, such as when the data it refreshes is missing.
+        """
         if self._waiter is None:
             raise WaiterRequired(self.name)
         if self.running:
             raise TaskAlreadyRunning(self.name)
         self.logger.info(f'Starting up task `{self.name}`.')
-        self.asyncio_task = asyncio.create_task(self._task())
+        self.asyncio_task = asyncio.create_task(self._task(force_run))
 
     async def manual_trigger(self, arg=None):
         """Manually triggers the `func` with the optionally provided `arg`, which defaults to
@@ -147,15 +242,32 @@ class Task:
             self.asyncio_task.cancel()
             await asyncio.sleep(0)  # To ensure cancellation if called from within the task itself.
 
-    async def _task(self):
+    async def _task(self, force_run):
         arg = None
+        previous = task_states.pop_previous(self.name)
         if self._waiter.run_first:
             arg = await self._waiter.wait(self.instance)
+        elif not force_run:
+            await self._catch_up(previous)
         while True:
-            await self._execute_func(arg)
+            async with _get_scheduled_run_semaphore():
+                await self._execute_func(arg)
             arg = await self._waiter.wait(self.instance)
 
+    async def _catch_up(self, previous):
+        """Waits out the rest of the fixed delay since the successful run of an earlier
+        process."""
+        if self._waiter.delay is None or previous is None or previous['error'] is not None:
+            return
+        wait_time = (previous['finish_time'] + self._waiter.delay - time.time() +
+                     random.uniform(0, self._waiter.jitter))
+        if wait_time > 0:
+            self.logger.info(f'Task `{self.name}` ran recently, next run in {wait_time:.0f}s.')
+            await asyncio.sleep(wait_time)
+
     async def _execute_func(self, arg):
+        start_time = time.time()
+        error = None
         try:
             if self.instance is not None:
                 await self.func(self.instance, arg)
@@ -164,9 +276,11 @@ class Task:
         except asyncio.CancelledError:
             raise
         except Exception as ex:
+            error = f'{ex.__class__.__name__}: {ex}'
             self.logger.warning(f'Exception in task `{self.name}`, ignoring.', exc_info=True)
             if self._exception_handler is not None:
                 await self._exception_handler.handle(ex, self.instance)
+        task_states.record(self.name, start_time, time.time(), error)
 
 
 class TaskSpec: